@@ -17,11 +17,35 @@ import base64
 import tempfile
 import subprocess
 import logging
+import hashlib
+import shutil
+import ast
+import copy
+import math
+import asyncio
+import gzip
+import bz2
+import lzma
+import zipfile
+import zlib
+import sqlite3
+import threading
+import codecs
+import itertools
+import contextvars
+import signal
+import pickle
+import warnings
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime
 from io import BytesIO
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import StreamingResponse
 from fastapi import FastAPI
 from dotenv import load_dotenv
 
@@ -37,6 +61,34 @@ try:
 except Exception:
     PIL_AVAILABLE = False
 
+# Optional Arrow support (shared-memory dataset tier)
+try:
+    import pyarrow as pa
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+# Optional zstd support (compressed uploads)
+try:
+    import zstandard as zstd
+    ZSTD_AVAILABLE = True
+except Exception:
+    ZSTD_AVAILABLE = False
+
+# Optional incremental JSON parser (large JSON / NDJSON ingestion)
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except Exception:
+    IJSON_AVAILABLE = False
+
+# Optional headless-browser rendering (JavaScript-built pages)
+try:
+    from playwright.async_api import async_playwright
+    PLAYWRIGHT_AVAILABLE = True
+except Exception:
+    PLAYWRIGHT_AVAILABLE = False
+
 # LangChain / LLM imports (keep as you used)
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -68,56 +120,909 @@ MODEL_HIERARCHY = [
 
 MAX_RETRIES_PER_KEY = 2
 TIMEOUT = 30
-QUOTA_KEYWORDS = ["quota", "exceeded", "rate limit", "403", "too many requests"]
+QUOTA_KEYWORDS = ["quota", "exceeded", "rate limit", "403", "429", "resource exhausted", "resource_exhausted", "too many requests"]
+# the request itself is bad: no other key or model will accept it either
+INVALID_REQUEST_PATTERN = re.compile(r"\b400\b|invalid[ _]argument|bad request|invalid request", re.IGNORECASE)
 
 if not GEMINI_KEYS:
     raise RuntimeError("No Gemini API keys found. Please set them in your environment.")
 
+# -------------------- Shared rate-limit coordinator --------------------
+# Node-local SQLite file shared by every worker process on this machine
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB", os.path.join(tempfile.gettempdir(), "tdata_shared_state.db"))
+QUOTA_MAX_WAIT_SECONDS = int(os.getenv("QUOTA_MAX_WAIT_SECONDS", 120))
+QUOTA_DEFAULT_COOLDOWN_SECONDS = int(os.getenv("QUOTA_DEFAULT_COOLDOWN_SECONDS", 60))
+
+# (requests per minute, tokens per minute) per API key; override with GEMINI_RATE_LIMITS='{"model": [rpm, tpm]}'
+MODEL_RATE_LIMITS = {
+    "gemini-2.5-pro": (5, 250_000),
+    "gemini-2.5-flash": (10, 250_000),
+    "gemini-2.5-flash-lite": (15, 250_000),
+    "gemini-2.0-flash": (15, 1_000_000),
+    "gemini-2.0-flash-lite": (30, 1_000_000),
+}
+try:
+    MODEL_RATE_LIMITS.update({m: tuple(v) for m, v in json.loads(os.getenv("GEMINI_RATE_LIMITS", "{}")).items()})
+except Exception as e:
+    logger.warning(f"Ignoring invalid GEMINI_RATE_LIMITS: {e}")
+_DEFAULT_RATE_LIMIT = (10, 250_000)
+
+
+def _shared_db(path: str = None) -> sqlite3.Connection:
+    """Autocommit connection to the node-local shared state DB; callers manage transactions."""
+    conn = sqlite3.connect(path or SHARED_STATE_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _key_id(key: str) -> str:
+    # never persist raw API keys
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+class QuotaExhausted(RuntimeError):
+    pass
+
+
+class _SharedDBClient:
+    """Per-thread, per-process connection to the shared state DB."""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or SHARED_STATE_DB
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # connections must not cross a fork (gunicorn --preload imports this module before forking)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = self._local.conn = _shared_db(self.db_path)
+            self._local.pid = os.getpid()
+        return conn
+
+
+class QuotaCoordinator(_SharedDBClient):
+    """
+    Token buckets per (API key, model), one for requests and one for tokens, refilled at the
+    model's RPM/TPM. State lives in SQLite so all uvicorn workers on the node draw from the
+    same buckets; a quota error empties the bucket and blocks it until the retry delay passes.
+    """
+
+    def __init__(self, db_path: str = None, limits: Dict[str, tuple] = None):
+        super().__init__(db_path)
+        self.limits = limits or MODEL_RATE_LIMITS
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            " key_id TEXT, model TEXT, req_tokens REAL, tok_tokens REAL,"
+            " updated REAL, blocked_until REAL DEFAULT 0, PRIMARY KEY (key_id, model))"
+        )
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS llm_health ("
+            " key_id TEXT, model TEXT, last_ok REAL, last_error REAL, last_error_msg TEXT,"
+            " ok_count INTEGER DEFAULT 0, error_count INTEGER DEFAULT 0, PRIMARY KEY (key_id, model))"
+        )
+
+    def _state(self, conn, key_id: str, model: str, now: float):
+        rpm, tpm = self.limits.get(model, _DEFAULT_RATE_LIMIT)
+        row = conn.execute(
+            "SELECT req_tokens, tok_tokens, updated, blocked_until FROM rate_buckets WHERE key_id=? AND model=?",
+            (key_id, model),
+        ).fetchone()
+        if row is None:
+            return float(rpm), float(tpm), 0.0
+        req, tok, updated, blocked_until = row
+        elapsed = max(0.0, now - updated)
+        req = min(rpm, req + elapsed * rpm / 60.0)
+        tok = min(tpm, tok + elapsed * tpm / 60.0)
+        return req, tok, blocked_until or 0.0
+
+    def _save(self, conn, key_id: str, model: str, req: float, tok: float, now: float, blocked_until: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO rate_buckets (key_id, model, req_tokens, tok_tokens, updated, blocked_until)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key_id, model, req, tok, now, blocked_until),
+        )
+
+    def _wait_for(self, model: str, req: float, tok: float, blocked_until: float, est_tokens: int, now: float) -> float:
+        rpm, tpm = self.limits.get(model, _DEFAULT_RATE_LIMIT)
+        if blocked_until > now:
+            return blocked_until - now
+        wait_req = 0.0 if req >= 1 else (1 - req) * 60.0 / rpm
+        wait_tok = 0.0 if tok >= est_tokens else (est_tokens - tok) * 60.0 / tpm
+        return max(wait_req, wait_tok)
+
+    def try_acquire(self, keys: List[str], models: List[str], est_tokens: int):
+        """
+        Take one request slot from the first model (in hierarchy order) that has a key with capacity,
+        preferring the least-used key so concurrent callers spread across keys.
+        Returns ((model, key), 0.0) on success or (None, seconds_until_some_slot_frees).
+        """
+        conn = self._conn()
+        now = time.time()
+        min_wait = float("inf")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for model in models:
+                _, tpm = self.limits.get(model, _DEFAULT_RATE_LIMIT)
+                need = min(est_tokens, tpm)
+                best = None
+                for key in keys:
+                    kid = _key_id(key)
+                    req, tok, blocked_until = self._state(conn, kid, model, now)
+                    wait = self._wait_for(model, req, tok, blocked_until, need, now)
+                    if wait <= 0:
+                        if best is None or req > best[1]:
+                            best = (key, req, tok, blocked_until)
+                    else:
+                        min_wait = min(min_wait, wait)
+                if best is not None:
+                    key, req, tok, blocked_until = best
+                    self._save(conn, _key_id(key), model, req - 1, tok - need, now, blocked_until)
+                    conn.execute("COMMIT")
+                    return (model, key), 0.0
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return None, min_wait
+
+    def acquire(self, keys: List[str], models: List[str], est_tokens: int, max_wait: float = None):
+        """Block (queue) until a slot is free instead of firing a request that would 429."""
+        deadline = time.time() + (QUOTA_MAX_WAIT_SECONDS if max_wait is None else max_wait)
+        while True:
+            slot, wait = self.try_acquire(keys, models, est_tokens)
+            if slot is not None:
+                return slot
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise QuotaExhausted(f"No Gemini key/model has quota available (next slot in {wait:.1f}s)")
+            time.sleep(min(wait, remaining, 5.0) + 0.01)
+
+    def report_quota_error(self, key: str, model: str, retry_after: float = None) -> None:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _, tok, _ = self._state(conn, _key_id(key), model, now)
+            self._save(conn, _key_id(key), model, 0.0, tok, now, now + (retry_after or QUOTA_DEFAULT_COOLDOWN_SECONDS))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+    def record_outcome(self, key: str, model: str, ok: bool, error: str = None) -> None:
+        """Passive health: remember how real calls on (key, model) went so /summary need not ping."""
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO llm_health (key_id, model, last_ok, last_error, last_error_msg, ok_count, error_count)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(key_id, model) DO UPDATE SET"
+            "  last_ok = COALESCE(excluded.last_ok, last_ok),"
+            "  last_error = COALESCE(excluded.last_error, last_error),"
+            "  last_error_msg = COALESCE(excluded.last_error_msg, last_error_msg),"
+            "  ok_count = ok_count + excluded.ok_count,"
+            "  error_count = error_count + excluded.error_count",
+            (_key_id(key), model, now if ok else None, None if ok else now,
+             None if ok else (error or "")[:300], int(ok), int(not ok)),
+        )
+
+    def health_snapshot(self) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT key_id, model, last_ok, last_error, last_error_msg, ok_count, error_count FROM llm_health"
+        ).fetchall()
+        cols = ["key_id", "model", "last_ok", "last_error", "last_error_msg", "ok_count", "error_count"]
+        return [dict(zip(cols, row)) for row in rows]
+
+
+class MetricsRegistry(_SharedDBClient):
+    """Counters shared by all workers on the node (served by GET /metrics)."""
+
+    def __init__(self, db_path: str = None):
+        super().__init__(db_path)
+        self._conn().execute("CREATE TABLE IF NOT EXISTS metrics (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def inc(self, name: str, n: int = 1) -> None:
+        try:
+            self._conn().execute(
+                "INSERT INTO metrics (name, value) VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, n),
+            )
+        except Exception as e:
+            logger.debug(f"Could not record metric {name}: {e}")
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self._conn().execute("SELECT name, value FROM metrics ORDER BY name").fetchall())
+
+
+metrics = MetricsRegistry()
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Extract the server-suggested retry delay from a Gemini quota error, if present."""
+    m = re.search(r"retry(?:_delay| in| after)?[^0-9]{0,20}(\d+(?:\.\d+)?)\s*s", str(error), re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+
+quota_coordinator = QuotaCoordinator()
+
 # -------------------- LLM wrapper --------------------
+from langchain_core.runnables import RunnableLambda
+
+
 class LLMWithFallback:
-    def __init__(self, keys=None, models=None, temperature=0):
+    def __init__(self, keys=None, models=None, temperature=0, coordinator=None):
         self.keys = keys or GEMINI_KEYS
         self.models = models or MODEL_HIERARCHY
         self.temperature = temperature
+        self.coordinator = coordinator or quota_coordinator
         self.slow_keys_log = defaultdict(list)
         self.failing_keys_log = defaultdict(int)
-        self.current_llm = None  # placeholder for actual ChatGoogleGenerativeAI instance
-
-    def _get_llm_instance(self):
+        self.current_llm = None  # last ChatGoogleGenerativeAI instance used
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def _get_llm_instance(self, model, key, tools=None):
+        cache_key = (model, key, id(tools) if tools is not None else None)
+        with self._lock:
+            llm_instance = self._instances.get(cache_key)
+            if llm_instance is None:
+                llm_instance = ChatGoogleGenerativeAI(
+                    model=model,
+                    temperature=self.temperature,
+                    google_api_key=key
+                )
+                if tools is not None:
+                    llm_instance = llm_instance.bind_tools(tools)
+                self._instances[cache_key] = llm_instance
+        return llm_instance
+
+    def _call(self, prompt, tools=None):
+        # rough token estimate: ~4 chars per token for the prompt plus room for the answer
+        est_tokens = len(str(prompt)) // 4 + 2048
         last_error = None
-        for model in self.models:
-            for key in self.keys:
-                try:
-                    llm_instance = ChatGoogleGenerativeAI(
-                        model=model,
-                        temperature=self.temperature,
-                        google_api_key=key
-                    )
-                    self.current_llm = llm_instance
-                    return llm_instance
-                except Exception as e:
-                    last_error = e
-                    msg = str(e).lower()
-                    if any(qk in msg for qk in QUOTA_KEYWORDS):
-                        self.slow_keys_log[key].append(model)
-                    self.failing_keys_log[key] += 1
-                    time.sleep(0.5)
+        models = list(self.models)
+        for _ in range(len(self.keys) * len(self.models)):
+            if not models:
+                break
+            # queue for a slot only as long as the request has left
+            model, key = self.coordinator.acquire(self.keys, models, est_tokens,
+                                                  max_wait=deadline_budget(QUOTA_MAX_WAIT_SECONDS, "LLM call"))
+            try:
+                llm_instance = self._get_llm_instance(model, key, tools)
+                self.current_llm = llm_instance
+                # the client timeout is per call: one attempt, bounded by what the request has left
+                # (quota retries are the coordinator's job, not the client's six backed-off attempts)
+                result = llm_instance.invoke(prompt, timeout=deadline_budget(LLM_TIMEOUT_SECONDS, "LLM call"),
+                                             max_retries=1)
+                self._record(key, model, True)
+                return result
+            except Exception as e:
+                last_error = e
+                self._record(key, model, False, str(e))
+                msg = str(e).lower()
+                self.failing_keys_log[key] += 1
+                if any(qk in msg for qk in QUOTA_KEYWORDS):
+                    # only quota errors rotate keys: the coordinator hands out another key or waits
+                    self.slow_keys_log[key].append(model)
+                    self.coordinator.report_quota_error(key, model, _retry_after_seconds(e))
+                    logger.warning(f"Quota error on {model} key {_key_id(key)}; queueing on next slot")
+                    continue
+                if INVALID_REQUEST_PATTERN.search(msg):
+                    raise
+                # anything else is this model failing: fall back to the next one instead of burning slots on it
+                logger.warning(f"{model} failed ({e}); falling back to the next model")
+                models.remove(model)
         raise RuntimeError(f"All models/keys failed. Last error: {last_error}")
 
-    # Required by LangChain agent
+    def _record(self, key, model, ok, error=None):
+        try:
+            self.coordinator.record_outcome(key, model, ok, error)
+        except Exception as e:
+            logger.debug(f"Could not record LLM outcome: {e}")
+
+    # Required by LangChain agent: every agent step acquires its own slot
     def bind_tools(self, tools):
-        llm_instance = self._get_llm_instance()
-        return llm_instance.bind_tools(tools)
+        return RunnableLambda(lambda prompt: self._call(prompt, tools))
 
     # Keep .invoke interface
     def invoke(self, prompt):
-        llm_instance = self._get_llm_instance()
-        return llm_instance.invoke(prompt)
+        return self._call(prompt)
 
 
 LLM_TIMEOUT_SECONDS = int(os.getenv("LLM_TIMEOUT_SECONDS", 240))
 
 
+# -------------------- Request deadline --------------------
+# One budget per /api request (LLM_TIMEOUT_SECONDS from arrival). Every stage -- agent calls,
+# quota waits, scrapes, page rendering, the sandbox -- gets only what is left of it, and when the
+# request times out or the client goes away the deadline is cancelled: waiting stages stop at their
+# next check and registered sandbox processes are killed.
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def remaining(self) -> float:
+        if self._cancelled.is_set():
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, cap: float = None, stage: str = "request") -> float:
+        """Seconds this stage may use: what is left, at most cap. Raises DeadlineExceeded when nothing is."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            reason = "was cancelled" if self._cancelled.is_set() else f"exceeded its {self.seconds}s deadline"
+            raise DeadlineExceeded(f"Request {reason} before {stage}")
+        return remaining if cap is None else min(cap, remaining)
+
+    def on_cancel(self, callback):
+        """Run callback when the deadline is cancelled (at once if it already was); returns an unregister function."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._callbacks.remove(callback) if callback in self._callbacks else None
+        callback()
+        return lambda: None
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Deadline cancel callback failed: {e}")
+
+
+_current_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def use_deadline(deadline: Optional[Deadline]):
+    """Make deadline the current one for this thread's stages (worker threads do not inherit it)."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+def deadline_budget(cap: float, stage: str = "request") -> float:
+    """cap, or less when the current request has less time left (see Deadline.budget)."""
+    deadline = _current_deadline.get()
+    return cap if deadline is None else deadline.budget(cap, stage)
+
+
+# -------------------- Shared node-local cache --------------------
+# Worker processes (see entrypoint.sh, WEB_CONCURRENCY) share parsed datasets and scrape
+# results through this directory instead of each keeping a private copy.
+SHARED_CACHE_DIR = os.path.abspath(os.getenv("SHARED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tdata_shared_cache")))
+DATASET_CACHE_MAX_BYTES = int(os.getenv("DATASET_CACHE_MAX_MB", 1024)) * 1024 * 1024
+DATASET_CACHE_TTL_SECONDS = int(os.getenv("DATASET_CACHE_TTL_SECONDS", 6 * 3600))
+SCRAPE_CACHE_TTL_SECONDS = int(os.getenv("SCRAPE_CACHE_TTL_SECONDS", 600))
+SCRAPE_CACHE_MAX_BYTES = int(os.getenv("SCRAPE_CACHE_MAX_MB", 256)) * 1024 * 1024
+
+
+class SharedCache:
+    """
+    File-per-entry cache under SHARED_CACHE_DIR/<namespace>, safe to use from several processes:
+    writes go to a temp file and are renamed into place. An entry's mtime is its creation time
+    (TTL) and its atime, set explicitly on every hit, the last use (LRU eviction).
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: int, max_bytes: int):
+        self.root = os.path.join(SHARED_CACHE_DIR, namespace)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key: str, suffix: str = "") -> str:
+        return os.path.join(self.root, key + suffix)
+
+    def contains(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(self.root + os.sep)
+
+    def get_path(self, key: str, suffix: str = "") -> Optional[str]:
+        path = self.path(key, suffix)
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime > self.ttl_seconds:
+                os.unlink(path)
+                return None
+            os.utime(path, (time.time(), st.st_mtime))
+            return path
+        except FileNotFoundError:
+            return None
+
+    def get_bytes(self, key: str, suffix: str = "") -> Optional[bytes]:
+        path = self.get_path(key, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_file(self, key: str, src_path: str, suffix: str = "") -> str:
+        """Move an already written file into the cache and return its cached path."""
+        dest = self.path(key, suffix)
+        shutil.move(src_path, dest + f".tmp-{os.getpid()}")
+        os.replace(dest + f".tmp-{os.getpid()}", dest)
+        self.evict()
+        return dest
+
+    def put_bytes(self, key: str, data: bytes, suffix: str = "") -> str:
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return self.put_file(key, tmp_path, suffix)
+
+    def evict(self) -> None:
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if ".tmp-" in entry.name:
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.ttl_seconds:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            entries.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+dataset_cache = SharedCache("datasets", DATASET_CACHE_TTL_SECONDS, DATASET_CACHE_MAX_BYTES)
+scrape_cache = SharedCache("scrape", SCRAPE_CACHE_TTL_SECONDS, SCRAPE_CACHE_MAX_BYTES)
+
+
+# -------------------- Shared-memory hot dataset tier --------------------
+HOT_TIER_DIR = os.getenv("HOT_TIER_DIR", "/dev/shm/tdata-hot")
+HOT_TIER_ENABLED = (os.getenv("HOT_TIER_ENABLED", "1") != "0" and PYARROW_AVAILABLE
+                    and os.path.isdir(os.path.dirname(HOT_TIER_DIR)))
+HOT_TIER_MAX_BYTES = int(os.getenv("HOT_TIER_MAX_MB", 512)) * 1024 * 1024
+# a reference held longer than this is treated as leaked by a crashed worker
+HOT_TIER_LEASE_SECONDS = int(os.getenv("HOT_TIER_LEASE_SECONDS", 2 * LLM_TIMEOUT_SECONDS))
+
+
+def _arrow_table(df: pd.DataFrame):
+    """
+    df as an Arrow table, or None when Arrow can't hold it faithfully: conversion errors (mixed-type
+    object columns, images, duplicate column names) and object columns that Arrow would retype
+    (ints with None come back as floats, lists as arrays) stay on the pickle path.
+    """
+    try:
+        table = pa.Table.from_pandas(df)
+    except Exception as e:
+        logger.info(f"Dataset not Arrow-convertible, keeping it as a pickle: {e}")
+        return None
+    for field in table.schema:
+        if field.name in df.columns and df[field.name].dtype == object and not (
+                pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+                or pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type)
+                or pa.types.is_null(field.type)):
+            logger.info(f"Column {field.name!r} would not round-trip through Arrow, keeping a pickle")
+            return None
+    return table
+
+
+def _write_arrow_file(table, path: str) -> None:
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_dataset_file(path: str) -> pd.DataFrame:
+    """Load a cached dataset file: an Arrow IPC file (.arrow) or a pickle."""
+    if path.endswith(".arrow"):
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+    return pd.read_pickle(path)
+
+
+class HotDatasetTier(_SharedDBClient):
+    """
+    Recently used datasets kept resident as Arrow IPC files in named POSIX shared memory (/dev/shm).
+    Sandboxes memory-map a segment instead of reading and unpickling a file, so repeat requests
+    for a hot dataset skip deserialization. Reference counts and LRU order live in the shared
+    state DB so every worker sees the same tier; unreferenced segments are evicted oldest-first
+    to stay under HOT_TIER_MAX_BYTES (open mappings stay valid after eviction).
+    """
+
+    def __init__(self, root: str, max_bytes: int, db_path: str = None):
+        super().__init__(db_path)
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS hot_datasets ("
+            " dataset_hash TEXT PRIMARY KEY, path TEXT, size INTEGER, refcount INTEGER, last_used REAL)"
+        )
+
+    def _write_segment(self, df: pd.DataFrame = None, source_path: str = None) -> Optional[str]:
+        """Temp segment file from df, or a plain copy of an Arrow IPC file (no conversion)."""
+        table = None
+        if source_path is None:
+            table = _arrow_table(df)
+            if table is None:
+                return None
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".arrow", dir=self.root)
+        os.close(fd)
+        try:
+            if table is not None:
+                _write_arrow_file(table, tmp_path)
+            else:
+                shutil.copyfile(source_path, tmp_path)
+        except Exception as e:
+            logger.warning(f"Could not write hot tier segment: {e}")
+            os.unlink(tmp_path)
+            return None
+        if os.path.getsize(tmp_path) > self.max_bytes:
+            os.unlink(tmp_path)
+            return None
+        return tmp_path
+
+    def _evict(self, conn, needed: int) -> bool:
+        now = time.time()
+        used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM hot_datasets").fetchone()[0]
+        victims = conn.execute(
+            "SELECT dataset_hash, path, size FROM hot_datasets"
+            " WHERE refcount <= 0 OR last_used < ? ORDER BY last_used",
+            (now - HOT_TIER_LEASE_SECONDS,),
+        ).fetchall()
+        for dataset_hash, path, size in victims:
+            if used + needed <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM hot_datasets WHERE dataset_hash=?", (dataset_hash,))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+        return used + needed <= self.max_bytes
+
+    def acquire(self, dataset_hash: str, df: pd.DataFrame = None, pickle_path: str = None) -> Optional[str]:
+        """
+        Take a reference on the dataset's segment, creating it if needed: a cached .arrow file is
+        copied as is, otherwise df (or the loaded pickle_path) is converted. Returns the segment
+        path, or None when the dataset can't be held in the tier.
+        Every non-None return must be paired with release().
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT path FROM hot_datasets WHERE dataset_hash=?", (dataset_hash,)).fetchone()
+            if row and os.path.exists(row[0]):
+                conn.execute("UPDATE hot_datasets SET refcount = refcount + 1, last_used = ? WHERE dataset_hash=?",
+                             (time.time(), dataset_hash))
+                conn.execute("COMMIT")
+                return row[0]
+            if row:
+                conn.execute("DELETE FROM hot_datasets WHERE dataset_hash=?", (dataset_hash,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        # convert outside the lock; another worker may promote the same dataset meanwhile
+        if pickle_path and pickle_path.endswith(".arrow"):
+            tmp_path = self._write_segment(source_path=pickle_path)
+        else:
+            if df is None:
+                if not pickle_path:
+                    return None
+                df = pd.read_pickle(pickle_path)
+            tmp_path = self._write_segment(df)
+        if tmp_path is None:
+            return None
+        size = os.path.getsize(tmp_path)
+        path = os.path.join(self.root, dataset_hash[:32] + ".arrow")
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT path FROM hot_datasets WHERE dataset_hash=?", (dataset_hash,)).fetchone()
+            if row:
+                os.unlink(tmp_path)
+                conn.execute("UPDATE hot_datasets SET refcount = refcount + 1, last_used = ? WHERE dataset_hash=?",
+                             (time.time(), dataset_hash))
+                conn.execute("COMMIT")
+                return row[0]
+            if not self._evict(conn, size):
+                os.unlink(tmp_path)
+                conn.execute("COMMIT")
+                return None
+            os.replace(tmp_path, path)
+            conn.execute("INSERT INTO hot_datasets (dataset_hash, path, size, refcount, last_used) VALUES (?, ?, ?, 1, ?)",
+                         (dataset_hash, path, size, time.time()))
+            conn.execute("COMMIT")
+            return path
+        except Exception:
+            conn.execute("ROLLBACK")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def release(self, dataset_hash: str) -> None:
+        self._conn().execute(
+            "UPDATE hot_datasets SET refcount = MAX(refcount - 1, 0), last_used = ? WHERE dataset_hash=?",
+            (time.time(), dataset_hash),
+        )
+
+
+hot_tier = HotDatasetTier(HOT_TIER_DIR, HOT_TIER_MAX_BYTES) if HOT_TIER_ENABLED else None
+
+
+# -------------------- Approximate-answer samples --------------------
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", 200_000))
+# smaller datasets are answered exactly even when approximate mode is requested
+APPROX_MIN_ROWS = int(os.getenv("APPROX_MIN_ROWS", 1_000_000))
+APPROX_MAX_STRATA = int(os.getenv("APPROX_MAX_STRATA", 50))
+APPROX_MIN_PER_STRATUM = int(os.getenv("APPROX_MIN_PER_STRATUM", 50))
+APPROX_CONFIDENCE = float(os.getenv("APPROX_CONFIDENCE", 0.95))
+APPROX_STRATUM_COLUMN = "__stratum__"
+
+
+def _reservoir_indices(n_items: int, k: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Uniform sample of k positions out of range(n_items) via reservoir sampling (Algorithm L):
+    one pass, O(k) memory and O(k log(n/k)) random draws, so it also works on row streams.
+    """
+    if n_items <= k:
+        return np.arange(n_items)
+    reservoir = np.arange(k)
+    w = math.exp(math.log(1.0 - rng.random()) / k)
+    i = k - 1
+    while True:
+        i += int(math.log(1.0 - rng.random()) / math.log(1.0 - w)) + 1 if w < 1.0 else 1
+        if i >= n_items:
+            break
+        reservoir[rng.integers(k)] = i
+        w *= math.exp(math.log(1.0 - rng.random()) / k)
+    return np.sort(reservoir)
+
+
+def _choose_strata_column(df: pd.DataFrame) -> Optional[str]:
+    """The categorical column with the most (but at most APPROX_MAX_STRATA) distinct values, if any."""
+    best, best_n = None, 1
+    probe = df.head(100_000)
+    for col in df.columns:
+        if col == APPROX_STRATUM_COLUMN:
+            continue
+        s = df[col]
+        if not (s.dtype == object or isinstance(s.dtype, (pd.CategoricalDtype, pd.StringDtype)) or s.dtype == bool):
+            continue
+        try:
+            if probe[col].nunique(dropna=False) > APPROX_MAX_STRATA:
+                continue
+            n = s.nunique(dropna=False)
+        except TypeError:  # unhashable cells (lists, dicts, images)
+            continue
+        if best_n < n <= APPROX_MAX_STRATA:
+            best, best_n = col, n
+    return best
+
+
+def build_approx_sample(df: pd.DataFrame, seed: int = 0):
+    """
+    Stratified sample of about APPROX_SAMPLE_ROWS rows: proportional allocation over the strata
+    of _choose_strata_column (each stratum gets at least APPROX_MIN_PER_STRATUM rows, so small
+    groups still get usable estimates), drawn within each stratum by reservoir sampling. Without
+    a usable categorical column this is a plain reservoir sample (one stratum).
+    Returns (sample, meta); sample keeps the original row labels plus an APPROX_STRATUM_COLUMN
+    with each row's stratum, and meta holds the population/sample size of every stratum.
+    """
+    rng = np.random.default_rng(seed)
+    n_total = len(df)
+    strata_col = _choose_strata_column(df)
+    if strata_col is None:
+        codes = np.zeros(n_total, dtype=np.int64)
+        labels = ["all"]
+    else:
+        codes, uniques = pd.factorize(df[strata_col], use_na_sentinel=False)
+        labels = [str(u) for u in uniques]
+    groups = pd.Series(np.arange(n_total)).groupby(codes).indices
+
+    picks, strata = [], {}
+    for code, positions in sorted(groups.items()):
+        pop = len(positions)
+        want = max(round(APPROX_SAMPLE_ROWS * pop / n_total), APPROX_MIN_PER_STRATUM)
+        chosen = positions[_reservoir_indices(pop, min(want, pop), rng)]
+        picks.append(chosen)
+        strata[str(int(code))] = {"label": labels[int(code)], "population": pop, "sample": len(chosen)}
+    picks = np.sort(np.concatenate(picks))
+
+    sample = df.iloc[picks].copy()
+    sample[APPROX_STRATUM_COLUMN] = np.asarray(codes)[picks].astype(np.int64)
+    if not sample.index.is_unique:
+        sample = sample.reset_index(drop=True)
+    meta = {
+        "population_rows": n_total,
+        "sample_rows": len(sample),
+        "strata_column": strata_col,
+        "method": "stratified" if strata_col is not None else "reservoir",
+        "confidence": APPROX_CONFIDENCE,
+        "strata": strata,
+    }
+    return sample, meta
+
+
+def approx_sample_for(dataset_hash: str, df: pd.DataFrame = None, pickle_path: str = None):
+    """
+    Cached sample of a dataset for approximate mode: returns (sample_hash, sample_pickle_path, meta),
+    or None when the dataset is small enough to answer exactly. The sample is built once per
+    dataset and shared across requests and workers through the dataset cache.
+    """
+    sample_hash = f"{dataset_hash}-approx"
+    cached_meta = dataset_cache.get_bytes(sample_hash, ".meta.json")
+    cached_path = _cached_dataset_path(sample_hash)
+    if cached_meta is not None:
+        meta = json.loads(cached_meta.decode("utf-8"))
+        if meta.get("exact"):
+            return None
+        if cached_path:
+            return sample_hash, cached_path, meta
+
+    if df is None:
+        df = _read_dataset_file(pickle_path)
+    if len(df) < APPROX_MIN_ROWS:
+        dataset_cache.put_bytes(sample_hash, json.dumps({"exact": True}).encode("utf-8"), ".meta.json")
+        return None
+    sample, meta = build_approx_sample(df, seed=int(dataset_hash[:8], 16))
+    path, _ = _store_dataset(sample_hash, sample)
+    dataset_cache.put_bytes(sample_hash, json.dumps(meta).encode("utf-8"), ".meta.json")
+    return sample_hash, path, meta
+
+
+def approx_rules(meta: Dict[str, Any]) -> str:
+    return (
+        f"Approximate mode: `df` is a {meta['method']} random sample of {meta['sample_rows']} of the "
+        f"dataset's {meta['population_rows']} rows, so answers are estimates.\n"
+        "   - For population means, totals, row counts and shares use approx_mean(series), approx_sum(series),\n"
+        "     approx_count(mask=None) and approx_proportion(mask, within=None). They return the estimate (store it\n"
+        "     in results as is) and record its confidence interval. Pass Series / boolean masks taken from df\n"
+        "     (e.g. df.loc[df['region'] == 'EU', 'sales']) so the row labels are kept.\n"
+        "   - Never report len(df), .count() or .sum() of the sample as a population count or total.\n"
+        "   - Medians, quantiles, min/max, correlations, rankings and plots can be computed on df directly.\n"
+    )
+
+
+# Sandbox side of approximate mode, run right after df is loaded. Estimators are the usual
+# stratified ones: totals are sum_h N_h * mean_h with variance sum_h N_h^2 (1 - n_h/N_h) s_h^2 / n_h
+# (rows outside a filter count as zeros in their stratum), means and shares are ratio estimators
+# with a linearized variance. Each call records an interval; _result_extras() attaches the
+# intervals to the results they were returned for.
+_APPROX_HELPERS = r'''
+import math
+_approx_strata = df.pop(_APPROX["stratum_column"])
+_approx_intervals = []
+
+def _approx_series(values, name):
+    if not isinstance(values, pd.Series):
+        raise TypeError(f"{name}() needs a pandas Series or boolean mask taken from df")
+    return values
+
+def _approx_total(values):
+    v = pd.to_numeric(values, errors="coerce").astype(float).fillna(0.0)
+    h = _approx_strata.reindex(v.index)
+    if h.isna().any():
+        raise ValueError("approx helpers need values that keep df's row labels (no reset_index or aggregated series)")
+    y = v.to_numpy()
+    sums = pd.DataFrame({"h": h.to_numpy(), "y": y, "y2": y * y}).groupby("h")[["y", "y2"]].sum()
+    total = var = 0.0
+    for code, st in _APPROX["strata"].items():
+        N, n = st["population"], st["sample"]
+        s = float(sums["y"].get(int(code), 0.0))
+        ss = float(sums["y2"].get(int(code), 0.0))
+        mean = s / n
+        total += N * mean
+        if 1 < n < N:
+            var += N * N * (1 - n / N) * (max(ss - n * mean * mean, 0.0) / (n - 1)) / n
+    return total, var
+
+def _approx_record(kind, estimate, variance):
+    se = math.sqrt(max(variance, 0.0))
+    _approx_intervals.append({"kind": kind, "estimate": float(estimate), "std_error": se,
+                              "low": float(estimate - _APPROX["z"] * se),
+                              "high": float(estimate + _APPROX["z"] * se)})
+    return float(estimate)
+
+def _approx_ratio(values, kind):
+    v = pd.to_numeric(values, errors="coerce").dropna()
+    y, _ = _approx_total(v)
+    x, _ = _approx_total(pd.Series(1.0, index=v.index))
+    if x <= 0:
+        return _approx_record(kind, float("nan"), 0.0)
+    r = y / x
+    _, var = _approx_total((v - r) / x)
+    return _approx_record(kind, r, var)
+
+def approx_sum(values):
+    """Estimated population total of a (possibly filtered) numeric column of df."""
+    return _approx_record("sum", *_approx_total(_approx_series(values, "approx_sum")))
+
+def approx_mean(values):
+    """Estimated population mean of a (possibly filtered) numeric column of df."""
+    return _approx_ratio(_approx_series(values, "approx_mean"), "mean")
+
+def approx_count(mask=None):
+    """Estimated number of population rows where mask is True (the exact row count without a mask)."""
+    if mask is None:
+        return _approx_record("count", _APPROX["population_rows"], 0.0)
+    mask = _approx_series(mask, "approx_count").fillna(False).astype(bool)
+    return _approx_record("count", *_approx_total(mask.astype(float)))
+
+def approx_proportion(mask, within=None):
+    """Estimated share of population rows (of those where `within` is True) where mask is True."""
+    m = _approx_series(mask, "approx_proportion").fillna(False).astype(bool).astype(float)
+    if within is not None:
+        m = m[_approx_series(within, "approx_proportion").reindex(m.index, fill_value=False).fillna(False).astype(bool)]
+    return _approx_ratio(m, "proportion")
+
+def _approx_matches(value, estimate):
+    if isinstance(value, bool) or not isinstance(value, (int, float, np.integer, np.floating)):
+        return False
+    value = float(value)
+    if math.isnan(value) or math.isnan(estimate):
+        return False
+    if math.isclose(value, estimate, rel_tol=1e-9, abs_tol=1e-12):
+        return True
+    # the generated code may round or truncate the estimate before storing it
+    return value in (math.floor(estimate), math.ceil(estimate)) or any(value == round(estimate, d) for d in range(1, 7))
+
+def _result_extras(results):
+    intervals, used = {}, set()
+    for q, v in results.items():
+        for i, iv in enumerate(_approx_intervals):
+            if i not in used and _approx_matches(v, iv["estimate"]):
+                intervals[q] = iv
+                used.add(i)
+                break
+    meta = {k: _APPROX[k] for k in ("population_rows", "sample_rows", "method", "strata_column", "confidence")}
+    meta["intervals"] = intervals
+    meta["unmatched_intervals"] = [iv for i, iv in enumerate(_approx_intervals) if i not in used]
+    return {"approx": meta}
+'''
+
+
+def _approx_sandbox_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
+    from statistics import NormalDist
+    z = NormalDist().inv_cdf(0.5 + meta.get("confidence", APPROX_CONFIDENCE) / 2)
+    return {**meta, "z": z, "stratum_column": APPROX_STRATUM_COLUMN}
+
+
 @app.get("/", response_class=HTMLResponse)
 async def serve_frontend():
     """Serve the main HTML interface"""
@@ -150,6 +1055,197 @@ def parse_keys_and_types(raw_questions: str):
     return keys_list, type_map
 
 
+# -----------------------------
+# Headless-browser rendering backend
+# -----------------------------
+# "off": static HTML only; "auto": render when the static HTML has no table; "always": render every HTML page
+SCRAPE_RENDER_BACKEND = os.getenv("SCRAPE_RENDER_BACKEND", "auto").lower()
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", 4))
+RENDER_TIMEOUT_SECONDS = int(os.getenv("RENDER_TIMEOUT_SECONDS", 30))
+# contexts are recycled after this many pages to bound browser memory
+RENDER_CONTEXT_MAX_USES = int(os.getenv("RENDER_CONTEXT_MAX_USES", 50))
+RENDER_BLOCKED_RESOURCES = frozenset(
+    t.strip() for t in os.getenv("RENDER_BLOCKED_RESOURCES", "image,font,media").split(",") if t.strip()
+)
+RENDER_CACHE_TTL_SECONDS = int(os.getenv("RENDER_CACHE_TTL_SECONDS", 600))
+render_cache = SharedCache("rendered", RENDER_CACHE_TTL_SECONDS, int(os.getenv("RENDER_CACHE_MAX_MB", 128)) * 1024 * 1024)
+SCRAPE_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/138.0.0.0 Safari/537.36"
+)
+
+
+class BrowserPool:
+    """
+    One headless Chromium per worker process with a pool of up to `size` browser contexts that are
+    reused across requests (cookies cleared between pages). Rendering runs on a private event loop
+    in a daemon thread, so synchronous callers such as the scrape tool can use it from any thread;
+    the pool size is also the cap on concurrently rendered pages. Images, fonts and media are
+    never downloaded.
+    """
+
+    def __init__(self, size: int, timeout: int):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._playwright = None
+        self._browser = None
+        self._sem = None
+        self._launch_lock = None
+        self._idle = []   # [context, uses]
+        self._open = 0
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                # a forked worker inherits neither the thread nor the browser; start afresh
+                self._pid = os.getpid()
+                self._loop = asyncio.new_event_loop()
+                self._playwright = self._browser = None
+                self._idle, self._open = [], 0
+                self._sem = None
+                threading.Thread(target=self._loop.run_forever, name="browser-pool", daemon=True).start()
+            return self._loop
+
+    async def _ensure_browser(self):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.size)
+            self._launch_lock = asyncio.Lock()
+        async with self._launch_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return self._browser
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            # (re)launch; contexts of a crashed browser are gone with it
+            self._browser = await self._playwright.chromium.launch(headless=True, args=["--no-sandbox"])
+            self._idle, self._open = [], 0
+            return self._browser
+
+    @staticmethod
+    async def _route(route):
+        if route.request.resource_type in RENDER_BLOCKED_RESOURCES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def _checkout(self):
+        browser = await self._ensure_browser()
+        if self._idle:
+            return self._idle.pop()
+        context = await browser.new_context(user_agent=SCRAPE_USER_AGENT)
+        await context.route("**/*", self._route)
+        self._open += 1
+        return [context, 0]
+
+    async def _checkin(self, entry, healthy: bool):
+        entry[1] += 1
+        if healthy and entry[1] < RENDER_CONTEXT_MAX_USES and self._browser is not None and self._browser.is_connected():
+            try:
+                await entry[0].clear_cookies()
+                self._idle.append(entry)
+                return
+            except Exception:
+                pass
+        self._open = max(0, self._open - 1)
+        try:
+            await entry[0].close()
+        except Exception:
+            pass
+
+    async def _render(self, url: str, timeout: float) -> str:
+        await self._ensure_browser()
+        async with self._sem:
+            entry = await self._checkout()
+            healthy = True
+            page = await entry[0].new_page()
+            try:
+                await page.goto(url, wait_until="networkidle", timeout=timeout * 1000)
+                try:
+                    await page.wait_for_selector("table", timeout=2000)
+                except Exception:
+                    pass  # not every page has a table; render what is there
+                return await page.content()
+            except Exception:
+                healthy = False
+                raise
+            finally:
+                try:
+                    await page.close()
+                except Exception:
+                    healthy = False
+                await self._checkin(entry, healthy)
+
+    def render(self, url: str, timeout: float = None) -> str:
+        """Rendered DOM (HTML after scripts ran) of url. Blocks the calling thread; raises on failure."""
+        timeout = self.timeout if timeout is None else timeout
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._render(url, timeout), loop)
+        try:
+            # the grace period for browser start-up must not outlive the request either
+            return future.result(timeout=min(timeout + 10, deadline_budget(timeout + 10, f"rendering {url}")))
+        except Exception:
+            future.cancel()
+            raise
+
+    async def _close(self):
+        for context, _ in self._idle:
+            try:
+                await context.close()
+            except Exception:
+                pass
+        self._idle, self._open = [], 0
+        if self._browser is not None:
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._browser = self._playwright = None
+
+    def close(self) -> None:
+        with self._lock:
+            loop = self._loop if self._pid == os.getpid() else None
+            self._loop = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), loop).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"Browser pool shutdown failed: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": self.size, "open_contexts": self._open, "idle_contexts": len(self._idle),
+                "browser_connected": bool(self._browser is not None and self._browser.is_connected())}
+
+
+browser_pool = BrowserPool(RENDER_POOL_SIZE, RENDER_TIMEOUT_SECONDS) \
+    if PLAYWRIGHT_AVAILABLE and SCRAPE_RENDER_BACKEND != "off" else None
+
+
+def render_page(url: str) -> Optional[str]:
+    """Rendered HTML of url from the shared render cache or the browser pool; None when unavailable or failed."""
+    if browser_pool is None:
+        return None
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    cached = render_cache.get_bytes(key, ".html")
+    if cached is not None:
+        metrics.inc("render.cache_hits")
+        return cached.decode("utf-8", errors="replace")
+    timeout = deadline_budget(RENDER_TIMEOUT_SECONDS, f"rendering {url}")
+    try:
+        html = browser_pool.render(url, timeout)
+    except Exception as e:
+        metrics.inc("render.errors")
+        logger.warning(f"Rendering {url} failed: {e}")
+        return None
+    metrics.inc("render.pages")
+    try:
+        render_cache.put_bytes(key, html.encode("utf-8"), ".html")
+    except Exception as e:
+        logger.warning(f"Could not cache rendered {url}: {e}")
+    return html
 
 
 # -----------------------------
@@ -163,20 +1259,26 @@ def scrape_url_to_dataframe(url: str) -> Dict[str, Any]:
     Always returns {"status": "success", "data": [...], "columns": [...]} if fetch works.
     """
     print(f"Scraping URL: {url}")
+    # the render backend decides what a page yields, so a static-only result is not reused once rendering is on
+    url_key = hashlib.sha256(f"{SCRAPE_RENDER_BACKEND}\0{url}".encode("utf-8")).hexdigest()
+    cached = scrape_cache.get_bytes(url_key, ".pkl")
+    if cached is not None:
+        try:
+            # pickled, not JSON: a hit returns the same Timestamps, Decimals and numpy scalars as a miss
+            return pickle.loads(cached)
+        except Exception:
+            pass
     try:
         from io import BytesIO, StringIO
         from bs4 import BeautifulSoup
 
         headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/138.0.0.0 Safari/537.36"
-            ),
+            "User-Agent": SCRAPE_USER_AGENT,
             "Referer": "https://www.google.com/",
         }
 
-        resp = requests.get(url, headers=headers, timeout=20)
+        # streamed so JSON bodies can be parsed as they arrive; other types read resp.content as before
+        resp = requests.get(url, headers=headers, timeout=deadline_budget(20, f"fetching {url}"), stream=True)
         resp.raise_for_status()
         ctype = resp.headers.get("Content-Type", "").lower()
 
@@ -194,17 +1296,24 @@ def scrape_url_to_dataframe(url: str) -> Dict[str, Any]:
         elif url.lower().endswith(".parquet"):
             df = pd.read_parquet(BytesIO(resp.content))
 
-        # --- JSON ---
-        elif "application/json" in ctype or url.lower().endswith(".json"):
-            try:
-                data = resp.json()
-                df = pd.json_normalize(data)
-            except Exception:
-                df = pd.DataFrame([{"text": resp.text}])
+        # --- JSON / NDJSON ---
+        elif "json" in ctype or url.lower().split("?")[0].endswith((".json",) + _NDJSON_SUFFIXES):
+            resp.raw.decode_content = True
+            ndjson = "ndjson" in ctype or "jsonl" in ctype or url.lower().split("?")[0].endswith(_NDJSON_SUFFIXES)
+            records, document, ndjson = _json_records(resp.raw, ndjson=True if ndjson else None)
+            if records is not None:
+                df = records_to_dataframe(records)
+            else:
+                try:
+                    df = pd.json_normalize(_json_document(document, ndjson))
+                except Exception:
+                    df = pd.DataFrame([{"text": document.decode(resp.encoding or "utf-8", errors="replace")}])
 
         # --- HTML / Fallback ---
         elif "text/html" in ctype or re.search(r'/wiki/|\.org|\.com', url, re.IGNORECASE):
             html_content = resp.text
+            if SCRAPE_RENDER_BACKEND == "always":
+                html_content = render_page(url) or html_content
             # Try HTML tables first
             try:
                 tables = pd.read_html(StringIO(html_content), flavor="bs4")
@@ -213,6 +1322,18 @@ def scrape_url_to_dataframe(url: str) -> Dict[str, Any]:
             except ValueError:
                 pass
 
+            # Tables built by JavaScript only exist in the rendered DOM
+            if df is None and SCRAPE_RENDER_BACKEND == "auto":
+                rendered = render_page(url)
+                if rendered:
+                    html_content = rendered
+                    try:
+                        tables = pd.read_html(StringIO(html_content), flavor="bs4")
+                        if tables:
+                            df = tables[0]
+                    except ValueError:
+                        pass
+
             # If no table found, fallback to plain text
             if df is None:
                 soup = BeautifulSoup(html_content, "html.parser")
@@ -226,11 +1347,16 @@ def scrape_url_to_dataframe(url: str) -> Dict[str, Any]:
         # --- Normalize columns ---
         df.columns = df.columns.map(str).str.replace(r'\[.*\]', '', regex=True).str.strip()
 
-        return {
+        result = {
             "status": "success",
             "data": df.to_dict(orient="records"),
             "columns": df.columns.tolist()
         }
+        try:
+            scrape_cache.put_bytes(url_key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), ".pkl")
+        except Exception as e:
+            logger.warning(f"Could not cache scrape of {url}: {e}")
+        return result
 
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -270,6 +1396,568 @@ def clean_llm_output(output: str) -> Dict:
     except Exception as e:
         return {"error": str(e)}
 
+# -----------------------------
+# Static performance linter for generated code
+# -----------------------------
+PERF_LINT_ENABLED = os.getenv("PERF_LINT_ENABLED", "1") != "0"
+PERF_LINT_FEEDBACK = os.getenv("PERF_LINT_FEEDBACK", "1") != "0"
+
+_PERF_ADVICE = {
+    "iterrows": "avoid DataFrame.iterrows(); use vectorized column operations, groupby/agg or merge instead",
+    "apply_axis1": "avoid row-wise .apply(..., axis=1); use vectorized column arithmetic, np.where or np.select",
+    "concat_in_loop": "pd.concat inside a loop is quadratic; collect the pieces in a list and call pd.concat once after the loop",
+    "scrape_in_loop": "scrape_url_to_dataframe inside a loop fetches pages repeatedly; fetch each URL once, outside any loop",
+}
+_VECTOR_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_VECTOR_CMPOPS = (ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq)
+# concat keywords that give the same result whether the pieces are concatenated one by one or at once
+_CONCAT_BATCHABLE_KEYWORDS = {"ignore_index"}
+
+# Runtime guard of the row-wise rewrites, defined in every sandbox. A row of iterrows()/apply(axis=1)
+# has the common dtype of all columns, so the column-wise form only matches when every column has
+# the same numeric numpy dtype (an int column of a mixed frame is read as float: 3 vs 3.0). Integer
+# // and % by zero differ between numpy scalars and pandas columns, so they need float columns, and
+# an empty frame keeps the original loop (apply returns a frame there; += would change acc's type).
+_PERF_LINT_HELPERS = r'''
+def _rows_vectorizable(frame, kinds="iuf"):
+    if not isinstance(frame, pd.DataFrame) or not len(frame) or not len(frame.columns):
+        return False
+    dtypes = set(frame.dtypes)
+    dtype = dtypes.pop()
+    return not dtypes and isinstance(dtype, np.dtype) and dtype.kind in kinds
+'''
+
+
+def _has_call(node: ast.AST) -> bool:
+    return any(isinstance(n, ast.Call) for n in ast.walk(node))
+
+
+def _vectorize_row_expr(expr: ast.expr, row_name: str, frame: ast.expr) -> Optional[ast.expr]:
+    """
+    Rewrite an arithmetic/comparison expression over one row (row["c"], row.c, numeric constants)
+    into the same expression over whole columns (frame["c"]). Returns None when the expression
+    uses anything else (free variables, calls, boolean operators), i.e. when the rewrite is not
+    provably equivalent.
+    """
+    uses = 0
+
+    def conv(node):
+        nonlocal uses
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == row_name:
+            if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                uses += 1
+                return ast.Subscript(value=copy.deepcopy(frame), slice=ast.Constant(node.slice.value), ctx=ast.Load())
+            return None
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == row_name:
+            if hasattr(pd.Series, node.attr):  # row.name, row.values, ... are not columns
+                return None
+            uses += 1
+            return ast.Subscript(value=copy.deepcopy(frame), slice=ast.Constant(node.attr), ctx=ast.Load())
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return ast.Constant(node.value)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, _VECTOR_BINOPS):
+            left, right = conv(node.left), conv(node.right)
+            return None if left is None or right is None else ast.BinOp(left=left, op=node.op, right=right)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = conv(node.operand)
+            return None if operand is None else ast.UnaryOp(op=node.op, operand=operand)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], _VECTOR_CMPOPS):
+            left, right = conv(node.left), conv(node.comparators[0])
+            return None if left is None or right is None else ast.Compare(left=left, ops=node.ops, comparators=[right])
+        return None
+
+    out = conv(expr)
+    return out if out is not None and uses else None
+
+
+def _rows_guard(frame: ast.expr, expr: ast.expr) -> ast.expr:
+    """_rows_vectorizable(frame[, "f"]) for a rewrite of expr (see _PERF_LINT_HELPERS)."""
+    args = [copy.deepcopy(frame)]
+    if any(isinstance(n, ast.BinOp) and isinstance(n.op, (ast.FloorDiv, ast.Mod)) for n in ast.walk(expr)):
+        args.append(ast.Constant("f"))
+    return ast.Call(func=ast.Name("_rows_vectorizable", ast.Load()), args=args, keywords=[])
+
+
+def _is_pd_concat(call: ast.AST) -> bool:
+    return (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "concat"
+            and isinstance(call.func.value, ast.Name) and call.func.value.id in ("pd", "pandas"))
+
+
+def _is_apply_axis1(call: ast.Call) -> bool:
+    if not (isinstance(call.func, ast.Attribute) and call.func.attr == "apply"):
+        return False
+    return any(kw.arg == "axis" and isinstance(kw.value, ast.Constant) and kw.value.value in (1, "columns")
+               for kw in call.keywords)
+
+
+class _PerfLinter(ast.NodeTransformer):
+    """Finds performance anti-patterns and rewrites the cases that are provably safe."""
+
+    def __init__(self, tree: ast.AST):
+        self.findings: List[Dict[str, Any]] = []
+        self._by_node: Dict[int, Dict[str, Any]] = {}
+        self.loop_depth = 0
+        self.name_counts = defaultdict(int)
+        for n in ast.walk(tree):
+            if isinstance(n, ast.Name):
+                self.name_counts[n.id] += 1
+        # names read somewhere without an enclosing for/comprehension/lambda/def rebinding them
+        self.free_loads = set()
+        self._collect_free_loads(tree, frozenset())
+
+    def _collect_free_loads(self, node: ast.AST, bound: frozenset) -> None:
+        if isinstance(node, (ast.For, ast.AsyncFor)):
+            bound = bound | {n.id for n in ast.walk(node.target) if isinstance(n, ast.Name)}
+        elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            bound = bound | {n.id for g in node.generators for n in ast.walk(g.target) if isinstance(n, ast.Name)}
+        elif isinstance(node, (ast.Lambda, ast.FunctionDef, ast.AsyncFunctionDef)):
+            a = node.args
+            bound = bound | {x.arg for x in a.posonlyargs + a.args + a.kwonlyargs + [a.vararg, a.kwarg] if x}
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound:
+            self.free_loads.add(node.id)
+        for child in ast.iter_child_nodes(node):
+            self._collect_free_loads(child, bound)
+
+    def _record(self, pattern: str, node: ast.AST, fixed: bool = False) -> Dict[str, Any]:
+        finding = {"pattern": pattern, "line": getattr(node, "lineno", None), "fixed": fixed}
+        self.findings.append(finding)
+        self._by_node[id(node)] = finding
+        return finding
+
+    def _names_in(self, node: ast.AST) -> Dict[str, int]:
+        counts = defaultdict(int)
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name):
+                counts[n.id] += 1
+        return counts
+
+    # -- loops --------------------------------------------------------------
+    def _visit_loop(self, node):
+        self.loop_depth += 1
+        self.generic_visit(node)
+        self.loop_depth -= 1
+        return self._fix_concat_in_loop(node)
+
+    def visit_For(self, node):
+        fixed = self._fix_iterrows_loop(node)
+        if fixed is not None:
+            return fixed
+        return self._visit_loop(node)
+
+    visit_AsyncFor = visit_For
+
+    def visit_While(self, node):
+        return self._visit_loop(node)
+
+    def _visit_comprehension(self, node):
+        self.loop_depth += 1
+        self.generic_visit(node)
+        self.loop_depth -= 1
+        return node
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def _fix_iterrows_loop(self, node: ast.For):
+        """for _, row in frame.iterrows(): acc += <expr(row)>  /  lst.append(<expr(row)>)"""
+        it = node.iter
+        if not (isinstance(it, ast.Call) and isinstance(it.func, ast.Attribute) and it.func.attr == "iterrows"
+                and not it.args and not it.keywords and not _has_call(it.func.value)):
+            return None
+        if not (isinstance(node.target, ast.Tuple) and len(node.target.elts) == 2
+                and all(isinstance(e, ast.Name) for e in node.target.elts)):
+            return None
+        if node.orelse or len(node.body) != 1:
+            return None
+        idx_name, row_name = node.target.elts[0].id, node.target.elts[1].id
+        in_loop = self._names_in(node)
+        # loop variables must not be read outside a scope that rebinds them (e.g. after the loop),
+        # and the index must not be used at all
+        if row_name in self.free_loads or idx_name in self.free_loads or in_loop[idx_name] != 1:
+            return None
+        frame = it.func.value
+        stmt = node.body[0]
+        new_stmt = None
+        if isinstance(stmt, ast.AugAssign) and isinstance(stmt.op, (ast.Add, ast.Sub)) \
+                and row_name not in self._names_in(stmt.target):
+            row_expr = stmt.value
+            vec = _vectorize_row_expr(row_expr, row_name, frame)
+            if vec is not None:
+                total = ast.Call(func=ast.Attribute(value=vec, attr="sum", ctx=ast.Load()), args=[],
+                                 keywords=[ast.keyword(arg="skipna", value=ast.Constant(False))])
+                new_stmt = ast.AugAssign(target=stmt.target, op=stmt.op, value=total)
+        elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) \
+                and isinstance(stmt.value.func, ast.Attribute) and stmt.value.func.attr == "append" \
+                and isinstance(stmt.value.func.value, ast.Name) and stmt.value.func.value.id != row_name \
+                and len(stmt.value.args) == 1 and not stmt.value.keywords:
+            row_expr = stmt.value.args[0]
+            vec = _vectorize_row_expr(row_expr, row_name, frame)
+            if vec is not None:
+                # extending from the array keeps numpy scalars, like the row values appended by the loop
+                values = ast.Call(func=ast.Attribute(value=vec, attr="to_numpy", ctx=ast.Load()), args=[], keywords=[])
+                new_stmt = ast.Expr(value=ast.Call(
+                    func=ast.Attribute(value=stmt.value.func.value, attr="extend", ctx=ast.Load()),
+                    args=[values], keywords=[]))
+        if new_stmt is None:
+            return None
+        self._record("iterrows", it, fixed=True)
+        # the original loop stays as the fallback for frames whose rows don't keep the column dtypes
+        return ast.copy_location(ast.If(test=_rows_guard(frame, row_expr), body=[new_stmt], orelse=[node]), node)
+
+    def _fix_concat_in_loop(self, node):
+        """
+        acc = pd.concat([acc, x, ...]) in a loop body -> append to a list, concat once afterwards.
+        Only without keywords other than _CONCAT_BATCHABLE_KEYWORDS (keys=, axis=, ... label or align
+        every step), and acc is left untouched when the loop doesn't run (it may be None).
+        """
+        if node.orelse:
+            return node
+        in_loop = self._names_in(node)
+        for i, stmt in enumerate(node.body):
+            if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                    and _is_pd_concat(stmt.value) and len(stmt.value.args) == 1
+                    and isinstance(stmt.value.args[0], ast.List) and len(stmt.value.args[0].elts) >= 2
+                    and all(kw.arg in _CONCAT_BATCHABLE_KEYWORDS for kw in stmt.value.keywords)):
+                continue
+            acc = stmt.targets[0].id
+            first, *rest = stmt.value.args[0].elts
+            if not (isinstance(first, ast.Name) and first.id == acc) or in_loop[acc] != 2:
+                continue
+            parts = f"_{acc}_parts"
+            if self.name_counts[parts]:
+                continue
+            node.body[i] = ast.copy_location(ast.Expr(value=ast.Call(
+                func=ast.Attribute(value=ast.Name(parts, ast.Load()), attr="extend", ctx=ast.Load()),
+                args=[ast.List(elts=rest, ctx=ast.Load())], keywords=[])), stmt)
+            before = ast.copy_location(ast.Assign(targets=[ast.Name(parts, ast.Store())],
+                                                  value=ast.List(elts=[ast.Name(acc, ast.Load())], ctx=ast.Load())), node)
+            concat = ast.Call(func=stmt.value.func, args=[ast.Name(parts, ast.Load())], keywords=stmt.value.keywords)
+            ran = ast.Compare(left=ast.Call(func=ast.Name("len", ast.Load()), args=[ast.Name(parts, ast.Load())],
+                                            keywords=[]), ops=[ast.Gt()], comparators=[ast.Constant(1)])
+            after = ast.copy_location(ast.Assign(targets=[ast.Name(acc, ast.Store())], value=ast.IfExp(
+                test=ran, body=concat, orelse=ast.Name(acc, ast.Load()))), node)
+            finding = self._by_node.get(id(stmt.value))
+            if finding is not None:
+                finding["fixed"] = True
+            return [before, node, after]
+        return node
+
+    # -- calls --------------------------------------------------------------
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr == "iterrows":
+            self._record("iterrows", node)
+        elif _is_apply_axis1(node):
+            lam = node.args[0] if node.args else None
+            if isinstance(lam, ast.Lambda) and len(lam.args.args) == 1 and not _has_call(func.value):
+                vec = _vectorize_row_expr(lam.body, lam.args.args[0].arg, func.value)
+                if vec is not None and len(node.args) == 1 and len(node.keywords) == 1:
+                    self._record("apply_axis1", node, fixed=True)
+                    # apply's result is unnamed; fall back to the apply itself unless rows keep the dtypes
+                    vec = ast.Call(func=ast.Attribute(value=vec, attr="rename", ctx=ast.Load()),
+                                   args=[ast.Constant(None)], keywords=[])
+                    return ast.copy_location(ast.IfExp(test=_rows_guard(func.value, lam.body), body=vec,
+                                                       orelse=node), node)
+            self._record("apply_axis1", node)
+        elif self.loop_depth and _is_pd_concat(node):
+            self._record("concat_in_loop", node)
+        elif self.loop_depth and isinstance(func, ast.Name) and func.id == "scrape_url_to_dataframe":
+            self._record("scrape_in_loop", node)
+        return node
+
+
+def lint_generated_code(code: str):
+    """
+    Returns (code, findings). code is rewritten (vectorized) only when at least one finding was
+    fixed; each finding is {"pattern", "line", "fixed"} with line numbers of the original code.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, []
+    linter = _PerfLinter(tree)
+    tree = ast.fix_missing_locations(linter.visit(tree))
+    if any(f["fixed"] for f in linter.findings):
+        code = ast.unparse(tree)
+    return code, linter.findings
+
+
+def _lint_plan(parsed: Dict[str, Any]):
+    """Lint "code", or "setup" and every cell of a parallel plan. Returns (parsed, findings with "where")."""
+    findings = []
+    parsed = dict(parsed)
+    if isinstance(parsed.get("code"), str):
+        parsed["code"], found = lint_generated_code(parsed["code"])
+        findings += [{**f, "where": "code"} for f in found]
+    if isinstance(parsed.get("setup"), str):
+        parsed["setup"], found = lint_generated_code(parsed["setup"])
+        findings += [{**f, "where": "setup"} for f in found]
+    if isinstance(parsed.get("cells"), list):
+        cells = []
+        for i, cell in enumerate(parsed["cells"]):
+            if isinstance(cell, dict) and isinstance(cell.get("code"), str):
+                cell = dict(cell)
+                cell["code"], found = lint_generated_code(cell["code"])
+                findings += [{**f, "where": f"cell {i}"} for f in found]
+            cells.append(cell)
+        parsed["cells"] = cells
+    for f in findings:
+        metrics.inc(f"perf_lint.{f['pattern']}.found")
+        if f["fixed"]:
+            metrics.inc(f"perf_lint.{f['pattern']}.fixed")
+    return parsed, findings
+
+
+def _perf_feedback(parsed: Dict[str, Any], findings: List[Dict[str, Any]]) -> str:
+    lines = ["Your previous answer was:", json.dumps({k: parsed[k] for k in ("code", "setup", "cells") if k in parsed}),
+             "It contains performance problems that will be too slow on large datasets:"]
+    for f in findings:
+        lines.append(f"- {f['where']}, line {f['line']}: {_PERF_ADVICE[f['pattern']]}")
+    lines.append("Return the corrected JSON object (same keys) only.")
+    return "\n".join(lines)
+
+
+# -----------------------------
+# Column projection / predicate pushdown for dataset loading
+# -----------------------------
+PROJECTION_ENABLED = os.getenv("PROJECTION_ENABLED", "1") != "0"
+# datasets with at least this many cells also get a parquet copy at ingestion
+PARQUET_COPY_MIN_CELLS = int(os.getenv("PARQUET_COPY_MIN_CELLS", 5_000_000))
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", 128 * 1024))
+
+# frame methods that keep every column they don't name; their string arguments are column names
+_PROJECTION_PASSTHROUGH = {"sort_values", "head", "tail", "nlargest", "nsmallest", "reset_index",
+                           "copy", "groupby", "set_index", "fillna", "astype", "round"}
+# only safe when they are told which columns to look at (otherwise they read every column)
+_PROJECTION_NEED_SUBSET = {"dropna", "drop_duplicates"}
+_PUSHDOWN_OPS = {ast.Eq: "==", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+_SWAPPED_OPS = {"==": "==", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+class _Unsure(Exception):
+    pass
+
+
+class _DfUsage:
+    """Columns of `df` read by generated code and the row filters every use of `df` starts with."""
+
+    def __init__(self, tree: ast.AST, columns: List[str]):
+        self.columns = set(columns)
+        self.used = set()
+        self.parents = {}
+        for node in ast.walk(tree):
+            for child in ast.iter_child_nodes(node):
+                self.parents[child] = node
+        self.tree = tree
+
+    def _str_list(self, node: ast.AST) -> Optional[List[str]]:
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [node.value]
+        if isinstance(node, (ast.List, ast.Tuple)) and all(
+                isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts):
+            return [e.value for e in node.elts]
+        return None
+
+    def _use(self, names) -> None:
+        self.used.update(n for n in names if n in self.columns)
+
+    def _column_of(self, node: ast.AST) -> Optional[str]:
+        """Column name if node is df["c"] / df.c."""
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "df":
+            cols = self._str_list(node.slice)
+            return cols[0] if cols and len(cols) == 1 and isinstance(node.slice, ast.Constant) else None
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "df" \
+                and node.attr in self.columns:
+            return node.attr
+        return None
+
+    def _predicates(self, mask: ast.AST) -> Optional[List[tuple]]:
+        """
+        The conjuncts (column, op, value) of a boolean mask, or None unless every conjunct is an
+        elementwise column-vs-literal comparison: anything else (df["s"] > df["s"].mean(), ...)
+        may depend on rows the pushed-down filter would drop.
+        """
+        if isinstance(mask, ast.BinOp) and isinstance(mask.op, ast.BitAnd):
+            left, right = self._predicates(mask.left), self._predicates(mask.right)
+            return None if left is None or right is None else left + right
+        if isinstance(mask, ast.Compare) and len(mask.ops) == 1 and type(mask.ops[0]) in _PUSHDOWN_OPS:
+            op = _PUSHDOWN_OPS[type(mask.ops[0])]
+            left, right = mask.left, mask.comparators[0]
+            for col_node, val_node, o in ((left, right, op), (right, left, _SWAPPED_OPS[op])):
+                col = self._column_of(col_node)
+                if col and isinstance(val_node, ast.Constant) and isinstance(val_node.value, (int, float, str, bool)):
+                    return [(col, o, val_node.value)]
+        if isinstance(mask, ast.Call) and isinstance(mask.func, ast.Attribute) and mask.func.attr == "isin" \
+                and len(mask.args) == 1 and isinstance(mask.args[0], (ast.List, ast.Tuple, ast.Set)):
+            col = self._column_of(mask.func.value)
+            values = mask.args[0].elts
+            if col and values and all(isinstance(v, ast.Constant) and isinstance(v.value, (int, float, str, bool))
+                                      for v in values):
+                return [(col, "in", tuple(v.value for v in values))]
+        return None
+
+    def _query(self, expr: str) -> Optional[List[tuple]]:
+        """Columns and predicates of a DataFrame.query() string (None unless every conjunct is pushable)."""
+        quoted = re.findall(r"`([^`]+)`", expr)
+        self._use(quoted)
+        expr = re.sub(r"`[^`]+`", lambda m: f"__q{quoted.index(m.group(0)[1:-1])}", expr).replace("@", "")
+        try:
+            tree = ast.parse(expr, mode="eval").body
+        except SyntaxError:
+            raise _Unsure()
+        names = {n.id: quoted[int(n.id[3:])] if n.id.startswith("__q") else n.id
+                 for n in ast.walk(tree) if isinstance(n, ast.Name)}
+        self._use(names.values())
+        conjuncts = tree.values if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And) else [tree]
+        preds = []
+        for c in conjuncts:
+            if isinstance(c, ast.Compare) and len(c.ops) == 1 and type(c.ops[0]) in _PUSHDOWN_OPS:
+                op = _PUSHDOWN_OPS[type(c.ops[0])]
+                for col_node, val_node, o in ((c.left, c.comparators[0], op), (c.comparators[0], c.left, _SWAPPED_OPS[op])):
+                    col = names.get(col_node.id) if isinstance(col_node, ast.Name) else None
+                    if col in self.columns and isinstance(val_node, ast.Constant) \
+                            and isinstance(val_node.value, (int, float, str, bool)):
+                        preds.append((col, o, val_node.value))
+                        break
+                else:
+                    return None
+            else:
+                return None
+        return preds
+
+    def _lead_filter(self, mask: ast.AST, filtering: bool, leading: set, mask_refs: set) -> bool:
+        """
+        Add a row filter of the chain to its leading predicates when it can be pushed down; the df
+        references inside a pushed mask only read the compared columns. Returns whether later
+        filters of the chain may still be pushed (not after one that can't: it must see every row).
+        """
+        preds = self._predicates(mask) if filtering else None
+        if preds is None:
+            return False
+        leading.update(preds)
+        mask_refs.update(n for n in ast.walk(mask) if isinstance(n, ast.Name) and n.id == "df")
+        return True
+
+    def _chain(self, name: ast.Name):
+        """
+        Follow one `df` reference outwards until a column projection ends it. Returns the set of
+        leading filter predicates (None if the chain does not start with a row filter) and the df
+        references inside those filters' masks. Raises _Unsure if the chain may read every column.
+        """
+        node, leading, mask_refs, filtering = name, set(), set(), True
+        while True:
+            parent = self.parents.get(node)
+            if isinstance(parent, ast.Subscript) and parent.value is node:
+                cols = self._str_list(parent.slice)
+                if cols is not None:
+                    self._use(cols)
+                    return (leading if leading else None), mask_refs
+                if isinstance(parent.slice, ast.Slice):
+                    raise _Unsure()
+                # row filter: df[mask]
+                filtering = self._lead_filter(parent.slice, filtering, leading, mask_refs)
+                node = parent
+                continue
+            if isinstance(parent, ast.Attribute) and parent.value is node:
+                call = self.parents.get(parent)
+                is_call = isinstance(call, ast.Call) and call.func is parent
+                if parent.attr in self.columns and not is_call:
+                    self._use([parent.attr])
+                    return (leading if leading else None), mask_refs
+                if parent.attr == "loc":
+                    sub = self.parents.get(parent)
+                    if not (isinstance(sub, ast.Subscript) and sub.value is parent):
+                        raise _Unsure()
+                    rows, cols = (sub.slice.elts if isinstance(sub.slice, ast.Tuple) and len(sub.slice.elts) == 2
+                                  else (sub.slice, None))
+                    if isinstance(rows, ast.Slice) and not (rows.lower or rows.upper or rows.step):
+                        rows = None  # df.loc[:, cols]
+                    elif isinstance(rows, ast.Slice) or self._str_list(rows) is not None:
+                        raise _Unsure()  # label-based row selection
+                    if rows is not None:
+                        filtering = self._lead_filter(rows, filtering, leading, mask_refs)
+                    if cols is not None:
+                        names = self._str_list(cols)
+                        if names is None:
+                            raise _Unsure()
+                        self._use(names)
+                        return (leading if leading else None), mask_refs
+                    node = sub
+                    continue
+                if not is_call:
+                    raise _Unsure()
+                args = list(call.args) + [k.value for k in call.keywords]
+                if parent.attr == "query":
+                    if not (call.args and isinstance(call.args[0], ast.Constant) and isinstance(call.args[0].value, str)):
+                        raise _Unsure()
+                    preds = self._query(call.args[0].value)
+                    if filtering and preds is not None:
+                        leading.update(preds)
+                    else:
+                        filtering = False
+                elif parent.attr in _PROJECTION_PASSTHROUGH or (
+                        parent.attr in _PROJECTION_NEED_SUBSET and any(k.arg == "subset" for k in call.keywords)):
+                    filtering = False
+                    # any string in the arguments may name a column: astype({"y": float}), by=["a", "b"], ...
+                    self._use(n.value for a in args for n in ast.walk(a)
+                              if isinstance(n, ast.Constant) and isinstance(n.value, str))
+                else:
+                    raise _Unsure()
+                node = call
+                continue
+            if isinstance(parent, ast.Assign) and parent.value is node and node is not name \
+                    and all(isinstance(t, ast.Name) and t.id == "df" for t in parent.targets):
+                # df = df[mask] / df.sort_values(...): the new df has the same columns and its own
+                # uses are followed like any other reference
+                return None, mask_refs
+            if isinstance(parent, ast.Call) and isinstance(parent.func, ast.Name) and parent.func.id == "len" \
+                    and parent.args == [node] and node is name:
+                return None, mask_refs  # len(df) needs rows, not columns
+            raise _Unsure()
+
+    def analyze(self) -> Optional[Dict[str, Any]]:
+        refs = [n for n in ast.walk(self.tree) if isinstance(n, ast.Name) and n.id in ("df", "data")]
+        if any(n.id == "data" for n in refs):
+            return None  # `data` is every column of every row
+        rebound = any(isinstance(n.ctx, (ast.Store, ast.Del)) for n in refs)
+        try:
+            chains = {id(n): self._chain(n) for n in refs if isinstance(n.ctx, ast.Load)}
+        except _Unsure:
+            return None
+        exempt = set()
+        for _, mask_refs in chains.values():
+            exempt.update(id(n) for n in mask_refs)
+        filters = None
+        for ref_id, (leading, _) in chains.items():
+            if ref_id in exempt:
+                continue
+            filters = set(leading or ()) if filters is None else filters & set(leading or ())
+        if rebound or not filters:
+            filters = set()
+        return {"columns": sorted(self.used),
+                "filters": sorted(([c, op, list(v) if isinstance(v, tuple) else v] for c, op, v in filters), key=str)}
+
+
+def analyze_df_usage(code: str, columns: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Which of the dataset's columns the code reads (through df["c"], df[["a", "b"]], df.c, df.loc[..., cols],
+    df.query("...") and the string arguments of column-preserving methods) and which simple filters
+    (column <op> constant, column.isin([...])) every use of df starts with, so the loader can read only
+    those columns and rows. Returns None whenever df might be used in any other way, i.e. when a full
+    load is needed, or when nothing would be saved.
+    """
+    if not columns:
+        return None
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    usage = _DfUsage(tree, columns).analyze()
+    if usage is None or (len(usage["columns"]) >= len(set(columns)) and not usage["filters"]):
+        return None
+    return usage
+
+
 SCRAPE_FUNC = r'''
 from typing import Dict, Any
 import requests
@@ -329,38 +2017,196 @@ def scrape_url_to_dataframe(url: str) -> Dict[str, Any]:
 '''
 
 
-def write_and_run_temp_python(code: str, injected_pickle: str = None, timeout: int = 60) -> Dict[str, Any]:
-    """
-    Write a temp python file which:
-      - provides a safe environment (imports)
-      - loads df/from pickle if provided into df and data variables
-      - defines a robust plot_to_base64() helper that ensures < 100kB (attempts resizing/conversion)
-      - executes the user code (which should populate `results` dict)
-      - prints json.dumps({"status":"success","result":results})
-    Returns dict with parsed JSON or error details.
+# -----------------------------
+# Execution result cache
+# -----------------------------
+EXEC_CACHE_ENABLED = os.getenv("EXEC_CACHE_ENABLED", "1") != "0"
+EXEC_CACHE_DIR = os.getenv("EXEC_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tdata_exec_cache"))
+EXEC_CACHE_TTL_SECONDS = int(os.getenv("EXEC_CACHE_TTL_SECONDS", 3600))
+EXEC_CACHE_MAX_BYTES = int(os.getenv("EXEC_CACHE_MAX_MB", 256)) * 1024 * 1024
+
+# Code matching any of these depends on randomness, the clock or live network data,
+# so re-running it may legitimately give a different answer.
+_NONDETERMINISTIC_PATTERNS = [
+    r"\bimport\s+random\b", r"\brandom\.", r"np\.random", r"numpy\.random", r"default_rng",
+    r"\bsecrets\b", r"\buuid\b", r"os\.urandom",
+    r"\btime\.(?:time|perf_counter|monotonic|process_time)\b",
+    r"datetime\.(?:now|today|utcnow)\b", r"date\.today\b",
+    r"Timestamp\.(?:now|today)\b", r"Timestamp\(\s*['\"](?:now|today)['\"]",
+    r"\.sample\((?![^)]*random_state)", r"\bshuffle\(",
+    r"\brequests\.", r"\burlopen\(", r"\bhttpx\.",
+    r"read_(?:html|csv|json|excel|parquet)\(\s*['\"]https?://",
+]
+
+_IMAGE_B64_PREFIXES = ("data:image/", "iVBORw0KGgo", "/9j/", "UklGR", "R0lGOD")
+
+
+def _file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _normalize_code(code: str) -> str:
+    """Strip comments/formatting so cosmetic differences map to the same cache key."""
+    try:
+        return ast.unparse(ast.parse(code))
+    except Exception:
+        return "\n".join(line.strip() for line in code.strip().splitlines() if line.strip())
+
+
+def is_cacheable_code(code: str, source_hashes: Optional[Dict[str, str]] = None) -> bool:
+    """False if the code uses randomness, the clock, or scrapes a URL we have not hashed."""
+    if any(re.search(p, code) for p in _NONDETERMINISTIC_PATTERNS):
+        return False
+    covered = source_hashes or {}
+    urls = re.findall(r"scrape_url_to_dataframe\(\s*['\"](.*?)['\"]\s*\)", code)
+    if "scrape_url_to_dataframe(" in code and (not urls or any(u not in covered for u in urls)):
+        return False
+    return True
+
+
+def _sandbox_fingerprint() -> str:
     """
-    # create file content
-    preamble = [
-        "import json, sys, gc",
-        "import pandas as pd, numpy as np",
-        "import matplotlib",
-        "matplotlib.use('Agg')",
-        "import matplotlib.pyplot as plt",
-        "from io import BytesIO",
-        "import base64",
-    ]
-    if PIL_AVAILABLE:
-        preamble.append("from PIL import Image")
-    # inject df if a pickle path provided
-    if injected_pickle:
-        preamble.append(f"df = pd.read_pickle(r'''{injected_pickle}''')\n")
-        preamble.append("data = df.to_dict(orient='records')\n")
-    else:
-        # ensure data exists so user code that references data won't break
-        preamble.append("data = globals().get('data', {})\n")
+    Hash of what decides a run's answers besides the code and its inputs: the sandbox prelude as
+    rendered with the current configuration (helpers, plot patches, thresholds), the cell runner
+    and the projection switch. The cache outlives deploys; a new prelude or config misses it.
+    """
+    h = hashlib.sha256()
+    for part in _sandbox_prelude("<dataset>") + [_CELL_RUNNER, f"projection={PROJECTION_ENABLED}"]:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
 
-    # plot_to_base64 helper that tries to reduce size under 100_000 bytes
-    helper = r'''
+def execution_cache_key(code: str, dataset_hash: Optional[str] = None,
+                        source_hashes: Optional[Dict[str, str]] = None) -> str:
+    h = hashlib.sha256()
+    h.update(_sandbox_fingerprint().encode("ascii") + b"\0")
+    h.update(_normalize_code(code).encode("utf-8"))
+    h.update(b"\0dataset:" + (dataset_hash or "").encode("ascii"))
+    for url, digest in sorted((source_hashes or {}).items()):
+        h.update(f"\0source:{url}={digest}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _looks_like_image(value) -> bool:
+    return isinstance(value, str) and len(value) >= 256 and value.startswith(_IMAGE_B64_PREFIXES)
+
+
+class ExecutionResultCache:
+    """
+    On-disk cache of sandbox `results` dicts.
+    Each entry is a directory holding result.json plus one file per image blob, so
+    large base64 plots are not re-parsed as part of the JSON document.
+    result.json's mtime is the creation time (TTL), the directory's mtime the last hit (LRU).
+    """
+
+    def __init__(self, root: str, ttl_seconds: int, max_bytes: int):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entry_dir(key)
+        meta_path = os.path.join(entry, "result.json")
+        try:
+            if time.time() - os.path.getmtime(meta_path) > self.ttl_seconds:
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            with open(meta_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+
+            def rehydrate(value):
+                if isinstance(value, dict):
+                    if set(value) == {"__blob__"}:
+                        with open(os.path.join(entry, value["__blob__"]), "r", encoding="ascii") as bf:
+                            return bf.read()
+                    return {k: rehydrate(v) for k, v in value.items()}
+                if isinstance(value, list):
+                    return [rehydrate(v) for v in value]
+                return value
+
+            result = rehydrate(stored)
+            os.utime(entry)
+            return result
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Execution cache read failed for {key}: {e}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+    def put(self, key: str, results: Dict[str, Any]) -> None:
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        blobs = []
+
+        def extract(value):
+            if _looks_like_image(value):
+                name = f"img_{len(blobs)}.b64"
+                blobs.append((name, value))
+                return {"__blob__": name}
+            if isinstance(value, dict):
+                return {k: extract(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [extract(v) for v in value]
+            return value
+
+        try:
+            stored = extract(results)
+            for name, blob in blobs:
+                with open(os.path.join(tmp_dir, name), "w", encoding="ascii") as bf:
+                    bf.write(blob)
+            with open(os.path.join(tmp_dir, "result.json"), "w", encoding="utf-8") as f:
+                json.dump(stored, f, default=str)
+            try:
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError:
+                # another request cached the same key first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception as e:
+            logger.warning(f"Execution cache write failed for {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """Drop expired entries, then least-recently-used ones until under the size budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry = self._entry_dir(name)
+            if name.startswith(".tmp-") or not os.path.isdir(entry):
+                continue
+            try:
+                created = os.path.getmtime(os.path.join(entry, "result.json"))
+                if now - created > self.ttl_seconds:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                size = sum(e.stat().st_size for e in os.scandir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total += size
+            except FileNotFoundError:
+                continue
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+_exec_cache = ExecutionResultCache(EXEC_CACHE_DIR, EXEC_CACHE_TTL_SECONDS, EXEC_CACHE_MAX_BYTES) if EXEC_CACHE_ENABLED else None
+
+
+# plot_to_base64 helper that tries to reduce size under 100_000 bytes
+_PLOT_HELPER = r'''
 def plot_to_base64(max_bytes=100000):
     buf = BytesIO()
     plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
@@ -405,25 +2251,599 @@ def plot_to_base64(max_bytes=100000):
     return base64.b64encode(buf.getvalue()).decode('ascii')
 '''
 
-    # Build the code to write
-    script_lines = []
-    script_lines.extend(preamble)
-    script_lines.append(helper)
-    script_lines.append(SCRAPE_FUNC)
-    script_lines.append("\nresults = {}\n")
-    script_lines.append(code)
-    # ensure results printed as json
-    script_lines.append("\nprint(json.dumps({'status':'success','result':results}, default=str), flush=True)\n")
 
+# Loads df for the sandbox: the hot-tier Arrow segment (memory-mapped; with a projection only
+# the selected columns are touched), else the parquet copy (column pruning + row-group filters),
+# else the cached dataset file (Arrow IPC, mapped the same way, or a pickle). Any failure of a
+# projected load falls through to the next source and finally to the full file, so a wrong guess
+# costs time but never correctness.
+#
+# Arrow files are mapped copy-on-write (mmap.ACCESS_COPY): numeric, datetime and timedelta columns
+# without nulls become numpy views of the mapped pages, so they are not copied, stay writable, and
+# writes by the generated code land in private pages (the shared segment never changes). Columns
+# that are still copied on conversion: strings/objects, bools (bit-packed in Arrow), columns with
+# nulls, categorical/extension/tz-aware dtypes, and every column of a row-filtered load (the filter
+# materialises the selected rows). Row-filtered loads keep the original row labels, as filtering
+# the pickled frame does.
+_DATASET_LOADER = r'''
+import operator as _operator
+_FILTER_OPS = {"==": _operator.eq, "<": _operator.lt, "<=": _operator.le, ">": _operator.gt, ">=": _operator.ge}
+
+def _arrow_filter(filters):
+    import pyarrow.compute as _pc
+    expr = None
+    for col, op, val in filters:
+        e = _pc.field(col).isin(val) if op == "in" else _FILTER_OPS[op](_pc.field(col), val)
+        expr = e if expr is None else expr & e
+    return expr
+
+def _filtered_frame(table, filters, rows=None):
+    # Arrow renumbers a RangeIndex when rows are dropped; keep the labels of the selected rows
+    # (rows: position of every table row in the whole dataset) like filtering the frame would
+    index = [c for c in (table.schema.pandas_metadata or {}).get("index_columns", [])]
+    if not (len(index) == 1 and isinstance(index[0], dict) and index[0].get("kind") == "range"):
+        return table.filter(_arrow_filter(filters)).to_pandas()
+    import pyarrow as _pa
+    rows = np.arange(table.num_rows) if rows is None else rows
+    table = table.append_column("__row__", _pa.array(rows)).filter(_arrow_filter(filters))
+    frame = table.drop_columns(["__row__"]).to_pandas()
+    frame.index = pd.Index(index[0]["start"] + index[0]["step"] * table.column("__row__").to_numpy(),
+                           name=index[0]["name"])
+    return frame
+
+def _parquet_frame(path, projection):
+    # only the row groups whose statistics can match the filters are read
+    import pyarrow.dataset as _ds
+    import pyarrow.parquet as _pq
+    keep = set(projection["columns"])
+    pf = _pq.ParquetFile(path)
+    columns = [c for c in pf.schema_arrow.names if c in keep or c.startswith("__index_level_")]
+    if not projection["filters"]:
+        return pf.read(columns=columns).to_pandas()
+    fragment = next(iter(_ds.dataset(path, format="parquet").get_fragments()))
+    groups = [g.row_groups[0].id for g in fragment.split_by_row_group(filter=_arrow_filter(projection["filters"]))]
+    sizes = [pf.metadata.row_group(i).num_rows for i in range(pf.metadata.num_row_groups)]
+    starts = np.cumsum([0] + sizes)
+    rows = np.concatenate([np.arange(starts[g], starts[g] + sizes[g]) for g in groups] or [np.arange(0)])
+    return _filtered_frame(pf.read_row_groups(groups, columns=columns), projection["filters"], rows)
+
+def _mapped_column(mm, base, column, dtype):
+    # numpy view of a column's data buffer inside the mapping, or None when it can't be one
+    if column.num_chunks != 1 or column.null_count:
+        return None
+    chunk = column.chunk(0)
+    try:
+        if chunk.to_numpy(zero_copy_only=True).dtype != dtype:
+            return None
+    except Exception:
+        return None
+    offset = chunk.buffers()[1].address - base + chunk.offset * dtype.itemsize
+    if offset < 0 or offset + len(chunk) * dtype.itemsize > len(mm):
+        return None  # not in the mapping (e.g. rows materialised by a filter)
+    return np.frombuffer(mm, dtype=dtype, count=len(chunk), offset=offset)
+
+def _arrow_frame(path, projection):
+    import mmap as _mmap
+    import pyarrow as _pa
+    with open(path, "rb") as f:
+        mm = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY)
+    buf = _pa.py_buffer(mm)
+    table = _pa.ipc.open_file(buf).read_all()
+    if projection:
+        keep = set(projection["columns"])
+        table = table.select([c for c in table.column_names if c in keep or c.startswith("__index_level_")])
+        if projection["filters"]:
+            return _filtered_frame(table, projection["filters"])
+    index_fields = [c for c in (table.schema.pandas_metadata or {}).get("index_columns", []) if isinstance(c, str)]
+    fields = [c for c in table.column_names if c not in index_fields]
+    empty = table.slice(0, 0).to_pandas()  # labels and dtypes pandas restores, in field order
+    if len(empty.columns) != len(fields):
+        return table.to_pandas()
+    views = {}
+    for field, dtype in zip(fields, empty.dtypes):
+        if isinstance(dtype, np.dtype) and dtype.kind in "iufmM":
+            view = _mapped_column(mm, buf.address, table.column(field), dtype)
+            if view is not None:
+                views[field] = view
+    if not views:
+        return table.to_pandas()
+    rest = table.drop_columns(list(views)).to_pandas()
+    columns = {i: views[field] if field in views else rest[label]
+               for i, (field, label) in enumerate(zip(fields, empty.columns))}
+    frame = pd.DataFrame(columns, index=rest.index, copy=False)
+    frame.columns = empty.columns
+    return frame
+
+def _load_dataset(hot, parquet, pickle, projection):
+    keep = set(projection["columns"]) if projection else None
+    filters = projection["filters"] if projection else []
+    if hot:
+        try:
+            return _arrow_frame(hot, projection)
+        except Exception:
+            pass
+    if parquet and projection:
+        try:
+            return _parquet_frame(parquet, projection)
+        except Exception:
+            pass
+    if not pickle:
+        return None
+    if pickle.endswith(".arrow"):
+        if projection:
+            try:
+                return _arrow_frame(pickle, projection)
+            except Exception:
+                pass
+        return _arrow_frame(pickle, None)
+    frame = pd.read_pickle(pickle)
+    if projection:
+        try:
+            for col, op, val in filters:
+                frame = frame[frame[col].isin(val) if op == "in" else _FILTER_OPS[op](frame[col], val)]
+            frame = frame[[c for c in frame.columns if c in keep]]
+        except Exception:
+            frame = pd.read_pickle(pickle)
+    return frame
+'''
+
+
+# -----------------------------
+# Plot downsampling in the sandbox
+# -----------------------------
+# opt-in: patched plot/scatter/hist draw (nearly) the same image from fewer points, not the same artists
+PLOT_AUTO_DOWNSAMPLE = os.getenv("PLOT_AUTO_DOWNSAMPLE", "0") == "1"
+# series shorter than this are always drawn as given
+PLOT_DOWNSAMPLE_MIN_POINTS = int(os.getenv("PLOT_DOWNSAMPLE_MIN_POINTS", 20000))
+LARGE_PLOT_RULES = (
+    "   Large series may be plotted directly: plot/scatter/hist reduce them to the figure's resolution.\n"
+    if PLOT_AUTO_DOWNSAMPLE else
+    f"   Plot lines of more than {PLOT_DOWNSAMPLE_MIN_POINTS} points as plt.plot(*lttb_downsample(x, y)) and\n"
+    "   histograms of that many values with fast_hist(values, bins).\n"
+) + "   For a density view of a huge scatter use density_scatter(x, y).\n"
+
+# Reduce plotted data to what the figure can show: LTTB (largest-triangle-three-buckets) keeps
+# the visually significant points of a line at ~2 points per horizontal pixel, scatter keeps the
+# topmost point of every occupied pixel, and histograms are binned with np.histogram before
+# matplotlib draws one weighted sample per bin (same bars, same return values).
+_PLOT_DOWNSAMPLE_HELPERS = r'''
+_DOWNSAMPLE_MIN_POINTS = _DOWNSAMPLE_MIN_POINTS_VALUE
+
+def _axes_pixels(ax):
+    try:
+        w, h = ax.bbox.width, ax.bbox.height
+    except Exception:
+        w, h = plt.gcf().get_size_inches() * plt.gcf().dpi
+    return max(int(w), 100), max(int(h), 100)
+
+def _as_float(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[ns]").astype("int64").astype(float)
+    if np.issubdtype(values.dtype, np.timedelta64):
+        return values.astype("timedelta64[ns]").astype("int64").astype(float)
+    if np.issubdtype(values.dtype, np.number) or values.dtype == bool:
+        return values.astype(float)
+    return None
+
+def lttb_indices(x, y, n_out):
+    """Indices of the n_out points LTTB keeps from the line (x, y); x must be sorted ascending."""
+    xf, yf = _as_float(x), _as_float(y)
+    n = len(yf)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        nlo, nhi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        nhi = max(nhi, nlo + 1)
+        avg_x, avg_y = xf[nlo:nhi].mean(), yf[nlo:nhi].mean()
+        area = np.abs((xf[a] - avg_x) * (yf[lo:hi] - yf[a]) - (xf[a] - xf[lo:hi]) * (avg_y - yf[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def lttb_downsample(x, y, n_out=None, ax=None):
+    """(x, y) reduced with LTTB to n_out points (default: 2 per horizontal pixel of ax)."""
+    x, y = np.asarray(x), np.asarray(y)
+    if n_out is None:
+        n_out = 2 * _axes_pixels(ax if ax is not None else plt.gca())[0]
+    idx = lttb_indices(x, y, n_out)
+    return x[idx], y[idx]
+
+def _line_downsampleable(x, y):
+    if len(y) < _DOWNSAMPLE_MIN_POINTS or np.ndim(x) != 1 or np.ndim(y) != 1 or len(x) != len(y):
+        return False
+    xf, yf = _as_float(x), _as_float(y)
+    if xf is None or yf is None or not (np.isfinite(xf).all() and np.isfinite(yf).all()):
+        return False  # NaN gaps and categorical axes are drawn as given
+    return bool(np.all(np.diff(xf) >= 0))
+
+def _pixel_representatives(ax, x, y):
+    """
+    Index of the last (topmost drawn) point in every occupied pixel of ax, in drawing order, plus
+    the points with the smallest and largest x and y, so autoscaling sets the same limits.
+    """
+    xf, yf = _as_float(x), _as_float(y)
+    w, h = _axes_pixels(ax)
+    finite = np.isfinite(xf) & np.isfinite(yf)
+    if not finite.any():
+        return np.arange(len(xf))
+    x0, x1 = xf[finite].min(), xf[finite].max()
+    y0, y1 = yf[finite].min(), yf[finite].max()
+    cx = np.clip(((xf - x0) / ((x1 - x0) or 1.0) * (w - 1)), 0, w - 1)
+    cy = np.clip(((yf - y0) / ((y1 - y0) or 1.0) * (h - 1)), 0, h - 1)
+    cell = np.where(finite, np.nan_to_num(cx).astype(np.int64) * h + np.nan_to_num(cy).astype(np.int64), -1)
+    _, last_from_end = np.unique(cell[::-1], return_index=True)
+    keep = len(cell) - 1 - last_from_end
+    positions = np.flatnonzero(finite)
+    extremes = positions[[np.argmin(xf[finite]), np.argmax(xf[finite]), np.argmin(yf[finite]), np.argmax(yf[finite])]]
+    keep = np.union1d(keep, extremes)
+    return keep[cell[keep] >= 0]
+
+def density_scatter(x, y, ax=None, bins=None, cmap="viridis", log=True, colorbar=True, **kwargs):
+    """Binned density view of a very large scatter: one cell per ~2 pixels, colored by point count."""
+    ax = ax if ax is not None else plt.gca()
+    xf, yf = _as_float(x), _as_float(y)
+    finite = np.isfinite(xf) & np.isfinite(yf)
+    if bins is None:
+        w, h = _axes_pixels(ax)
+        bins = (max(w // 2, 10), max(h // 2, 10))
+    counts, xe, ye = np.histogram2d(xf[finite], yf[finite], bins=bins)
+    counts = np.ma.masked_equal(counts, 0)
+    from matplotlib.colors import LogNorm
+    mesh = ax.pcolormesh(xe, ye, counts.T, cmap=cmap, norm=LogNorm() if log else None, **kwargs)
+    if colorbar:
+        ax.figure.colorbar(mesh, ax=ax, label="points")
+    return mesh
+
+def fast_hist(x, bins=10, ax=None, range=None, weights=None, **kwargs):
+    """Histogram of a very large array, aggregated with np.histogram before matplotlib draws it."""
+    ax = ax if ax is not None else plt.gca()
+    values = np.asarray(x, dtype=float)
+    finite = np.isfinite(values)
+    counts, edges = np.histogram(values[finite], bins=bins, range=range,
+                                 weights=None if weights is None else np.asarray(weights)[finite])
+    return _orig_hist(ax, (edges[:-1] + edges[1:]) / 2, bins=edges, weights=counts, **kwargs)
+
+import matplotlib.axes as _maxes
+_orig_plot, _orig_scatter, _orig_hist = _maxes.Axes.plot, _maxes.Axes.scatter, _maxes.Axes.hist
+'''
+
+# Optional: route Axes.plot / scatter / hist (and so plt.* and pandas .plot) through the
+# reductions above when a series is large enough for it to matter.
+_PLOT_AUTO_DOWNSAMPLE_PATCH = r'''
+def _downsampled_plot(self, *args, **kwargs):
+    try:
+        if kwargs.get("data") is None and 1 <= len(args) <= 3:
+            fmt = [args[-1]] if isinstance(args[-1], str) else []
+            xy = args[:len(args) - len(fmt)]
+            if len(xy) in (1, 2):
+                y = np.asarray(xy[-1])
+                x = np.asarray(xy[0]) if len(xy) == 2 else np.arange(len(y))
+                if _line_downsampleable(x, y):
+                    idx = lttb_indices(x, y, 2 * _axes_pixels(self)[0])
+                    args = (x[idx], y[idx], *fmt)
+    except Exception:
+        pass
+    return _orig_plot(self, *args, **kwargs)
+
+def _downsampled_scatter(self, x, y, s=None, c=None, *args, **kwargs):
+    try:
+        alpha = kwargs.get("alpha")
+        if (np.ndim(x) == 1 and len(x) >= _DOWNSAMPLE_MIN_POINTS and len(x) == len(y) and not args
+                and (alpha is None or alpha >= 1) and self.get_xscale() == "linear" and self.get_yscale() == "linear"
+                and _as_float(x) is not None and _as_float(y) is not None):
+            keep = _pixel_representatives(self, x, y)
+            pick = lambda v: np.asarray(v)[keep] if v is not None and np.ndim(v) >= 1 and len(v) == len(x) else v
+            cf = _as_float(c) if c is not None and np.ndim(c) == 1 and len(c) == len(x) else None
+            if cf is not None and kwargs.get("norm") is None and np.isfinite(cf).any():
+                # colors are scaled to the full c, not to the values of the points that are kept
+                if kwargs.get("vmin") is None:
+                    kwargs["vmin"] = np.nanmin(cf)
+                if kwargs.get("vmax") is None:
+                    kwargs["vmax"] = np.nanmax(cf)
+            x, y, s, c = np.asarray(x)[keep], np.asarray(y)[keep], pick(s), pick(c)
+            for key in ("edgecolors", "linewidths"):
+                if key in kwargs:
+                    kwargs[key] = pick(kwargs[key])
+    except Exception:
+        pass
+    return _orig_scatter(self, x, y, s, c, *args, **kwargs)
+
+def _downsampled_hist(self, x, bins=None, range=None, density=False, weights=None, *args, **kwargs):
+    try:
+        values = np.asarray(x)
+        if (values.ndim == 1 and len(values) >= _DOWNSAMPLE_MIN_POINTS and not args and not kwargs.get("data")
+                and np.issubdtype(values.dtype, np.number)):
+            values = values.astype(float)
+            finite = np.isfinite(values)
+            w = None if weights is None else np.asarray(weights, dtype=float)[finite]
+            counts, edges = np.histogram(values[finite], bins=10 if bins is None else bins, range=range, weights=w)
+            return _orig_hist(self, (edges[:-1] + edges[1:]) / 2, bins=edges, density=density,
+                              weights=counts, **kwargs)
+    except Exception:
+        pass
+    return _orig_hist(self, x, bins, range, density, weights, *args, **kwargs)
+
+_maxes.Axes.plot = _downsampled_plot
+_maxes.Axes.scatter = _downsampled_scatter
+_maxes.Axes.hist = _downsampled_hist
+'''
+
+
+def _sandbox_prelude(injected_pickle: str = None, hot_dataset: str = None,
+                     approx: Dict[str, Any] = None, projection: Dict[str, Any] = None,
+                     parquet_path: str = None) -> List[str]:
+    """
+    Imports, df/data injection, plot_to_base64() and scrape_url_to_dataframe() for sandbox scripts.
+    hot_dataset is a hot-tier Arrow segment that is memory-mapped in preference to the pickle.
+    approx (sample meta from approx_sample_for) means df is a sample: the approx_* estimators
+    are defined and _result_extras() reports their confidence intervals.
+    projection (from analyze_df_usage) limits df to the columns and rows the code reads; it is
+    pushed into the Arrow segment or parquet copy (parquet_path) when there is one.
+    """
+    preamble = [
+        "import json, sys, gc",
+        "import pandas as pd, numpy as np",
+        "import matplotlib",
+        "matplotlib.use('Agg')",
+        "import matplotlib.pyplot as plt",
+        "from io import BytesIO",
+        "import base64",
+    ]
+    if PIL_AVAILABLE:
+        preamble.append("from PIL import Image")
+    # extra top-level keys for the final JSON line (overridden in approximate mode)
+    preamble.append("def _result_extras(results):\n    return {}\n")
+    preamble.append(_PERF_LINT_HELPERS)
+    # inject df if a pickle path provided
+    if hot_dataset or injected_pickle:
+        preamble.append(_DATASET_LOADER)
+        preamble.append(f"df = _load_dataset({hot_dataset!r}, {parquet_path!r}, {injected_pickle!r}, "
+                        f"json.loads({json.dumps(json.dumps(projection))}))\n")
+        if approx:
+            preamble.append(f"_APPROX = json.loads({json.dumps(json.dumps(_approx_sandbox_meta(approx)))})")
+            preamble.append(_APPROX_HELPERS)
+        # with a projection the code is known not to touch `data`
+        preamble.append("data = df.to_dict(orient='records')\n" if projection is None else "data = {}\n")
+    else:
+        # ensure data exists so user code that references data won't break
+        preamble.append("data = globals().get('data', {})\n")
+    preamble.append(_PLOT_HELPER)
+    preamble.append(_PLOT_DOWNSAMPLE_HELPERS.replace("_DOWNSAMPLE_MIN_POINTS_VALUE", str(PLOT_DOWNSAMPLE_MIN_POINTS)))
+    if PLOT_AUTO_DOWNSAMPLE:
+        preamble.append(_PLOT_AUTO_DOWNSAMPLE_PATCH)
+    preamble.append(SCRAPE_FUNC)
+    preamble.append("\nresults = {}\n")
+    return preamble
+
+
+def _lookup_cached_result(code: str, injected_pickle: str = None, dataset_hash: str = None,
+                          source_hashes: Dict[str, str] = None):
+    """Returns (cache_key, cached_results). cache_key is None when the code must not be cached."""
+    if _exec_cache is None or not is_cacheable_code(code, source_hashes):
+        return None, None
+    try:
+        if dataset_hash is None and injected_pickle:
+            dataset_hash = _file_sha256(injected_pickle)
+        cache_key = execution_cache_key(code, dataset_hash, source_hashes)
+        return cache_key, _exec_cache.get(cache_key)
+    except Exception as e:
+        logger.warning(f"Execution cache lookup failed: {e}")
+        return None, None
+
+
+def _remove_injected_pickle(injected_pickle: str = None) -> None:
+    # pickles that live in the shared dataset cache are owned (and evicted) by the cache
+    try:
+        if injected_pickle and not dataset_cache.contains(injected_pickle) and os.path.exists(injected_pickle):
+            os.unlink(injected_pickle)
+    except Exception:
+        pass
+
+
+def _run_sandbox_script(script: str, timeout: int, on_line=None) -> subprocess.CompletedProcess:
+    """
+    Write the script to a temp file and run it in a fresh interpreter. Raises subprocess.TimeoutExpired,
+    whose output/stderr hold what the script had printed before it was killed. With on_line, every stdout line is passed to it as soon as the sandbox prints it.
+    The timeout is capped by the request deadline, and the process is killed if the deadline is cancelled.
+    """
+    timeout = deadline_budget(timeout, "running the generated code")
+    deadline = current_deadline()
     tmp = tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8')
-    tmp.write("\n".join(script_lines))
+    tmp.write(script)
     tmp.flush()
     tmp_path = tmp.name
     tmp.close()
+    unregister = lambda: None
+    try:
+        # own process group, so forked cell workers are killed along with the sandbox
+        proc = subprocess.Popen([sys.executable, tmp_path], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True, start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill_on_timeout():
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except Exception:
+                proc.kill()
+
+        if deadline is not None:
+            unregister = deadline.on_cancel(kill_on_timeout)
+        if on_line is None:
+            try:
+                stdout, stderr = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill_on_timeout()
+                stdout, stderr = proc.communicate()
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(proc.args, timeout, output=stdout, stderr=stderr)
+            return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+        timer = threading.Timer(timeout, kill_on_timeout)
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+        timer.start()
+        stderr_reader.start()
+        stdout_lines = []
+        try:
+            for line in proc.stdout:
+                stdout_lines.append(line)
+                try:
+                    on_line(line)
+                except Exception as e:
+                    logger.warning(f"Sandbox line callback failed: {e}")
+            proc.wait()
+            stderr_reader.join()
+        finally:
+            timer.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(proc.args, timeout, output="".join(stdout_lines),
+                                            stderr="".join(stderr_chunks))
+        return subprocess.CompletedProcess(proc.args, proc.returncode, "".join(stdout_lines), "".join(stderr_chunks))
+    finally:
+        unregister()
+        try:
+            os.unlink(tmp_path)
+        except Exception:
+            pass
+
+
+# -----------------------------
+# Opt-in profiling of generated code
+# -----------------------------
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", 25))
+PROFILE_STORE_TTL_SECONDS = int(os.getenv("PROFILE_STORE_TTL_SECONDS", 7 * 86400))
+profile_store = SharedCache("profiles", PROFILE_STORE_TTL_SECONDS, int(os.getenv("PROFILE_STORE_MAX_MB", 64)) * 1024 * 1024)
+
+# Runs _USER_CODE (compiled as "<generated>") under cProfile for per-function cumulative time, a
+# line tracer restricted to "<generated>" frames for per-line wall time (inclusive of callees)
+# and hit counts, and tracemalloc for the peak-memory trace. Prints results + report as JSON.
+_PROFILE_RUNNER = r'''
+import cProfile, pstats, time, traceback, tracemalloc, resource
+
+_line_stats = {}   # lineno -> [hits, seconds, peak traced bytes]
+_frame_last = {}   # id(frame) -> (lineno, start time)
+
+def _line_tracer(frame, event, arg):
+    now = time.perf_counter()
+    prev = _frame_last.pop(id(frame), None)
+    if prev is not None:
+        st = _line_stats.setdefault(prev[0], [0, 0.0, 0])
+        st[1] += now - prev[1]
+        st[2] = max(st[2], tracemalloc.get_traced_memory()[0])
+    if event == "line":
+        _line_stats.setdefault(frame.f_lineno, [0, 0.0, 0])[0] += 1
+        _frame_last[id(frame)] = (frame.f_lineno, time.perf_counter())
+    return _line_tracer
+
+def _call_tracer(frame, event, arg):
+    return _line_tracer if frame.f_code.co_filename == "<generated>" else None
+
+def _profile_report(profiler, wall):
+    stats = pstats.Stats(profiler)
+    funcs = []
+    for (filename, lineno, name), (cc, nc, tt, ct, _) in stats.stats.items():
+        funcs.append({"function": f"{filename}:{lineno}({name})", "ncalls": nc,
+                      "tottime": round(tt, 6), "cumtime": round(ct, 6)})
+    funcs.sort(key=lambda f: f["cumtime"], reverse=True)
+    source = _USER_CODE.splitlines()
+    lines = [{"line": ln, "source": source[ln - 1].strip() if 0 < ln <= len(source) else "",
+              "hits": st[0], "seconds": round(st[1], 6), "peak_mb": round(st[2] / 1024 ** 2, 3)}
+             for ln, st in sorted(_line_stats.items())]
+    return {
+        "wall_seconds": round(wall, 6),
+        "peak_traced_mb": round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 3),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3),
+        "top_functions": funcs[:_PROFILE_TOP],
+        "lines": lines,
+        "hotspots": sorted(lines, key=lambda l: l["seconds"], reverse=True)[:10],
+    }
+
+_PROTO_OUT = sys.stdout
+sys.stdout = sys.stderr
+_error = None
+_profiler = cProfile.Profile()
+tracemalloc.start()
+_t0 = time.perf_counter()
+sys.settrace(_call_tracer)
+_profiler.enable()
+try:
+    exec(compile(_USER_CODE, "<generated>", "exec"), globals())
+except Exception:
+    _error = traceback.format_exc()
+finally:
+    _profiler.disable()
+    sys.settrace(None)
+_report = _profile_report(_profiler, time.perf_counter() - _t0)
+tracemalloc.stop()
+if _error is None:
+    _PROTO_OUT.write(json.dumps({"status": "success", "result": results, "profile": _report,
+                                 **_result_extras(results)}, default=str) + "\n")
+else:
+    _PROTO_OUT.write(json.dumps({"status": "error", "message": _error, "profile": _report}, default=str) + "\n")
+_PROTO_OUT.flush()
+'''
+
 
+def _store_profile(report: Dict[str, Any], code: str, dataset_hash: str = None) -> Optional[str]:
+    """Persist a profiling report (with the code it describes) for GET /profiles/{id}; returns its id."""
+    profile_id = hashlib.sha256(f"{time.time()}:{os.getpid()}:{code}".encode("utf-8")).hexdigest()[:24]
+    record = {"id": profile_id, "created": time.time(), "dataset_hash": dataset_hash, "code": code, "report": report}
     try:
-        completed = subprocess.run([sys.executable, tmp_path],
-                                   capture_output=True, text=True, timeout=timeout)
+        profile_store.put_bytes(profile_id, json.dumps(record, default=str).encode("utf-8"), ".json")
+        return profile_id
+    except Exception as e:
+        logger.warning(f"Could not store profile: {e}")
+        return None
+
+
+def write_and_run_temp_python(code: str, injected_pickle: str = None, timeout: int = 60,
+                              dataset_hash: str = None, source_hashes: Dict[str, str] = None,
+                              hot_dataset: str = None, profile: bool = False,
+                              approx: Dict[str, Any] = None, projection: Dict[str, Any] = None,
+                              parquet_path: str = None) -> Dict[str, Any]:
+    """
+    Write a temp python file which:
+      - provides a safe environment (imports)
+      - loads df/from pickle if provided into df and data variables
+      - defines a robust plot_to_base64() helper that ensures < 100kB (attempts resizing/conversion)
+      - executes the user code (which should populate `results` dict)
+      - prints json.dumps({"status":"success","result":results})
+    Returns dict with parsed JSON or error details.
+    Deterministic code is served from the execution result cache when the same
+    (code, dataset_hash, source_hashes) combination has run before.
+    With profile=True the cache is bypassed and the code runs under the profiler; the report
+    is stored and returned as "profile" / "profile_id", also when the code fails.
+    With approx (sample meta), df is the dataset's sample and the estimators' confidence
+    intervals come back as "approx"; those runs are cheap and are not cached.
+    projection / parquet_path: see _sandbox_prelude.
+    """
+    try:
+        cache_key, cached = (None, None) if profile or approx else \
+            _lookup_cached_result(code, injected_pickle, dataset_hash, source_hashes)
+        if cached is not None:
+            logger.info(f"Execution cache hit {cache_key[:12]}")
+            return {"status": "success", "result": cached, "cached": True}
+
+        # Build the code to write
+        script_lines = _sandbox_prelude(injected_pickle, hot_dataset, approx, projection, parquet_path)
+        if profile:
+            script_lines.append(f"_USER_CODE = {json.dumps(code)}")
+            script_lines.append(f"_PROFILE_TOP = {PROFILE_TOP_FUNCTIONS}")
+            script_lines.append(_PROFILE_RUNNER)
+        else:
+            script_lines.append(code)
+            # ensure results printed as json
+            script_lines.append("\nprint(json.dumps({'status':'success','result':results, **_result_extras(results)}, "
+                                "default=str), flush=True)\n")
+
+        completed = _run_sandbox_script("\n".join(script_lines), timeout)
         if completed.returncode != 0:
             # collect stderr and stdout for debugging
             return {"status": "error", "message": completed.stderr.strip() or completed.stdout.strip()}
@@ -431,18 +2851,219 @@ def plot_to_base64(max_bytes=100000):
         out = completed.stdout.strip()
         try:
             parsed = json.loads(out)
-            return parsed
         except Exception as e:
             return {"status": "error", "message": f"Could not parse JSON output: {str(e)}", "raw": out}
+        if profile and "profile" in parsed:
+            parsed["profile_id"] = _store_profile(parsed["profile"], code, dataset_hash)
+        if cache_key and parsed.get("status") == "success":
+            _exec_cache.put(cache_key, parsed.get("result", {}))
+        return parsed
     except subprocess.TimeoutExpired:
         return {"status": "error", "message": "Execution timed out"}
     finally:
+        _remove_injected_pickle(injected_pickle)
+
+
+# -----------------------------
+# Per-question parallel execution
+# -----------------------------
+PARALLEL_QUESTIONS_DEFAULT = os.getenv("PARALLEL_QUESTIONS", "0") == "1"
+CELL_TIMEOUT_SECONDS = int(os.getenv("CELL_TIMEOUT_SECONDS", 60))
+PARALLEL_CELL_WORKERS = int(os.getenv("PARALLEL_CELL_WORKERS", os.cpu_count() or 2))
+
+# Runs inside the sandbox after `setup`: every cell is forked from the process that
+# already holds df, so workers share the loaded dataset copy-on-write. The parent
+# enforces each cell's timeout and writes one JSON line per finished cell to stdout.
+_CELL_RUNNER = r'''
+import os, time, select, signal, traceback
+
+def _cell_questions(cell):
+    qs = cell.get("questions") or ([cell["question"]] if cell.get("question") else [])
+    return [str(q) for q in qs]
+
+def _emit(line):
+    _PROTO_OUT.write(json.dumps(line, default=str) + "\n")
+    _PROTO_OUT.flush()
+
+def _exec_cell(index, cell):
+    global results
+    results = {}
+    plt.close('all')
+    exec(compile(cell.get("code", ""), f"<cell {index}>", "exec"), globals())
+    return results
+
+def _cell_error(exc):
+    return "".join(traceback.format_exception_only(type(exc), exc)).strip()
+
+def _run_cells(cells, cell_timeout, max_workers):
+    outcomes = {}
+    if not hasattr(os, "fork"):
+        for i, cell in enumerate(cells):
+            try:
+                outcomes[i] = {"status": "success", "result": _exec_cell(i, cell)}
+            except Exception as e:
+                outcomes[i] = {"status": "error", "message": _cell_error(e)}
+            _emit({"cell": i, "questions": _cell_questions(cell), **outcomes[i]})
+        return outcomes
+
+    pending = list(range(len(cells)))
+    running = {}  # read fd -> [cell index, pid, start time, output chunks]
+    while pending or running:
+        while pending and len(running) < max_workers:
+            i = pending.pop(0)
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                code = 0
+                try:
+                    if "_approx_intervals" in globals():
+                        del _approx_intervals[:]  # report only this cell's estimates
+                    payload = {"status": "success", "result": _exec_cell(i, cells[i])}
+                    if "_approx_intervals" in globals():
+                        payload["intervals"] = _approx_intervals
+                except BaseException as e:
+                    payload = {"status": "error", "message": _cell_error(e)}
+                    code = 1
+                try:
+                    data = json.dumps(payload, default=str).encode("utf-8")
+                    while data:
+                        data = data[os.write(w, data):]
+                finally:
+                    os._exit(code)
+            os.close(w)
+            running[r] = [i, pid, time.monotonic(), []]
+
+        ready, _, _ = select.select(list(running), [], [], 0.05)
+        for fd in ready:
+            chunk = os.read(fd, 1 << 16)
+            if chunk:
+                running[fd][3].append(chunk)
+                continue
+            i, pid, _, chunks = running.pop(fd)
+            os.close(fd)
+            os.waitpid(pid, 0)
+            try:
+                outcomes[i] = json.loads(b"".join(chunks))
+            except Exception:
+                outcomes[i] = {"status": "error", "message": "Cell exited without producing a result"}
+            _emit({"cell": i, "questions": _cell_questions(cells[i]), **outcomes[i]})
+
+        now = time.monotonic()
+        for fd, (i, pid, started, _) in list(running.items()):
+            if now - started > cell_timeout:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                except Exception:
+                    pass
+                os.close(fd)
+                running.pop(fd)
+                outcomes[i] = {"status": "error", "message": f"Execution timed out after {cell_timeout}s"}
+                _emit({"cell": i, "questions": _cell_questions(cells[i]), **outcomes[i]})
+    return outcomes
+
+_outcomes = _run_cells(_CELLS, _CELL_TIMEOUT, _MAX_WORKERS)
+results, _errors = {}, {}
+for _i, _cell in enumerate(_CELLS):
+    _out = _outcomes.get(_i, {"status": "error", "message": "Cell did not run"})
+    if _out.get("status") == "success":
+        results.update(_out.get("result") or {})
+        if "_approx_intervals" in globals():
+            _approx_intervals.extend(_out.get("intervals") or [])
+    else:
+        for _q in _cell_questions(_cell):
+            _errors[_q] = _out.get("message")
+_emit({"status": "success", "result": results, "errors": _errors, **_result_extras(results)})
+'''
+
+
+PARALLEL_CELLS_RULES = (
+    "Parallel execution mode: instead of a single \"code\" string, return\n"
+    '   - "setup": "..."  (shared code run once before any question: imports, loading, cleaning)\n'
+    '   - "cells": [ {"question": "<exact question string>", "code": "..."}, ... ]  (one cell per question)\n'
+    "   Each cell runs in its own process after setup, sees everything setup defined, and must set\n"
+    "   results[<its question>]. Cells must not depend on each other.\n"
+)
+
+
+def write_and_run_parallel_cells(setup: str, cells: List[Dict[str, Any]], injected_pickle: str = None,
+                                 timeout: int = 60, cell_timeout: int = None,
+                                 dataset_hash: str = None, source_hashes: Dict[str, str] = None,
+                                 on_cell=None, hot_dataset: str = None,
+                                 approx: Dict[str, Any] = None, projection: Dict[str, Any] = None,
+                                 parquet_path: str = None) -> Dict[str, Any]:
+    """
+    Run shared `setup` code once, then every cell ({"question"/"questions", "code"}) in its own
+    forked worker with its own timeout. Returns {"status": "success", "result": {...}, "errors": {question: message}}
+    so answers from cells that finished are kept even when others fail or time out.
+    on_cell(outcome) is called as each cell finishes, before the remaining cells are done.
+    """
+    cell_timeout = min(cell_timeout or CELL_TIMEOUT_SECONDS, timeout)
+    plan = setup + "\n" + json.dumps(cells, sort_keys=True)
+    try:
+        cache_key, cached = (None, None) if approx else \
+            _lookup_cached_result(plan, injected_pickle, dataset_hash, source_hashes)
+        if cached is not None:
+            logger.info(f"Execution cache hit {cache_key[:12]}")
+            return {"status": "success", "result": cached, "errors": {}, "cached": True}
+
+        script_lines = _sandbox_prelude(injected_pickle, hot_dataset, approx, projection, parquet_path)
+        # protocol lines go to the real stdout; anything the generated code prints goes to stderr
+        script_lines.append("_PROTO_OUT = sys.stdout\nsys.stdout = sys.stderr\n")
+        script_lines.append(setup or "")
+        script_lines.append(f"\n_CELLS = json.loads({json.dumps(json.dumps(cells))})")
+        script_lines.append(f"_CELL_TIMEOUT = {int(cell_timeout)}")
+        script_lines.append(f"_MAX_WORKERS = {max(1, PARALLEL_CELL_WORKERS)}")
+        script_lines.append(_CELL_RUNNER)
+
+        def forward_cell(line):
+            if on_cell is not None and line.startswith('{"cell"'):
+                on_cell(json.loads(line))
+
+        completed = _run_sandbox_script("\n".join(script_lines), timeout,
+                                        on_line=forward_cell if on_cell is not None else None)
+        lines = [ln for ln in completed.stdout.splitlines() if ln.strip()]
+        if completed.returncode != 0 or not lines:
+            return {"status": "error", "message": completed.stderr.strip() or completed.stdout.strip()}
         try:
-            os.unlink(tmp_path)
-            if injected_pickle and os.path.exists(injected_pickle):
-                os.unlink(injected_pickle)
+            parsed = json.loads(lines[-1])
+        except Exception as e:
+            return {"status": "error", "message": f"Could not parse JSON output: {str(e)}", "raw": lines[-1]}
+        if cache_key and parsed.get("status") == "success" and not parsed.get("errors"):
+            _exec_cache.put(cache_key, parsed.get("result", {}))
+        return parsed
+    except subprocess.TimeoutExpired as e:
+        return _finished_cells(cells, e.output or "", f"Execution timed out after {int(e.timeout)}s")
+    finally:
+        _remove_injected_pickle(injected_pickle)
+
+
+def _finished_cells(cells: List[Dict[str, Any]], stdout: str, message: str) -> Dict[str, Any]:
+    """
+    Result of a cells run that was killed before its final line: the answers of the cells whose
+    {"cell": ...} line had been printed, and `message` as the error of every other cell's questions.
+    """
+    result, errors, done = {}, {}, set()
+    for line in stdout.splitlines():
+        if not line.startswith('{"cell"'):
+            continue
+        try:
+            outcome = json.loads(line)
         except Exception:
-            pass
+            continue  # the line the sandbox was writing when it was killed
+        done.add(outcome.get("cell"))
+        if outcome.get("status") == "success":
+            result.update(outcome.get("result") or {})
+        else:
+            errors.update({q: outcome.get("message") for q in outcome.get("questions", [])})
+    for i, cell in enumerate(cells):
+        if i not in done:
+            qs = cell.get("questions") or ([cell["question"]] if cell.get("question") else [])
+            errors.update({str(q): message for q in qs})
+    if not done:
+        return {"status": "error", "message": message}
+    return {"status": "success", "result": result, "errors": errors}
 
 
 # -----------------------------
@@ -502,193 +3123,1170 @@ agent_executor = AgentExecutor(
 )
 
 
-# -----------------------------
-# Runner: orchestrates agent -> pre-scrape inject -> execute
-# -----------------------------
-def run_agent_safely(llm_input: str) -> Dict:
+# -----------------------------
+# Runner: orchestrates agent -> pre-scrape inject -> execute
+# -----------------------------
+def run_agent_safely(llm_input: str) -> Dict:
+    """
+    1. Run the agent_executor.invoke to get LLM output
+    2. Extract JSON, get 'code' and 'questions'
+    3. Detect scrape_url_to_dataframe("...") calls in code, run them here, pickle df and inject before exec
+    4. Execute the code in a temp file and return results mapping questions -> answers
+    """
+    try:
+        response = agent_executor.invoke({"input": llm_input})
+        raw_out = response.get("output") or response.get("final_output") or response.get("text") or ""
+        if not raw_out:
+            return {"error": f"Agent returned no output. Full response: {response}"}
+
+        parsed = clean_llm_output(raw_out)
+        if "error" in parsed:
+            return parsed
+
+        if not isinstance(parsed, dict) or "code" not in parsed or "questions" not in parsed:
+            return {"error": f"Invalid agent response format: {parsed}"}
+
+        code = parsed["code"]
+        questions: List[str] = parsed["questions"]
+
+        # Detect scrape calls; find all URLs used in scrape_url_to_dataframe("URL")
+        urls = re.findall(r"scrape_url_to_dataframe\(\s*['\"](.*?)['\"]\s*\)", code)
+        pickle_path = None
+        if urls:
+            # For now support only the first URL (agent may code multiple scrapes; you can extend this)
+            url = urls[0]
+            tool_resp = scrape_url_to_dataframe(url)
+            if tool_resp.get("status") != "success":
+                return {"error": f"Scrape tool failed: {tool_resp.get('message')}"}
+            # create df and pickle it
+            df = pd.DataFrame(tool_resp["data"])
+            temp_pkl = tempfile.NamedTemporaryFile(suffix=".pkl", delete=False)
+            temp_pkl.close()
+            df.to_pickle(temp_pkl.name)
+            pickle_path = temp_pkl.name
+            # Make sure agent's code can reference df/data: we will inject the pickle loader in the temp script
+
+        # Execute code in temp python script
+        exec_result = write_and_run_temp_python(code, injected_pickle=pickle_path, timeout=LLM_TIMEOUT_SECONDS)
+        if exec_result.get("status") != "success":
+            return {"error": f"Execution failed: {exec_result.get('message', exec_result)}", "raw": exec_result.get("raw")}
+
+        # exec_result['result'] should be results dict
+        results_dict = exec_result.get("result", {})
+        # Map to original questions (they asked to use exact question strings)
+        output = {}
+        for q in questions:
+            output[q] = results_dict.get(q, "Answer not found")
+        return output
+
+    except Exception as e:
+        logger.exception("run_agent_safely failed")
+        return {"error": str(e)}
+
+
+from fastapi import Request
+
+
+# ---- Upload decoding: compressed uploads and content sniffing ----
+_SNIFF_BYTES = 8192
+_COMPRESSION_MAGIC = (
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"PK\x03\x04", "zip"),
+)
+_COMPRESSION_SUFFIXES = (".gz", ".gzip", ".zst", ".zstd", ".bz2", ".xz", ".zip")
+# compressed uploads and request bodies may not inflate to more than this (zip bombs): 413
+MAX_DECOMPRESSED_BYTES = int(os.getenv("MAX_DECOMPRESSED_MB", 2048)) * 1024 * 1024
+# request bodies are inflated and passed on in pieces of at most this size
+_INFLATE_CHUNK_BYTES = 1 << 20
+# zstd's decompressobj has no max_length, so it is fed this much input per call: zstd expands
+# at most ~32000x (RLE blocks), which bounds one call's output to about 16 MB
+_ZSTD_FEED_BYTES = 512
+
+
+def _decompressed_too_large() -> HTTPException:
+    return HTTPException(413, f"Decompressed data exceeds the {MAX_DECOMPRESSED_BYTES // (1024 * 1024)} MB limit")
+
+
+class _LimitedReader:
+    """read(n) view of a decompressing stream that raises 413 once more than MAX_DECOMPRESSED_BYTES came out."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._left = MAX_DECOMPRESSED_BYTES
+
+    def read(self, n: int) -> bytes:
+        data = self._stream.read(n)
+        self._left -= len(data)
+        if self._left < 0:
+            raise _decompressed_too_large()
+        return data
+
+
+class _RawStream(io.RawIOBase):
+    """Raw-IO view of any object with read(n), so it can sit under an io.BufferedReader (for peek())."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _is_seekable(f) -> bool:
+    try:
+        return f.seekable()
+    except Exception:
+        return False
+
+
+def _seekable_copy(stream, source):
+    """A seekable file with stream's full content: source rewound if given and seekable, else a temp-file spool."""
+    if source is not None and _is_seekable(source):
+        source.seek(0)
+        return source
+    spool = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, spool, 1 << 20)
+    spool.seek(0)
+    return spool
+
+
+def _decompressing_reader(stream, kind: str):
+    if kind == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if kind == "bz2":
+        return bz2.BZ2File(stream, mode="rb")
+    if kind == "xz":
+        return lzma.LZMAFile(stream, mode="rb")
+    if not ZSTD_AVAILABLE:
+        raise HTTPException(415, "zstd-compressed uploads need the zstandard package")
+    return zstd.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+
+def _zip_data_member(zf: zipfile.ZipFile) -> zipfile.ZipInfo:
+    members = [m for m in zf.infolist() if not m.is_dir() and not m.filename.startswith("__MACOSX/")
+               and not os.path.basename(m.filename).startswith(".")]
+    if not members:
+        raise HTTPException(400, "Zip upload contains no data file")
+    # several files: the largest one we know how to read
+    known = [m for m in members if m.filename.lower().endswith(
+        (".csv", ".tsv", ".txt", ".json", ".parquet", ".xlsx", ".xls") + _COMPRESSION_SUFFIXES)]
+    return max(known or members, key=lambda m: m.file_size)
+
+
+def _sniff_format(head: bytes, filename: str) -> Optional[str]:
+    """Data format from magic bytes, then the file extension, then what the text looks like."""
+    if head.startswith(b"PAR1"):
+        return "parquet"
+    if head.startswith((b"PK\x03\x04", b"\xd0\xcf\x11\xe0")):  # xlsx (zip container) / legacy xls
+        return "excel"
+    if head.startswith((b"\x89PNG", b"\xff\xd8\xff")):
+        return "image"
+    if filename.endswith((".csv", ".tsv", ".txt")):
+        return "csv"
+    if filename.endswith((".json", ".jsonl", ".ndjson")):
+        return "json"
+    if filename.endswith(".parquet"):
+        return "parquet"
+    if filename.endswith((".xlsx", ".xls")):
+        return "excel"
+    if filename.endswith((".png", ".jpg", ".jpeg")):
+        return "image"
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if text.startswith((b"{", b"[")):
+        return "json"
+    if head and b"\x00" not in head:
+        return "csv"
+    return None
+
+
+def _open_upload(fileobj, filename: str):
+    """
+    Returns (stream, filename, format) for an uploaded file, decompressing gzip / bz2 / xz / zstd
+    and zip archives (also nested, e.g. a .csv.gz inside a .zip) on the fly, chunk by chunk.
+    Reading more than MAX_DECOMPRESSED_BYTES out of a compressed upload raises HTTPException(413).
+    The stream is forward-only, except for parquet/excel which need a seekable file: those get
+    the original file when it was not compressed, else a temp-file spool.
+    """
+    source, name = fileobj, filename
+    for _ in range(3):
+        stream = io.BufferedReader(_RawStream(source), buffer_size=1 << 20)
+        head = stream.peek(_SNIFF_BYTES)[:_SNIFF_BYTES]
+        kind = next((k for magic, k in _COMPRESSION_MAGIC if head.startswith(magic)), None)
+        if kind is None:
+            break
+        if kind == "zip":
+            archive = _seekable_copy(stream, source if source is fileobj else None)
+            zf = zipfile.ZipFile(archive)
+            if "[Content_Types].xml" in zf.namelist():  # an Office document, not an archive of data files
+                archive.seek(0)
+                return archive, name, "excel"
+            member = _zip_data_member(zf)
+            source, name = _LimitedReader(zf.open(member)), member.filename.lower()
+        else:
+            source = _LimitedReader(_decompressing_reader(stream, kind))
+            base, ext = os.path.splitext(name)
+            name = base if ext in _COMPRESSION_SUFFIXES else name
+    fmt = _sniff_format(head, name)
+    if fmt in ("parquet", "excel"):
+        # random access into a decompressing reader would re-inflate from the start; spool instead
+        return _seekable_copy(stream, source if source is fileobj else None), name, fmt
+    return stream, name, fmt
+
+
+def _hash_upload(fileobj, ext: str) -> str:
+    """sha256 over ext + NUL + file bytes, read in chunks; leaves the file rewound."""
+    h = hashlib.sha256(ext.encode("utf-8") + b"\0")
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1 << 20), b""):
+        h.update(chunk)
+    fileobj.seek(0)
+    return h.hexdigest()
+
+
+def _body_decompressor(encoding: str):
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "zstd" and ZSTD_AVAILABLE:
+        return zstd.ZstdDecompressor().decompressobj()
+    return None
+
+
+class _BodyInflater:
+    """
+    Bounded incremental decoding of a request body: pieces() yields the output of each received
+    chunk in pieces of at most _INFLATE_CHUNK_BYTES (zlib: max_length + unconsumed_tail; zstd: see
+    _ZSTD_FEED_BYTES) and raises HTTPException(413) once the total passes MAX_DECOMPRESSED_BYTES.
+    """
+
+    def __init__(self, encoding: str, decompressor):
+        self.encoding = encoding
+        self._d = decompressor
+        self._left = MAX_DECOMPRESSED_BYTES
+
+    def _count(self, data: bytes) -> bytes:
+        self._left -= len(data)
+        if self._left < 0:
+            raise _decompressed_too_large()
+        return data
+
+    def _inflate(self, data: bytes, final: bool):
+        if self.encoding == "zstd":
+            for i in range(0, len(data), _ZSTD_FEED_BYTES):
+                yield self._count(self._d.decompress(data[i:i + _ZSTD_FEED_BYTES]))
+        else:
+            while True:
+                out = self._d.decompress(data, _INFLATE_CHUNK_BYTES)
+                data = self._d.unconsumed_tail
+                yield self._count(out)
+                if not data and len(out) < _INFLATE_CHUNK_BYTES:
+                    break  # input used up and nothing left buffered
+        if final:
+            yield self._count(self._d.flush())
+
+    def pieces(self, data: bytes, final: bool):
+        try:
+            for piece in self._inflate(data, final):
+                if piece:
+                    yield piece
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(400, f"Could not decode {self.encoding} request body: {e}")
+
+
+class RequestDecompressionMiddleware:
+    """
+    Inflates request bodies sent with Content-Encoding: gzip / deflate / zstd one chunk at a time
+    as the app receives them, so compressed uploads stream through the multipart parser (which
+    spools files to disk) without ever being inflated in memory as a whole. A received chunk that
+    inflates to more than _INFLATE_CHUNK_BYTES is handed to the app over several receive() calls,
+    and bodies inflating past MAX_DECOMPRESSED_BYTES are rejected with 413.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = dict(scope["headers"]).get(b"content-encoding", b"").decode("latin-1").strip().lower()
+        if encoding in ("", "identity"):
+            return await self.app(scope, receive, send)
+        decompressor = _body_decompressor(encoding)
+        if decompressor is None:
+            response = JSONResponse({"detail": f"Unsupported Content-Encoding: {encoding}"}, status_code=415)
+            return await response(scope, receive, send)
+
+        scope = dict(scope)
+        scope["headers"] = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        inflater = _BodyInflater(encoding, decompressor)
+        state = {"pieces": iter(()), "last": False, "done": False}
+
+        async def inflating_receive():
+            if state["done"]:
+                return await receive()  # body fully delivered: disconnects etc.
+            while True:
+                piece = next(state["pieces"], None)
+                if piece is not None:
+                    return {"type": "http.request", "body": piece, "more_body": True}
+                if state["last"]:
+                    state["done"] = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                message = await receive()
+                if message["type"] != "http.request":
+                    return message
+                state["last"] = not message.get("more_body", False)
+                state["pieces"] = inflater.pieces(message.get("body", b""), final=state["last"])
+
+        await self.app(scope, inflating_receive, send)
+
+
+app.add_middleware(RequestDecompressionMiddleware)
+
+
+# ---- Streaming JSON ingestion ----
+# Documents under JSON_STREAM_MIN_BYTES are parsed whole, as before. Larger top-level arrays and
+# NDJSON are parsed record by record into columns of JSON_CHUNK_ROWS records, so only one chunk of
+# Python objects is alive at a time, and the columns are joined one by one at the end.
+JSON_CHUNK_ROWS = int(os.getenv("JSON_CHUNK_ROWS", 50000))
+JSON_STREAM_MIN_BYTES = int(os.getenv("JSON_STREAM_MIN_MB", 64)) * 1024 * 1024
+_JSON_READ_BYTES = 1 << 20
+_NDJSON_SUFFIXES = (".jsonl", ".ndjson")
+
+
+def _looks_like_ndjson(text: bytes) -> bool:
+    """A complete JSON value on the first line, followed by another value on the next."""
+    first, sep, rest = text.partition(b"\n")
+    if not sep:
+        return False
+    try:
+        json.loads(first)
+    except ValueError:
+        return False
+    return rest.lstrip()[:1] in (b"{", b"[")
+
+
+def _iter_json_values(stream, array: bool):
+    """
+    Values of a top-level JSON array (array=True) or of whitespace-separated JSON values (NDJSON),
+    decoded one at a time from a binary stream.
+    """
+    if IJSON_AVAILABLE:
+        yield from ijson.items(stream, "item" if array else "", multiple_values=not array, use_float=True)
+        return
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, eof = "", 0, False
+    in_array = False
+    while True:
+        while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ",")):
+            pos += 1
+        if pos < len(buf) and array and not in_array:
+            if buf[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            in_array, pos = True, pos + 1
+            continue
+        if pos < len(buf) and in_array and buf[pos] == "]":
+            return
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            # a value ending exactly at the buffer end may be cut short (a number, say); read on first
+            if end is not None and (end < len(buf) or eof):
+                yield value
+                pos = end
+                continue
+            if eof:
+                raise ValueError(f"Invalid or truncated JSON: {buf[pos:pos + 80]!r}")
+        elif eof:
+            if array:
+                raise ValueError("Unterminated JSON array")
+            return
+        chunk = stream.read(_JSON_READ_BYTES)
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk or b"", final=eof)
+        pos = 0
+
+
+class _PrefixedStream:
+    """read(n) over bytes already taken from a stream, then the rest of that stream."""
+
+    def __init__(self, head: bytes, stream):
+        self._head, self._stream = head, stream
+
+    def read(self, n: int = -1) -> bytes:
+        if not self._head:
+            return self._stream.read(n)
+        if n is None or n < 0:
+            data, self._head = self._head + self._stream.read(), b""
+            return data
+        data, self._head = self._head[:n], self._head[n:]
+        return data
+
+
+def _json_records(stream, ndjson: bool = None):
+    """
+    (iterator over the records, None, ndjson) when the binary stream holds a top-level array or
+    NDJSON of at least JSON_STREAM_MIN_BYTES, else (None, the whole document as bytes, ndjson).
+    ndjson=None detects NDJSON from the first lines.
+    """
+    head = stream.read(_JSON_READ_BYTES)
+    if head.startswith(b"\xef\xbb\xbf"):
+        head = head[3:]
+    text = head.lstrip()
+    if ndjson is None:
+        ndjson = text.startswith((b"{", b"[")) and _looks_like_ndjson(text)
+    if not ndjson and not text.startswith(b"["):
+        return None, head + stream.read(), False
+    pieces, size = [head], len(head)
+    while size < JSON_STREAM_MIN_BYTES:
+        piece = stream.read(min(_JSON_READ_BYTES, JSON_STREAM_MIN_BYTES - size))
+        if not piece:
+            return None, b"".join(pieces), ndjson
+        pieces.append(piece)
+        size += len(piece)
+    stream = _PrefixedStream(b"".join(pieces), stream)
+    del pieces
+    return _iter_json_values(stream, array=not ndjson), None, ndjson
+
+
+def _json_document(document: bytes, ndjson: bool):
+    """The parsed document: a list of the values for NDJSON."""
+    if ndjson:
+        return list(_iter_json_values(BytesIO(document), array=False))
+    return json.loads(document)
+
+
+def _flatten_record(record: Dict[str, Any], prefix: str, out: Dict[str, Any]) -> None:
+    """Nested objects become "parent.child" columns, like pd.json_normalize; lists stay values."""
+    for key, value in record.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            _flatten_record(value, name + ".", out)
+        else:
+            out[name] = value
+
+
+def _read_json_date_column(name) -> bool:
+    """pd.read_json's keep_default_dates rule: the column names it tries to parse as dates."""
+    if not isinstance(name, str):
+        return False
+    lower = name.lower()
+    return (lower.endswith(("_at", "_time")) or lower in ("modified", "date", "datetime")
+            or lower.startswith("timestamp"))
+
+
+def _json_dates(column: pd.Series) -> Optional[pd.Series]:
+    """column as datetimes the way pd.read_json converts a date column (epoch numbers or date strings), or None."""
+    values = column
+    if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+        try:
+            values = column.astype("int64")
+        except OverflowError:
+            return None
+        except (TypeError, ValueError):
+            pass
+    if values.dtype.kind in "iuf" and not (values.isna() | (values > 31536000)).all():
+        return None  # numbers too small to be epoch seconds
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        if pd.api.types.is_string_dtype(values.dtype) and values.dtype != object:
+            for fmt in (None, "iso8601", "mixed"):
+                try:
+                    return pd.to_datetime(values, errors="raise", format=fmt)
+                except Exception:
+                    pass
+            return None
+        for unit in ("s", "ms", "us", "ns"):
+            try:
+                dates = pd.to_datetime(values, errors="raise", unit=unit)
+                dates.dt.as_unit("ns")
+                return dates
+            except pd.errors.OutOfBoundsDatetime:
+                continue
+            except (ValueError, OverflowError, TypeError):
+                pass
+    return None
+
+
+def _coerce_like_read_json(name, column: pd.Series) -> pd.Series:
+    """The dtype and date inference pd.read_json (dtype=True, convert_dates=True) applies to each column."""
+    if not len(column):
+        return column
+    if _read_json_date_column(name):
+        dates = _json_dates(column)
+        if dates is not None:
+            return dates
+    values = column
+    if pd.api.types.is_string_dtype(values.dtype):
+        try:
+            values = values.astype("float64")
+        except (TypeError, ValueError):
+            pass
+    if values.dtype == "float64" or values.dtype == object:
+        try:
+            ints = column.astype("int64")
+            if (ints == values).all():
+                values = ints
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return values
+
+
+def _missing_values(n: int) -> pd.Series:
+    return pd.Series(np.full(n, np.nan))
+
+
+def records_to_dataframe(records, chunk_rows: int = None, like_read_json: bool = False) -> pd.DataFrame:
+    """
+    Build a DataFrame from an iterator of JSON records, JSON_CHUNK_ROWS records at a time. Nested
+    objects are flattened like pd.json_normalize, or, with like_read_json, kept as values and the
+    columns given pd.read_json's dtype and date inference. Columns keep the order their keys are
+    first seen in (missing earlier, so NaN there). Records that are not objects (arrays, scalars)
+    give positional columns, like pd.DataFrame.
+    Each chunk becomes one array per column; the arrays of a column are joined, and freed, one
+    column at a time, so the peak stays near the size of the result plus one column.
+    """
+    chunk_rows = chunk_rows or JSON_CHUNK_ROWS
+    parts: Dict[Any, List[pd.Series]] = {}  # insertion order is the column order
+    rows = 0
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_rows))
+        if not chunk:
+            break
+        n = len(chunk)
+        if all(isinstance(r, dict) for r in chunk):
+            columns: Dict[Any, list] = {}
+            for i, record in enumerate(chunk):
+                flat = record
+                if not like_read_json:
+                    flat = {}
+                    _flatten_record(record, "", flat)
+                for name, value in flat.items():
+                    column = columns.get(name)
+                    if column is None:
+                        column = columns[name] = [None] * i
+                    column.append(value)
+                for column in columns.values():
+                    if len(column) <= i:
+                        column.append(None)
+            pieces = {name: pd.Series(values) for name, values in columns.items()}
+        else:
+            frame = pd.DataFrame([r if isinstance(r, (dict, list)) else [r] for r in chunk])
+            pieces = {name: frame[name].copy() for name in frame.columns}
+        del chunk
+        for name, piece in pieces.items():
+            if name not in parts:
+                parts[name] = [_missing_values(rows)] if rows else []
+            parts[name].append(piece)
+        for name, column_parts in parts.items():
+            if name not in pieces:
+                column_parts.append(_missing_values(n))
+        rows += n
+        del pieces
+    if not parts:
+        return pd.DataFrame(index=pd.RangeIndex(rows))
+    out = {}
+    for name in list(parts):
+        column_parts = parts.pop(name)
+        column = column_parts[0] if len(column_parts) == 1 else pd.concat(column_parts, ignore_index=True)
+        del column_parts
+        if column.dtype == object:
+            column = column.infer_objects()
+        out[name] = _coerce_like_read_json(name, column) if like_read_json else column
+    return pd.DataFrame(out, copy=False)
+
+
+def _parse_uploaded_dataframe(filename: str, fileobj) -> pd.DataFrame:
+    """Parse an uploaded file object (possibly compressed) without reading it into memory first."""
+    from io import BytesIO
+
+    stream, name, fmt = _open_upload(fileobj, filename)
+    if fmt == "csv":
+        df = pd.read_csv(stream, sep="\t" if name.endswith(".tsv") else ",")
+    elif fmt == "excel":
+        df = pd.read_excel(stream)
+    elif fmt == "parquet":
+        df = pd.read_parquet(stream)
+    elif fmt == "json":
+        records, content, ndjson = _json_records(stream, ndjson=True if name.endswith(_NDJSON_SUFFIXES) else None)
+        if records is not None:
+            df = records_to_dataframe(records, like_read_json=True)
+        else:
+            try:
+                df = pd.read_json(BytesIO(content), lines=ndjson)
+            except ValueError:
+                df = pd.DataFrame(_json_document(content, ndjson))
+    elif fmt == "image":
+        content = stream.read()
+        try:
+            if PIL_AVAILABLE:
+                image = Image.open(BytesIO(content))
+                image = image.convert("RGB")  # ensure RGB format
+                df = pd.DataFrame({"image": [image]})
+            else:
+                raise HTTPException(400, "PIL not available for image processing")
+        except Exception as e:
+            raise HTTPException(400, f"Image processing failed: {str(e)}")
+    else:
+        raise HTTPException(400, f"Unsupported data file type: {filename}")
+    return df
+
+
+def _store_dataset(dataset_hash: str, df: pd.DataFrame):
     """
-    1. Run the agent_executor.invoke to get LLM output
-    2. Extract JSON, get 'code' and 'questions'
-    3. Detect scrape_url_to_dataframe("...") calls in code, run them here, pickle df and inject before exec
-    4. Execute the code in a temp file and return results mapping questions -> answers
+    Write df once for injection into the sandbox: an Arrow IPC file when Arrow holds it faithfully
+    (the hot tier then promotes it by copying the file, and sandboxes map it without unpickling),
+    else a pickle. Published to the shared dataset cache when possible.
+    Returns (path, table); table is the Arrow conversion, reusable for other copies, or None.
     """
+    table = _arrow_table(df) if PYARROW_AVAILABLE else None
+    suffix = ".arrow" if table is not None else ".pkl"
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    if table is not None:
+        _write_arrow_file(table, tmp_path)
+    else:
+        df.to_pickle(tmp_path)
     try:
-        response = agent_executor.invoke({"input": llm_input}, {"timeout": LLM_TIMEOUT_SECONDS})
-        raw_out = response.get("output") or response.get("final_output") or response.get("text") or ""
-        if not raw_out:
-            return {"error": f"Agent returned no output. Full response: {response}"}
-
-        parsed = clean_llm_output(raw_out)
-        if "error" in parsed:
-            return parsed
+        return dataset_cache.put_file(dataset_hash, tmp_path, suffix), table
+    except Exception as e:
+        logger.warning(f"Could not cache dataset {dataset_hash[:12]}: {e}")
+        return tmp_path, table
 
-        if not isinstance(parsed, dict) or "code" not in parsed or "questions" not in parsed:
-            return {"error": f"Invalid agent response format: {parsed}"}
 
-        code = parsed["code"]
-        questions: List[str] = parsed["questions"]
+def _cached_dataset_path(dataset_hash: str) -> Optional[str]:
+    return dataset_cache.get_path(dataset_hash, ".arrow") or dataset_cache.get_path(dataset_hash, ".pkl")
 
-        # Detect scrape calls; find all URLs used in scrape_url_to_dataframe("URL")
-        urls = re.findall(r"scrape_url_to_dataframe\(\s*['\"](.*?)['\"]\s*\)", code)
-        pickle_path = None
-        if urls:
-            # For now support only the first URL (agent may code multiple scrapes; you can extend this)
-            url = urls[0]
-            tool_resp = scrape_url_to_dataframe(url)
-            if tool_resp.get("status") != "success":
-                return {"error": f"Scrape tool failed: {tool_resp.get('message')}"}
-            # create df and pickle it
-            df = pd.DataFrame(tool_resp["data"])
-            temp_pkl = tempfile.NamedTemporaryFile(suffix=".pkl", delete=False)
-            temp_pkl.close()
-            df.to_pickle(temp_pkl.name)
-            pickle_path = temp_pkl.name
-            # Make sure agent's code can reference df/data: we will inject the pickle loader in the temp script
 
-        # Execute code in temp python script
-        exec_result = write_and_run_temp_python(code, injected_pickle=pickle_path, timeout=LLM_TIMEOUT_SECONDS)
-        if exec_result.get("status") != "success":
-            return {"error": f"Execution failed: {exec_result.get('message', exec_result)}", "raw": exec_result.get("raw")}
+def _cache_parsed_dataset(dataset_hash: str, df: pd.DataFrame, df_preview: str) -> str:
+    """Store df for injection into the sandbox (see _store_dataset) with its preview, column list and parquet copy."""
+    path, table = _store_dataset(dataset_hash, df)
+    try:
+        dataset_cache.put_bytes(dataset_hash, df_preview.encode("utf-8"), ".preview.txt")
+        if all(isinstance(c, str) for c in df.columns):
+            dataset_cache.put_bytes(dataset_hash, json.dumps(list(df.columns)).encode("utf-8"), ".columns.json")
+        _write_parquet_copy(dataset_hash, df, table)
+    except Exception as e:
+        logger.warning(f"Could not cache dataset {dataset_hash[:12]}: {e}")
+    return path
 
-        # exec_result['result'] should be results dict
-        results_dict = exec_result.get("result", {})
-        # Map to original questions (they asked to use exact question strings)
-        output = {}
-        for q in questions:
-            output[q] = results_dict.get(q, "Answer not found")
-        return output
 
+def _write_parquet_copy(dataset_hash: str, df: pd.DataFrame, table=None) -> None:
+    """Parquet copy of a large dataset, so projected loads can skip columns and row groups."""
+    if not (PROJECTION_ENABLED and PYARROW_AVAILABLE) or df.size < PARQUET_COPY_MIN_CELLS:
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        if table is not None:
+            # reuse the conversion already done for the Arrow copy
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp_path, row_group_size=PARQUET_ROW_GROUP_ROWS)
+        else:
+            df.to_parquet(tmp_path, engine="pyarrow", row_group_size=PARQUET_ROW_GROUP_ROWS)
     except Exception as e:
-        logger.exception("run_agent_safely failed")
-        return {"error": str(e)}
+        # object columns with mixed types, images, ... : projected loads use the pickle
+        logger.info(f"No parquet copy for {dataset_hash[:12]}: {e}")
+        os.unlink(tmp_path)
+        return
+    dataset_cache.put_file(dataset_hash, tmp_path, ".parquet")
 
 
-from fastapi import Request
+def _dataset_columns(dataset_hash: str) -> Optional[List[str]]:
+    raw = dataset_cache.get_bytes(dataset_hash, ".columns.json")
+    return json.loads(raw) if raw is not None else None
 
-@app.post("/api")
-async def analyze_data(request: Request):
-    try:
-        form = await request.form()
-        questions_file = None
-        data_file = None
-
-        for key, val in form.items():
-            if hasattr(val, "filename") and val.filename:  # it's a file
-                fname = val.filename.lower()
-                if fname.endswith(".txt") and questions_file is None:
-                    questions_file = val
-                else:
-                    data_file = val
 
-        if not questions_file:
-            raise HTTPException(400, "Missing questions file (.txt)")
+def _request_flag(request: Request, form, name: str, default: bool = False) -> bool:
+    """Read an opt-in switch from the query string or a plain (non-file) form field."""
+    raw = request.query_params.get(name)
+    if raw is None:
+        val = form.get(name) if form is not None else None
+        raw = val if isinstance(val, str) else None
+    if raw is None:
+        return default
+    return raw.strip().lower() in ("1", "true", "yes", "on")
 
-        raw_questions = (await questions_file.read()).decode("utf-8")
-        keys_list, type_map = parse_keys_and_types(raw_questions)
 
-        pickle_path = None
-        df_preview = ""
-        dataset_uploaded = False
-
-        if data_file:
-            dataset_uploaded = True
-            filename = data_file.filename.lower()
-            content = await data_file.read()
-            from io import BytesIO
-
-            if filename.endswith(".csv"):
-                df = pd.read_csv(BytesIO(content))
-            elif filename.endswith((".xlsx", ".xls")):
-                df = pd.read_excel(BytesIO(content))
-            elif filename.endswith(".parquet"):
-                df = pd.read_parquet(BytesIO(content))
-            elif filename.endswith(".json"):
-                try:
-                    df = pd.read_json(BytesIO(content))
-                except ValueError:
-                    df = pd.DataFrame(json.loads(content.decode("utf-8")))
-            elif filename.endswith(".png") or filename.endswith(".jpg") or filename.endswith(".jpeg"):
-                try:
-                    if PIL_AVAILABLE:
-                        image = Image.open(BytesIO(content))
-                        image = image.convert("RGB")  # ensure RGB format
-                        df = pd.DataFrame({"image": [image]})
-                    else:
-                        raise HTTPException(400, "PIL not available for image processing")
-                except Exception as e:
-                    raise HTTPException(400, f"Image processing failed: {str(e)}")  
-            else:
-                raise HTTPException(400, f"Unsupported data file type: {filename}")
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
 
-            # Pickle for injection
-            temp_pkl = tempfile.NamedTemporaryFile(suffix=".pkl", delete=False)
-            temp_pkl.close()
-            df.to_pickle(temp_pkl.name)
-            pickle_path = temp_pkl.name
 
+def _wants_stream(request: Request) -> bool:
+    if "text/event-stream" in request.headers.get("accept", "").lower():
+        return True
+    return _request_flag(request, None, "stream")
+
+
+async def _prepare_analysis(request: Request, progress=None) -> Dict[str, Any]:
+    """Read the form, parse/cached-load the dataset and build the LLM input. Raises HTTPException on bad input."""
+    progress = progress or (lambda event, data=None: None)
+    # the request's whole budget starts now; parsing the upload already spends from it
+    deadline = Deadline(LLM_TIMEOUT_SECONDS)
+    form = await request.form()
+    questions_file = None
+    data_file = None
+
+    for key, val in form.items():
+        if hasattr(val, "filename") and val.filename:  # it's a file
+            fname = val.filename.lower()
+            if fname.endswith(".txt") and questions_file is None:
+                questions_file = val
+            else:
+                data_file = val
+
+    if not questions_file:
+        raise HTTPException(400, "Missing questions file (.txt)")
+
+    raw_questions = (await questions_file.read()).decode("utf-8")
+    keys_list, type_map = parse_keys_and_types(raw_questions)
+    parallel = _request_flag(request, form, "parallel", PARALLEL_QUESTIONS_DEFAULT)
+    profile = _request_flag(request, form, "profile")
+    approx_requested = _request_flag(request, form, "approx")
+    split = _request_flag(request, form, "split", CODEGEN_SPLIT_DEFAULT)
+    progress("parsed", {"keys": keys_list, "dataset": data_file.filename if data_file else None})
+
+    pickle_path = None
+    dataset_hash = None
+    hot_dataset = None
+    approx = None
+    columns = None
+    parquet_path = None
+    df = None
+    df_preview = ""
+    dataset_uploaded = False
+
+    if data_file:
+        dataset_uploaded = True
+        filename = data_file.filename.lower()
+        # the upload is already spooled to disk; hash and parse it in chunks off the event loop
+        loop = asyncio.get_running_loop()
+        dataset_hash = await loop.run_in_executor(None, _hash_upload, data_file.file, os.path.splitext(filename)[1])
+
+        # Another request (possibly in another worker) may already have parsed these exact bytes
+        pickle_path = _cached_dataset_path(dataset_hash)
+        cached_preview = dataset_cache.get_bytes(dataset_hash, ".preview.txt")
+        if pickle_path and cached_preview is not None:
+            df_preview = cached_preview.decode("utf-8")
+        else:
+            try:
+                df = await loop.run_in_executor(None, _parse_uploaded_dataframe, filename, data_file.file)
+            except (EOFError, OSError, zlib.error, lzma.LZMAError, zipfile.BadZipFile) as e:
+                raise HTTPException(400, f"Could not decompress {data_file.filename}: {e}")
             df_preview = (
                 f"\n\nThe uploaded dataset has {len(df)} rows and {len(df.columns)} columns.\n"
                 f"Columns: {', '.join(df.columns.astype(str))}\n"
                 f"First rows:\n{df.head(5).to_markdown(index=False)}\n"
             )
-
-        # Build rules based on data presence
-        if dataset_uploaded:
-            llm_rules = (
-                "Rules:\n"
-                "1) You have access to a pandas DataFrame called `df` and its dictionary form `data`.\n"
-                "2) DO NOT call scrape_url_to_dataframe() or fetch any external data.\n"
-                "3) Use only the uploaded dataset for answering questions.\n"
-                "4) Produce a final JSON object with keys:\n"
-                '   - "questions": [ ... original question strings ... ]\n'
-                '   - "code": "..."  (Python code that fills `results` with exact question strings as keys)\n'
-                "5) For plots: use plot_to_base64() helper to return base64 image data under 100kB.\n"
-            )
-        else:
-            llm_rules = (
-                "Rules:\n"
-                "1) If you need web data, CALL scrape_url_to_dataframe(url).\n"
-                "2) Produce a final JSON object with keys:\n"
-                '   - "questions": [ ... original question strings ... ]\n'
-                '   - "code": "..."  (Python code that fills `results` with exact question strings as keys)\n'
-                "3) For plots: use plot_to_base64() helper to return base64 image data under 100kB.\n"
-            )
-
-        llm_input = (
-            f"{llm_rules}\nQuestions:\n{raw_questions}\n"
+            pickle_path = await loop.run_in_executor(None, _cache_parsed_dataset, dataset_hash, df, df_preview)
+        if PROJECTION_ENABLED:
+            columns = _dataset_columns(dataset_hash)
+            parquet_path = dataset_cache.get_path(dataset_hash, ".parquet")
+        if approx_requested:
+            try:
+                sampled = await loop.run_in_executor(None, partial(approx_sample_for, dataset_hash,
+                                                                   df=df, pickle_path=pickle_path))
+            except Exception as e:
+                logger.warning(f"Could not sample {dataset_hash[:12]}, answering exactly: {e}")
+                sampled = None
+            if sampled:
+                # from here on the job runs against the sample (its own hash, pickle and hot segment)
+                dataset_hash, pickle_path, approx = sampled
+                parquet_path = None
+                df = None
+                progress("sampled", {"sample_rows": approx["sample_rows"],
+                                     "population_rows": approx["population_rows"],
+                                     "method": approx["method"]})
+        if hot_tier is not None:
+            try:
+                hot_dataset = await loop.run_in_executor(None, partial(hot_tier.acquire, dataset_hash,
+                                                                       df=df, pickle_path=pickle_path))
+            except Exception as e:
+                logger.warning(f"Hot tier unavailable for {dataset_hash[:12]}: {e}")
+        progress("preview_built", {"dataset_hash": dataset_hash, "hot": hot_dataset is not None})
+
+    # Build rules based on data presence
+    if dataset_uploaded:
+        llm_rules = (
+            "Rules:\n"
+            "1) You have access to a pandas DataFrame called `df` and its dictionary form `data`.\n"
+            "2) DO NOT call scrape_url_to_dataframe() or fetch any external data.\n"
+            "3) Use only the uploaded dataset for answering questions.\n"
+            "4) Produce a final JSON object with keys:\n"
+            '   - "questions": [ ... original question strings ... ]\n'
+            '   - "code": "..."  (Python code that fills `results` with exact question strings as keys)\n'
+            "5) For plots: use plot_to_base64() helper to return base64 image data under 100kB.\n"
+        )
+        llm_rules += LARGE_PLOT_RULES
+    else:
+        llm_rules = (
+            "Rules:\n"
+            "1) If you need web data, CALL scrape_url_to_dataframe(url).\n"
+            "2) Produce a final JSON object with keys:\n"
+            '   - "questions": [ ... original question strings ... ]\n'
+            '   - "code": "..."  (Python code that fills `results` with exact question strings as keys)\n'
+            "3) For plots: use plot_to_base64() helper to return base64 image data under 100kB.\n"
+        )
+    if parallel:
+        llm_rules += PARALLEL_CELLS_RULES
+    if approx:
+        llm_rules += approx_rules(approx)
+
+    llm_input = (
+        f"{llm_rules}\nQuestions:\n{raw_questions}\n"
+        f"{df_preview if df_preview else ''}"
+        "Respond with the JSON object only."
+    )
+    codegen_groups = split_questions(raw_questions, CODEGEN_GROUP_SIZE) if split else None
+    for group in codegen_groups or []:
+        # every group shares the rules and the dataset preview
+        group["input"] = (
+            f"{llm_rules}{CODEGEN_GROUP_RULES}\nQuestions:\n{group['text']}\n"
             f"{df_preview if df_preview else ''}"
             "Respond with the JSON object only."
         )
+    return {
+        "llm_input": llm_input,
+        "pickle_path": pickle_path,
+        "dataset_hash": dataset_hash,
+        "hot_dataset": hot_dataset,
+        "parallel": parallel,
+        "profile": profile,
+        "approx": approx,
+        "columns": columns,
+        "parquet_path": parquet_path,
+        "codegen_groups": codegen_groups,
+        "keys_list": keys_list,
+        "type_map": type_map,
+        "deadline": deadline,
+    }
 
-        # Run agent
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor() as ex:
-            fut = ex.submit(run_agent_safely_unified, llm_input, pickle_path)
+
+def _apply_key_types(result: Dict[str, Any], keys_list: List[str], type_map: Dict[str, Any]) -> Dict[str, Any]:
+    """Post-process key mapping & type casting: i-th answer -> i-th declared key, cast to its declared type."""
+    if not (keys_list and type_map):
+        return result
+    mapped = {}
+    for idx, q in enumerate(result.keys()):
+        if idx < len(keys_list):
+            key = keys_list[idx]
+            caster = type_map.get(key, str)
             try:
-                result = fut.result(timeout=LLM_TIMEOUT_SECONDS)
-            except concurrent.futures.TimeoutError:
-                raise HTTPException(408, "Processing timeout")
-
-        if "error" in result:
-            raise HTTPException(500, detail=result["error"])
-
-        # Post-process key mapping & type casting
-        if keys_list and type_map:
-            mapped = {}
-            for idx, q in enumerate(result.keys()):
-                if idx < len(keys_list):
-                    key = keys_list[idx]
-                    caster = type_map.get(key, str)
-                    try:
-                        val = result[q]
-                        if isinstance(val, str) and val.startswith("data:image/"):
-                            # Remove data URI prefix
-                            val = val.split(",", 1)[1] if "," in val else val
-                        mapped[key] = caster(val) if val not in (None, "") else val
-                    except Exception:
-                        mapped[key] = result[q]
-            result = mapped
+                val = result[q]
+                if isinstance(val, str) and val.startswith("data:image/"):
+                    # Remove data URI prefix
+                    val = val.split(",", 1)[1] if "," in val else val
+                mapped[key] = caster(val) if val not in (None, "") else val
+            except Exception:
+                mapped[key] = result[q]
+    return mapped
+
+
+async def _execute_analysis(job: Dict[str, Any], progress=None) -> Dict[str, Any]:
+    """
+    Run the agent + sandbox off the event loop and return the typed payload. Waits only for what
+    is left of the request's deadline; on timeout (or when the caller is cancelled, e.g. the SSE
+    client went away) the deadline is cancelled so the abandoned worker stops and its sandbox is killed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = job.get("deadline") or Deadline(LLM_TIMEOUT_SECONDS)
+    if deadline.expired:
+        raise HTTPException(408, "Processing timeout")
+    fut = loop.run_in_executor(None, partial(
+        run_agent_safely_unified, job["llm_input"], job["pickle_path"], job["parallel"], job["dataset_hash"],
+        progress=progress, hot_dataset=job.get("hot_dataset"), profile=job.get("profile", False),
+        approx=job.get("approx"), columns=job.get("columns"), parquet_path=job.get("parquet_path"),
+        codegen_groups=job.get("codegen_groups"), deadline=deadline,
+    ))
+    result = None
+    try:
+        result = await asyncio.wait_for(fut, timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        metrics.inc("deadline.exceeded")
+        raise HTTPException(408, "Processing timeout")
+    finally:
+        if result is None:
+            # wait_for has given up on the worker thread (it cannot be interrupted); make it stop instead
+            deadline.cancel()
+        if job.get("hot_dataset") and hot_tier is not None:
+            # the sandbox has mapped the segment (or given up) by the time the agent returns or times out
+            hot_tier.release(job["dataset_hash"])
+
+    if "error" in result:
+        if deadline.expired:
+            # a stage gave up because the budget ran out just before wait_for did
+            metrics.inc("deadline.exceeded")
+            raise HTTPException(408, "Processing timeout")
+        raise HTTPException(500, detail=result["error"])
+    profile = result.pop("_profile", None)
+    approximate = result.pop("_approximate", None)
+    questions = list(result.keys())
+    result = _apply_key_types(result, job["keys_list"], job["type_map"])
+    if profile is not None:
+        result["_profile"] = profile
+    if approximate is not None:
+        # intervals are keyed like the answers they belong to
+        renamed = dict(zip(questions, result.keys())) if list(result.keys()) != questions else {}
+        approximate["intervals"] = {renamed.get(q, q): iv for q, iv in approximate.get("intervals", {}).items()}
+        result["_approximate"] = approximate
+    return result
+
+
+# ---- Single-flight: identical concurrent requests share one run ----
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT", "1") != "0"
+_in_flight: Dict[str, Dict[str, Any]] = {}
+
+
+def _job_key(job: Dict[str, Any]) -> str:
+    """Same questions (the LLM input embeds them and the preview), same dataset bytes, same flags."""
+    flags = {
+        "parallel": bool(job.get("parallel")), "profile": bool(job.get("profile")),
+        "approx": bool(job.get("approx")), "split": bool(job.get("codegen_groups")),
+    }
+    h = hashlib.sha256()
+    for part in (job["llm_input"], job.get("dataset_hash") or "", json.dumps(flags, sort_keys=True)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _discard_job(job: Dict[str, Any]) -> None:
+    """Give back what _prepare_analysis took for a job that will not run."""
+    if job.get("hot_dataset") and hot_tier is not None:
+        hot_tier.release(job["dataset_hash"])
+    _remove_injected_pickle(job.get("pickle_path"))
+
+
+async def _execute_coalesced(job: Dict[str, Any], progress=None) -> Dict[str, Any]:
+    """
+    _execute_analysis, except that a request identical to one already running in this worker waits
+    for that run and gets a copy of its result (or its error) instead of starting its own. The run
+    is a task of its own, so it survives the request that started it going away; it is cancelled
+    only when every request waiting for it has gone. Progress events are sent to every waiter
+    from the moment it joined.
+    """
+    if not SINGLE_FLIGHT_ENABLED:
+        return await _execute_analysis(job, progress)
+    key = _job_key(job)
+    flight = _in_flight.get(key)
+    if flight is None:
+        listeners = []
+
+        def broadcast(event, data=None):
+            for listener in list(listeners):
+                listener(event, data)
+
+        flight = {"listeners": listeners, "waiters": 0,
+                  "task": asyncio.ensure_future(_execute_analysis(job, broadcast))}
+        _in_flight[key] = flight
+        flight["task"].add_done_callback(lambda _: _in_flight.pop(key, None) if _in_flight.get(key) is flight else None)
+    else:
+        metrics.inc("singleflight.coalesced")
+        logger.info(f"Coalescing request into in-flight analysis {key[:12]}")
+        _discard_job(job)
+        if progress is not None:
+            progress("coalesced", {"waiters": flight["waiters"] + 1})
+
+    if progress is not None:
+        flight["listeners"].append(progress)
+    flight["waiters"] += 1
+    try:
+        result = await asyncio.shield(flight["task"])
+    finally:
+        flight["waiters"] -= 1
+        if progress is not None:
+            flight["listeners"].remove(progress)
+        if flight["waiters"] == 0 and not flight["task"].done():
+            # forget the flight now, not when the task has finished cancelling, so an identical
+            # request arriving meanwhile starts a run of its own instead of joining this one
+            if _in_flight.get(key) is flight:
+                _in_flight.pop(key)
+            flight["task"].cancel()
+    # every waiter post-processes (blob refs, multipart) its own copy
+    return copy.deepcopy(result)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# ---- Image-heavy responses: multipart parts or blob references instead of inline base64 ----
+BLOB_TTL_SECONDS = int(os.getenv("BLOB_TTL_SECONDS", 600))
+blob_store = SharedCache("blobs", BLOB_TTL_SECONDS, int(os.getenv("BLOB_STORE_MAX_MB", 256)) * 1024 * 1024)
+BLOBREF_MEDIA_TYPE = "application/vnd.tdata.blobref+json"
+_IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+
+
+def _image_mode(request: Request) -> str:
+    """
+    "json" (default: images inline as base64), "multipart" (Accept: multipart/mixed) or
+    "ref" (Accept: application/vnd.tdata.blobref+json); ?images=json|multipart|ref overrides.
+    """
+    mode = (request.query_params.get("images") or "").strip().lower()
+    if mode in ("json", "multipart", "ref"):
+        return mode
+    accept = request.headers.get("accept", "").lower()
+    if "multipart/mixed" in accept:
+        return "multipart"
+    if BLOBREF_MEDIA_TYPE in accept:
+        return "ref"
+    return "json"
+
+
+def _decode_image(value: str):
+    """(raw bytes, media type) for a base64 / data-URI image string, or None if it is not one."""
+    mime = None
+    if value.startswith("data:image/"):
+        header, _, value = value.partition(",")
+        mime = header[5:].split(";")[0]
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except Exception:
+        return None
+    if raw.startswith(b"\x89PNG"):
+        mime = mime or "image/png"
+    elif raw.startswith(b"\xff\xd8\xff"):
+        mime = mime or "image/jpeg"
+    elif raw.startswith(b"GIF8"):
+        mime = mime or "image/gif"
+    elif raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
+        mime = mime or "image/webp"
+    elif mime is None:
+        return None
+    return raw, mime
+
+
+def _replace_images(value: Any, replace) -> Any:
+    """Copy of value (answers, possibly nested) with every image string swapped for replace(raw, mime)."""
+    if isinstance(value, dict):
+        return {k: _replace_images(v, replace) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_replace_images(v, replace) for v in value]
+    if _looks_like_image(value):
+        decoded = _decode_image(value)
+        if decoded is not None:
+            return replace(*decoded)
+    return value
+
+
+def _store_blob(raw: bytes, mime: str) -> str:
+    """Put an image in the blob store; returns its /blobs/ path (content-addressed, so repeats are free)."""
+    blob_id = hashlib.sha256(raw).hexdigest()[:24] + _IMAGE_EXTENSIONS.get(mime, ".bin")
+    if blob_store.get_path(blob_id) is None:
+        blob_store.put_bytes(blob_id, raw)
+    return f"/blobs/{blob_id}"
+
+
+def _with_blob_refs(result: Dict[str, Any]) -> Dict[str, Any]:
+    return _replace_images(result, _store_blob)
+
+
+def _multipart_response(result: Dict[str, Any]) -> StreamingResponse:
+    """
+    multipart/mixed: a JSON part (images replaced by "cid:<content-id>") followed by one raw part
+    per image with a matching Content-ID.
+    """
+    images = []
+
+    def to_part(raw, mime):
+        cid = f"img-{len(images)}"
+        images.append((cid, raw, mime))
+        return f"cid:{cid}"
+
+    body = json.dumps(_replace_images(result, to_part), default=str).encode("utf-8")
+    boundary = hashlib.sha256(os.urandom(16)).hexdigest()[:32]
 
+    def parts():
+        yield (f"--{boundary}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\n\r\n").encode("ascii") + body + b"\r\n"
+        for cid, raw, mime in images:
+            yield (f"--{boundary}\r\nContent-Type: {mime}\r\nContent-ID: <{cid}>\r\n"
+                   f"Content-Length: {len(raw)}\r\n\r\n").encode("ascii")
+            yield raw
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode("ascii")
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+async def _stream_analysis(request: Request):
+    """
+    Server-sent events for /api?stream=1 (or Accept: text/event-stream):
+    accepted -> parsed -> [sampled] -> preview_built -> [coalesced, when an identical request is already
+    running: the events below then come from that run] -> [llm_group_done per group with ?split=1] -> llm_done
+    -> executing -> answer (one per question, as soon as it is known) -> result (the typed payload,
+    same as the JSON response) | error.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def progress(event, data=None):
+        loop.call_soon_threadsafe(queue.put_nowait, (event, data or {}))
+
+    async def produce():
+        try:
+            job = await _prepare_analysis(request, progress)
+            result = await _execute_coalesced(job, progress)
+            progress("result", _with_blob_refs(result) if _image_mode(request) == "ref" else result)
+        except HTTPException as he:
+            progress("error", {"status_code": he.status_code, "detail": he.detail})
+        except Exception as e:
+            logger.exception("streamed analyze_data failed")
+            progress("error", {"status_code": 500, "detail": str(e)})
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, (None, None))
+
+    task = asyncio.create_task(produce())
+    try:
+        yield _sse("accepted", {"server_time": datetime.utcnow().isoformat() + "Z"})
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # comment line keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                break
+            yield _sse(event, data)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+@app.post("/api")
+async def analyze_data(request: Request):
+    if _wants_stream(request):
+        # Read the whole body before the response starts: from then on Starlette listens for the
+        # client disconnecting on the same receive channel, racing the multipart parser for the body.
+        # Request caches the parsed form, so _prepare_analysis reuses it.
+        await request.form()
+        return StreamingResponse(
+            _stream_analysis(request),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    try:
+        job = await _prepare_analysis(request)
+        result = await _execute_coalesced(job)
+        mode = _image_mode(request)
+        if mode == "multipart":
+            return _multipart_response(result)
+        if mode == "ref":
+            return JSONResponse(content=_with_blob_refs(result), media_type=BLOBREF_MEDIA_TYPE)
         return JSONResponse(content=result)
 
     except HTTPException as he:
@@ -698,34 +4296,233 @@ async def analyze_data(request: Request):
         raise HTTPException(500, detail=str(e))
 
 
-def run_agent_safely_unified(llm_input: str, pickle_path: str = None) -> Dict:
+def _apply_perf_lint(parsed: Dict[str, Any], llm_input: str) -> Dict[str, Any]:
+    """
+    Auto-fix the safe performance anti-patterns in the agent's code; if unfixable ones remain,
+    give the model targeted feedback for one regeneration (keeping the original on any failure).
+    """
+    parsed, findings = _lint_plan(parsed)
+    unfixed = [f for f in findings if not f["fixed"]]
+    if findings:
+        logger.info(f"Performance lint: {len(findings)} finding(s), {len(unfixed)} unfixed")
+    if not unfixed or not PERF_LINT_FEEDBACK:
+        return parsed
+
+    metrics.inc("perf_lint.regenerations")
+    try:
+        response = agent_executor.invoke({"input": f"{llm_input}\n\n{_perf_feedback(parsed, unfixed)}"})
+        raw_out = response.get("output") or response.get("final_output") or response.get("text") or ""
+        regenerated = clean_llm_output(raw_out)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"Performance feedback regeneration failed: {e}")
+        return parsed
+    if not isinstance(regenerated, dict) or "error" in regenerated \
+            or ("code" not in regenerated and "cells" not in regenerated):
+        return parsed
+    regenerated["questions"] = parsed["questions"]
+    regenerated, _ = _lint_plan(regenerated)
+    metrics.inc("perf_lint.regenerations_accepted")
+    return regenerated
+
+
+def _generate_plan(llm_input: str, max_retries: int = 3) -> Dict[str, Any]:
+    """Agent call -> validated (and performance-linted) plan with "questions" and "code" or "cells", or {"error": ...}."""
+    raw_out = ""
+    for attempt in range(1, max_retries + 1):
+        # each retry's LLM calls get only what is left of the request's budget (LLMWithFallback._call)
+        response = agent_executor.invoke({"input": llm_input})
+        raw_out = response.get("output") or response.get("final_output") or response.get("text") or ""
+        if raw_out:
+            break
+    if not raw_out:
+        return {"error": f"Agent returned no output after {max_retries} attempts"}
+
+    parsed = clean_llm_output(raw_out)
+    if "error" in parsed:
+        return parsed
+
+    if ("code" not in parsed and "cells" not in parsed) or "questions" not in parsed:
+        return {"error": f"Invalid agent response: {parsed}"}
+    if "cells" in parsed and "code" not in parsed and not isinstance(parsed["cells"], list):
+        return {"error": f"Invalid agent response: cells must be a list, got {type(parsed['cells']).__name__}"}
+
+    if PERF_LINT_ENABLED:
+        parsed = _apply_perf_lint(parsed, llm_input)
+    return parsed
+
+
+# -----------------------------
+# Split code generation for long questions files
+# -----------------------------
+CODEGEN_SPLIT_DEFAULT = os.getenv("CODEGEN_SPLIT", "0") == "1"
+CODEGEN_GROUP_SIZE = int(os.getenv("CODEGEN_GROUP_SIZE", 5))
+CODEGEN_GROUP_ATTEMPTS = int(os.getenv("CODEGEN_GROUP_ATTEMPTS", 2))
+# concurrent agent calls; the quota coordinator spreads them over the keys
+CODEGEN_MAX_CONCURRENCY = int(os.getenv("CODEGEN_MAX_CONCURRENCY", max(2, len(GEMINI_KEYS))))
+
+_NUMBERED_QUESTION = re.compile(r"^[ \t]*(?:Q(?:uestion)?[ \t]*)?\d+[ \t]*[.):][ \t]+", re.IGNORECASE | re.MULTILINE)
+
+CODEGEN_GROUP_RULES = (
+    "Answer ONLY the numbered questions listed below; the request's other questions are answered separately "
+    "(ignore any answer keys that belong to them).\n"
+)
+
+
+def split_questions(raw_questions: str, group_size: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Split a questions file into groups of up to group_size numbered questions. Text before the
+    first question (context) and after the last one (answer format), separated from it by a blank
+    line, is shared by every group. Returns [{"text": ..., "labels": [...]}], or None when there
+    are fewer than two groups' worth of numbered questions.
+    """
+    starts = [m.start() for m in _NUMBERED_QUESTION.finditer(raw_questions)]
+    if len(starts) <= group_size:
+        return None
+    head = raw_questions[:starts[0]]
+    items = [raw_questions[a:b] for a, b in zip(starts, starts[1:] + [len(raw_questions)])]
+    tail = ""
+    blank = re.search(r"\n[ \t]*\n", items[-1])
+    if blank:
+        items[-1], tail = items[-1][:blank.start()] + "\n", items[-1][blank.end():]
+    groups = []
+    for i in range(0, len(items), group_size):
+        chunk = items[i:i + group_size]
+        groups.append({
+            "text": f"{head}{''.join(chunk).rstrip()}\n\n{tail}",
+            "labels": [_NUMBERED_QUESTION.sub("", it, count=1).strip() for it in chunk],
+        })
+    return groups
+
+
+def _generate_group(index: int, llm_input: str, progress, deadline: Deadline = None) -> Dict[str, Any]:
+    plan = {"error": "not generated"}
+    for attempt in range(1, CODEGEN_GROUP_ATTEMPTS + 1):
+        try:
+            with use_deadline(deadline):
+                plan = _generate_plan(llm_input)
+        except DeadlineExceeded as e:
+            plan = {"error": str(e)}
+            break
+        except Exception as e:
+            plan = {"error": str(e)}
+        if "error" not in plan:
+            break
+        logger.warning(f"Code generation for question group {index} failed (attempt {attempt}): {plan['error']}")
+    progress("llm_group_done", {"group": index, "ok": "error" not in plan})
+    return plan
+
+
+def _relabel_answers(answered: List[str], labels: List[str]) -> str:
+    """
+    Code run after a group's code: its answers, keyed by the questions the model listed, are moved
+    to the group's labels by position; answers beyond the labels are dropped.
+    """
+    renames = [(q, label) for q, label in zip(answered, labels) if q != label]
+    extras = [q for q in answered[len(labels):] if q not in labels]
+    if not renames and not extras:
+        return ""
+    return (
+        "\n# this group's answers under its own question labels\n"
+        f"_answers = {{_label: results.pop(_q) for _q, _label in {renames!r} if _q in results}}\n"
+        f"for _q in {extras!r}:\n"
+        "    results.pop(_q, None)\n"
+        "results.update(_answers)\n"
+    )
+
+
+def generate_plan_in_groups(groups: List[Dict[str, Any]], progress=None) -> Dict[str, Any]:
+    """
+    Generate code for every question group concurrently (a failed group is regenerated on its
+    own) and merge the fragments into one cells plan: one cell per group, carrying exactly that
+    group's labels whatever questions the model listed, so answers stay in the request's order
+    (see _apply_key_types). Questions of a group that still fails, or that the model left out,
+    are reported in "codegen_errors".
+    """
+    progress = progress or (lambda event, data=None: None)
+    deadline = current_deadline()
+    with ThreadPoolExecutor(max_workers=max(1, min(CODEGEN_MAX_CONCURRENCY, len(groups)))) as pool:
+        plans = list(pool.map(lambda ig: _generate_group(ig[0], ig[1]["input"], progress, deadline),
+                              enumerate(groups)))
+    if deadline is not None:
+        deadline.budget(stage="running the generated code")
+
+    questions, cells, errors = [], [], {}
+    for group, plan in zip(groups, plans):
+        if "error" in plan:
+            questions.extend(group["labels"])
+            errors.update({q: f"code generation failed: {plan['error']}" for q in group["labels"]})
+            continue
+        labels = group["labels"]
+        answered = [str(q) for q in plan["questions"]]
+        if len(answered) != len(labels):
+            logger.warning(f"Question group answered {len(answered)} question(s) for {len(labels)}; "
+                           "keeping the group's own questions")
+            errors.update({q: "code generation returned no answer for this question"
+                           for q in labels[len(answered):]})
+        if "code" in plan:
+            code = plan["code"]
+        else:
+            code = "\n".join([plan.get("setup") or ""] +
+                             [str(c.get("code", "")) for c in plan["cells"] if isinstance(c, dict)])
+        questions.extend(labels)
+        cells.append({"questions": list(labels), "code": code + _relabel_answers(answered, labels)})
+    if not cells:
+        return {"error": "Code generation failed for every question group: "
+                         + "; ".join(sorted(set(errors.values())))}
+    return {"questions": questions, "setup": "", "cells": cells, "codegen_errors": errors}
+
+
+def run_agent_safely_unified(llm_input: str, pickle_path: str = None, parallel: bool = False,
+                             dataset_hash: str = None, progress=None, hot_dataset: str = None,
+                             profile: bool = False, approx: Dict[str, Any] = None,
+                             columns: List[str] = None, parquet_path: str = None,
+                             codegen_groups: List[Dict[str, Any]] = None, deadline: Deadline = None) -> Dict:
     """
     Runs the LLM agent and executes code.
     - Retries up to 3 times if agent returns no output.
     - If pickle_path is provided, injects that DataFrame directly.
     - If no pickle_path, falls back to scraping when needed.
+    - If the agent returned "setup" + "cells" (parallel mode), runs each cell in its own
+      worker; questions whose cell failed get an "Error: ..." answer instead of failing the request.
+    - progress(event, data), if given, is told about each stage and each answer as soon as it is known.
+    - profile=True runs the code (cells sequentially) under the profiler and adds
+      "_profile": {"id": ..., "report": ...} to the output.
+    - approx (sample meta) means pickle_path is a sample of the dataset; the output gets
+      "_approximate": {population/sample sizes, "intervals": {question: confidence interval}}.
+    - columns (the dataset's column names) enables loading only the columns and rows the
+      generated code reads; parquet_path is the dataset's parquet copy, if it has one.
+    - codegen_groups (from split_questions, each with its own "input") generates code for the
+      groups concurrently and runs one cell per group; a group whose code could not be
+      generated gets "Error: ..." answers.
+    - deadline bounds every stage (agent calls, quota waits, scraping, the sandbox); once it has
+      passed or been cancelled, the remaining stages are skipped and the sandbox is killed.
     """
+    progress = progress or (lambda event, data=None: None)
+    # runs in an executor thread, which does not inherit the caller's context
+    deadline_token = _current_deadline.set(deadline)
     try:
-        max_retries = 3
-        raw_out = ""
-        for attempt in range(1, max_retries + 1):
-            response = agent_executor.invoke({"input": llm_input}, {"timeout": LLM_TIMEOUT_SECONDS})
-            raw_out = response.get("output") or response.get("final_output") or response.get("text") or ""
-            if raw_out:
-                break
-        if not raw_out:
-            return {"error": f"Agent returned no output after {max_retries} attempts"}
-
-        parsed = clean_llm_output(raw_out)
+        if codegen_groups:
+            parsed = generate_plan_in_groups(codegen_groups, progress)
+        else:
+            parsed = _generate_plan(llm_input)
         if "error" in parsed:
             return parsed
+        plan_errors = parsed.get("codegen_errors") or {}
 
-        if "code" not in parsed or "questions" not in parsed:
-            return {"error": f"Invalid agent response: {parsed}"}
-
-        code = parsed["code"]
         questions = parsed["questions"]
+        progress("llm_done", {"questions": questions})
+        cells = parsed.get("cells") if parallel or "code" not in parsed else None
+        if cells is not None:
+            if not isinstance(cells, list):
+                return {"error": f"Invalid agent response: cells must be a list, got {type(cells).__name__}"}
+            setup = parsed.get("setup") or ""
+            code = "\n".join([setup] + [str(c.get("code", "")) for c in cells if isinstance(c, dict)])
+        else:
+            code = parsed["code"]
 
+        source_hashes = {}
         if pickle_path is None:
             urls = re.findall(r"scrape_url_to_dataframe\(\s*['\"](.*?)['\"]\s*\)", code)
             if urls:
@@ -733,22 +4530,80 @@ def run_agent_safely_unified(llm_input: str, pickle_path: str = None) -> Dict:
                 tool_resp = scrape_url_to_dataframe(url)
                 if tool_resp.get("status") != "success":
                     return {"error": f"Scrape tool failed: {tool_resp.get('message')}"}
+                source_hashes[url] = hashlib.sha256(
+                    json.dumps(tool_resp["data"], sort_keys=True, default=str).encode("utf-8")
+                ).hexdigest()
                 df = pd.DataFrame(tool_resp["data"])
                 temp_pkl = tempfile.NamedTemporaryFile(suffix=".pkl", delete=False)
                 temp_pkl.close()
                 df.to_pickle(temp_pkl.name)
                 pickle_path = temp_pkl.name
-
-        exec_result = write_and_run_temp_python(code, injected_pickle=pickle_path, timeout=LLM_TIMEOUT_SECONDS)
+                progress("scraped", {"url": url, "rows": len(df)})
+
+        def answer_for(q, results_dict, errors):
+            return results_dict.get(q, f"Error: {errors[q]}" if q in errors else "Answer not found")
+
+        announced = set()
+
+        def on_cell(outcome):
+            for q in outcome.get("questions", []):
+                if q in questions and q not in announced:
+                    announced.add(q)
+                    errors = {} if outcome.get("status") == "success" else {q: outcome.get("message")}
+                    progress("answer", {"question": q, "answer": answer_for(q, outcome.get("result") or {}, errors)})
+
+        projection = None
+        if pickle_path and columns and PROJECTION_ENABLED:
+            projection = analyze_df_usage(code, columns)
+            metrics.inc("projection.applied" if projection else "projection.full_load")
+            if projection:
+                if approx:
+                    projection["columns"].append(APPROX_STRATUM_COLUMN)
+                logger.info(f"Loading {len(projection['columns'])}/{len(columns)} columns, "
+                            f"{len(projection['filters'])} pushed-down filter(s)")
+
+        if profile:
+            # per-cell forking would hide the work from the profiler; run setup + cells as one script
+            cells = None
+        progress("executing", {"mode": "parallel" if cells is not None else "single", "profile": profile})
+        if cells is not None:
+            exec_result = write_and_run_parallel_cells(setup, [c for c in cells if isinstance(c, dict)],
+                                                       injected_pickle=pickle_path, timeout=LLM_TIMEOUT_SECONDS,
+                                                       dataset_hash=dataset_hash, source_hashes=source_hashes,
+                                                       on_cell=on_cell, hot_dataset=hot_dataset, approx=approx,
+                                                       projection=projection, parquet_path=parquet_path)
+        else:
+            exec_result = write_and_run_temp_python(code, injected_pickle=pickle_path, timeout=LLM_TIMEOUT_SECONDS,
+                                                    dataset_hash=dataset_hash, source_hashes=source_hashes,
+                                                    hot_dataset=hot_dataset, profile=profile, approx=approx,
+                                                    projection=projection, parquet_path=parquet_path)
         if exec_result.get("status") != "success":
-            return {"error": f"Execution failed: {exec_result.get('message')}", "raw": exec_result.get("raw")}
+            message = exec_result.get("message")
+            if exec_result.get("profile_id"):
+                message = f"{message} (profile: /profiles/{exec_result['profile_id']})"
+            return {"error": f"Execution failed: {message}", "raw": exec_result.get("raw")}
 
         results_dict = exec_result.get("result", {})
-        return {q: results_dict.get(q, "Answer not found") for q in questions}
+        errors = {**plan_errors, **(exec_result.get("errors") or {})}
+        output = {q: answer_for(q, results_dict, errors) for q in questions}
+        for q in questions:
+            if q not in announced:
+                progress("answer", {"question": q, "answer": output[q]})
+        if profile and "profile" in exec_result:
+            output["_profile"] = {"id": exec_result.get("profile_id"), "report": exec_result["profile"]}
+        if approx:
+            output["_approximate"] = exec_result.get("approx") or {
+                k: approx[k] for k in ("population_rows", "sample_rows", "method", "strata_column", "confidence")}
+        return output
 
+    except DeadlineExceeded as e:
+        logger.warning(f"run_agent_safely_unified stopped: {e}")
+        return {"error": str(e)}
     except Exception as e:
         logger.exception("run_agent_safely_unified failed")
         return {"error": str(e)}
+    finally:
+        _current_deadline.reset(deadline_token)
 
 
     
@@ -771,6 +4626,38 @@ async def favicon():
         return FileResponse(path, media_type="image/x-icon")
     return Response(content=_FAVICON_FALLBACK_PNG, media_type="image/png")
 
+@app.get("/metrics")
+async def get_metrics():
+    """Node-wide counters (performance linter, request coalescing, ...)."""
+    return JSONResponse(content=metrics.snapshot())
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    """Stored profiling report for a run made with ?profile=1."""
+    if not re.fullmatch(r"[0-9a-f]{24}", profile_id):
+        raise HTTPException(400, "Invalid profile id")
+    raw = profile_store.get_bytes(profile_id, ".json")
+    if raw is None:
+        raise HTTPException(404, "Profile not found or expired")
+    return JSONResponse(content=json.loads(raw))
+
+
+@app.get("/blobs/{blob_id}")
+async def get_blob(blob_id: str):
+    """Image referenced from an /api response made with Accept: application/vnd.tdata.blobref+json."""
+    m = re.fullmatch(r"[0-9a-f]{24}(\.[a-z]+)", blob_id)
+    if not m:
+        raise HTTPException(400, "Invalid blob id")
+    path = blob_store.get_path(blob_id)
+    if path is None:
+        raise HTTPException(404, "Blob not found or expired")
+    media_type = {ext: mime for mime, ext in _IMAGE_EXTENSIONS.items()}.get(m.group(1), "application/octet-stream")
+    # content-addressed, so the bytes behind an id never change
+    return FileResponse(path, media_type=media_type,
+                        headers={"Cache-Control": f"private, max-age={BLOB_TTL_SECONDS}, immutable"})
+
+
 @app.get("/api", include_in_schema=False)
 async def analyze_get_info():
     """Health/info endpoint. Use POST /api for actual analysis."""
@@ -813,6 +4700,7 @@ DIAG_NETWORK_TARGETS = {
 DIAG_LLM_KEY_TIMEOUT = 30  # seconds per key/model simple ping test (sync tests run in threadpool)
 DIAG_PARALLELISM = 6       # how many thread workers for sync checks
 RUN_LONGER_CHECKS = False  # Playwright/duckdb tests run only if true (they can be slow)
+HEALTH_PASSIVE_WINDOW_SECONDS = int(os.getenv("HEALTH_PASSIVE_WINDOW_SECONDS", 900))
 
 # Use existing GEMINI_KEYS / MODEL_HIERARCHY from your app. If not defined, create empty lists.
 try:
@@ -989,47 +4877,67 @@ def _test_gemini_key_model(key, model, ping_text="ping"):
         return {"ok": False, "error": str(e_outer)}
 
 # ---- Async wrappers that call the sync checks in threadpool ----
+def _recent_llm_success(window: float = None) -> Optional[float]:
+    """Timestamp of the latest successful real Gemini call within the passive window, if any."""
+    window = HEALTH_PASSIVE_WINDOW_SECONDS if window is None else window
+    try:
+        last = max((r["last_ok"] or 0) for r in quota_coordinator.health_snapshot())
+    except ValueError:
+        return None
+    return last if last and time.time() - last < window else None
+
+
 async def check_network():
+    targets = dict(DIAG_NETWORK_TARGETS)
+    out = {}
+    # real traffic to Gemini already proves generativelanguage.googleapis.com is reachable
+    last_ok = await run_in_thread(_recent_llm_success, timeout=10)
+    if last_ok and "Google AI" in targets:
+        targets.pop("Google AI")
+        out["Google AI"] = {"ok": True, "source": "passive", "last_ok_age_seconds": round(time.time() - last_ok, 1)}
     coros = []
-    for name, url in DIAG_NETWORK_TARGETS.items():
+    for name, url in targets.items():
         coros.append(run_in_thread(_network_probe_sync, url, timeout=30))
     results = await asyncio.gather(*[asyncio.create_task(c) for c in coros], return_exceptions=True)
-    out = {}
-    for (name, _), res in zip(DIAG_NETWORK_TARGETS.items(), results):
+    for (name, _), res in zip(targets.items(), results):
         if isinstance(res, Exception):
             out[name] = {"ok": False, "error": str(res)}
         else:
             out[name] = res
     return out
 
-async def check_llm_keys_models():
-    """Try all GEMINI_KEYS on each model (light-touch). Runs in threadpool with per-key timeout."""
+
+async def check_llm_health():
+    """
+    Gemini health from real traffic (recorded by LLMWithFallback). Only when nothing ran within
+    HEALTH_PASSIVE_WINDOW_SECONDS is a single key/model pinged, through the quota coordinator.
+    """
     if not _GEMINI_KEYS:
         return {"warning": "no GEMINI_KEYS configured"}
-
-    results = []
-    # we will stop early if we find a working combo but still record attempts
-    for model in (_MODEL_HIERARCHY or ["gemini-2.5-pro"]):
-        # test keys in parallel for this model
-        tasks = []
-        for key in _GEMINI_KEYS:
-            tasks.append(run_in_thread(_test_gemini_key_model, key, model, timeout=DIAG_LLM_KEY_TIMEOUT))
-        completed = await asyncio.gather(*[asyncio.create_task(t) for t in tasks], return_exceptions=True)
-        model_summary = {"model": model, "attempts": []}
-        any_ok = False
-        for key, res in zip(_GEMINI_KEYS, completed):
-            if isinstance(res, Exception):
-                model_summary["attempts"].append({"key_mask": (key[:4] + "..." + key[-4:]) if key else None, "ok": False, "error": str(res)})
-            else:
-                # res is dict returned by _test_gemini_key_model
-                model_summary["attempts"].append({"key_mask": (key[:4] + "..." + key[-4:]) if key else None, **res})
-                if res.get("ok"):
-                    any_ok = True
-        results.append(model_summary)
-        if any_ok:
-            # stop once first model has a working key (respecting MODEL_HIERARCHY)
-            break
-    return {"models_tested": results}
+    now = time.time()
+    snapshot = await run_in_thread(quota_coordinator.health_snapshot, timeout=10)
+    recent = [r for r in snapshot
+              if max(r["last_ok"] or 0, r["last_error"] or 0) > now - HEALTH_PASSIVE_WINDOW_SECONDS]
+    if recent:
+        models = {}
+        for r in recent:
+            m = models.setdefault(r["model"], {"keys_ok": 0, "keys_failing": 0, "last_ok_age_seconds": None, "last_error": None})
+            ok = (r["last_ok"] or 0) >= (r["last_error"] or 0)
+            m["keys_ok" if ok else "keys_failing"] += 1
+            if r["last_ok"]:
+                age = round(now - r["last_ok"], 1)
+                m["last_ok_age_seconds"] = age if m["last_ok_age_seconds"] is None else min(age, m["last_ok_age_seconds"])
+            if not ok:
+                m["last_error"] = r["last_error_msg"]
+        return {"source": "passive", "window_seconds": HEALTH_PASSIVE_WINDOW_SECONDS, "models": models}
+
+    slot, wait = await run_in_thread(quota_coordinator.try_acquire, _GEMINI_KEYS, _MODEL_HIERARCHY, 64, timeout=10)
+    if slot is None:
+        return {"source": "none", "warning": f"no quota free for a probe (next slot in {wait:.0f}s)"}
+    model, key = slot
+    res = await run_in_thread(_test_gemini_key_model, key, model, timeout=DIAG_LLM_KEY_TIMEOUT)
+    await run_in_thread(quota_coordinator.record_outcome, key, model, bool(res.get("ok")), res.get("error"), timeout=10)
+    return {"source": "probe", "key_mask": (key[:4] + "..." + key[-4:]), **res}
 
 # ---- Optional slow heavy checks (DuckDB, Playwright) ----
 async def check_duckdb():
@@ -1045,6 +4953,13 @@ async def check_duckdb():
         return {"duckdb_error": str(e)}
 
 async def check_playwright():
+    if browser_pool is not None:
+        # exercise the pool the scraper uses instead of launching a throwaway browser
+        try:
+            await run_in_thread(browser_pool.render, "about:blank", timeout=RENDER_TIMEOUT_SECONDS + 10)
+            return {"playwright_ok": True, "pool": browser_pool.stats()}
+        except Exception as e:
+            return {"playwright_error": str(e), "pool": browser_pool.stats()}
     try:
         from playwright.async_api import async_playwright
         async with async_playwright() as p:
@@ -1057,11 +4972,172 @@ async def check_playwright():
     except Exception as e:
         return {"playwright_error": str(e)}
 
-# ---- Final /diagnose route (concurrent) ----
+# ---- Background health monitor ----
+# Each check refreshes on its own interval (seconds; override with HEALTH_INTERVAL_<NAME>).
+# Results are also published to the shared cache so that with several workers only one of
+# them actually runs a check per interval; the others adopt its result. A worker claims a due
+# check with a lock file first, so workers that find it stale at the same moment do not all run it.
+HEALTH_CLAIM_TTL_SECONDS = int(os.getenv("HEALTH_CLAIM_TTL_SECONDS", 300))
+HEALTH_CLAIM_WAIT_SECONDS = int(os.getenv("HEALTH_CLAIM_WAIT_SECONDS", 60))
+HEALTH_CHECKS = {
+    "env": (lambda: run_in_thread(_env_check, ["GOOGLE_API_KEY", "GOOGLE_MODEL", "LLM_TIMEOUT_SECONDS"], timeout=3), 60),
+    "system": (lambda: run_in_thread(_system_info, timeout=30), 60),
+    "tmp_write": (lambda: run_in_thread(_temp_write_test, timeout=30), 300),
+    "cwd_write": (lambda: run_in_thread(_app_write_test, timeout=30), 300),
+    "pandas": (lambda: run_in_thread(_pandas_pipeline_test, timeout=30), 600),
+    "packages": (lambda: run_in_thread(_installed_packages_sample, timeout=50), 86400),
+    "network": (check_network, 300),
+    "llm_keys_models": (check_llm_health, 300),
+}
+EXTENDED_HEALTH_CHECKS = {
+    "duckdb": (check_duckdb, 3600),
+    "playwright": (check_playwright, 3600),
+}
+
+
+class HealthMonitor:
+    def __init__(self, checks: Dict[str, tuple]):
+        self.checks = {
+            name: (factory, int(os.getenv(f"HEALTH_INTERVAL_{name.upper()}", interval)))
+            for name, (factory, interval) in checks.items()
+        }
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.store = SharedCache("health", 7 * 86400, 16 * 1024 * 1024)
+        self._tasks: List[asyncio.Task] = []
+
+    def add(self, name: str, factory, interval: int) -> None:
+        self.checks[name] = (factory, int(os.getenv(f"HEALTH_INTERVAL_{name.upper()}", interval)))
+        if self._tasks:
+            self._tasks.append(asyncio.create_task(self._loop(name)))
+
+    def _load_shared(self, name: str) -> Optional[Dict[str, Any]]:
+        raw = self.store.get_bytes(name, ".json")
+        try:
+            return json.loads(raw) if raw else None
+        except Exception:
+            return None
+
+    def _claim(self, name: str) -> bool:
+        """Atomically take the right to run check `name` on this node; a claim older than HEALTH_CLAIM_TTL_SECONDS is abandoned."""
+        path = self.store.path(name, ".lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(path).st_mtime < HEALTH_CLAIM_TTL_SECONDS:
+                        return False
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def _release(self, name: str) -> None:
+        try:
+            os.unlink(self.store.path(name, ".lock"))
+        except FileNotFoundError:
+            pass
+
+    async def _wait_for_peer(self, name: str, previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Another worker is running the check: wait for its result (or its claim to go away)."""
+        since = (previous or {}).get("checked_ts", 0)
+        waited = 0.0
+        while waited < HEALTH_CLAIM_WAIT_SECONDS:
+            await asyncio.sleep(0.5)
+            waited += 0.5
+            shared = self._load_shared(name)
+            if shared and shared.get("checked_ts", 0) > since:
+                return shared
+            if not os.path.exists(self.store.path(name, ".lock")):
+                break
+        return self._load_shared(name) or previous or {"status": "pending", "error": "check is running in another worker"}
+
+    async def refresh(self, name: str, force: bool = False) -> Dict[str, Any]:
+        factory, interval = self.checks[name]
+        shared = self._load_shared(name)
+        if not force and shared and time.time() - shared.get("checked_ts", 0) < interval:
+            self.results[name] = shared
+            return shared
+        if not self._claim(name):
+            entry = await self._wait_for_peer(name, shared)
+            self.results[name] = entry
+            return entry
+        started = time.time()
+        try:
+            entry = {"status": "ok", "result": await factory()}
+        except TimeoutError:
+            entry = {"status": "timeout", "error": "check timed out"}
+        except Exception as e:
+            entry = {"status": "error", "error": str(e), "trace": traceback.format_exc()}
+        except BaseException:
+            self._release(name)
+            raise
+        entry.update({
+            "checked_at": _now_iso(),
+            "checked_ts": started,
+            "duration_seconds": round(time.time() - started, 3),
+        })
+        self.results[name] = entry
+        try:
+            self.store.put_bytes(name, json.dumps(entry, default=str).encode("utf-8"), ".json")
+        except Exception as e:
+            logger.warning(f"Could not publish health check {name}: {e}")
+        finally:
+            self._release(name)
+        return entry
+
+    async def _loop(self, name: str) -> None:
+        while True:
+            try:
+                entry = await self.refresh(name)
+                age = time.time() - entry.get("checked_ts", time.time())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Health check {name} failed")
+                age = 0
+            await asyncio.sleep(max(1.0, self.checks[name][1] - age))
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._loop(name)) for name in self.checks]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+health_monitor = HealthMonitor(HEALTH_CHECKS)
+
+
+@app.on_event("startup")
+async def _start_health_monitor():
+    if RUN_LONGER_CHECKS:
+        for name, (factory, interval) in EXTENDED_HEALTH_CHECKS.items():
+            health_monitor.add(name, factory, interval)
+    health_monitor.start()
+
+
+@app.on_event("shutdown")
+async def _stop_health_monitor():
+    await health_monitor.stop()
+
+
+@app.on_event("shutdown")
+async def _stop_browser_pool():
+    if browser_pool is not None:
+        await asyncio.get_running_loop().run_in_executor(None, browser_pool.close)
+
+
+# ---- Final /diagnose route (served from the health monitor's cache) ----
 from fastapi import Query
 
 @app.get("/summary")
-async def diagnose(full: bool = Query(False, description="If true, run extended checks (duckdb/playwright)")):
+async def diagnose(full: bool = Query(False, description="If true, include extended checks (duckdb/playwright)"),
+                   refresh: bool = Query(False, description="If true, re-run every check now instead of serving cached results")):
     started = datetime.utcnow()
     report = {
         "status": "ok",
@@ -1071,43 +5147,35 @@ async def diagnose(full: bool = Query(False, description="If true, run extended
         "elapsed_seconds": None
     }
 
-    # prepare tasks
-    tasks = {
-        "env": run_in_thread(_env_check, ["GOOGLE_API_KEY", "GOOGLE_MODEL", "LLM_TIMEOUT_SECONDS"], timeout=3),
-        "system": run_in_thread(_system_info, timeout=30),
-        "tmp_write": run_in_thread(_temp_write_test, timeout=30),
-        "cwd_write": run_in_thread(_app_write_test, timeout=30),
-        "pandas": run_in_thread(_pandas_pipeline_test, timeout=30),
-        "packages": run_in_thread(_installed_packages_sample, timeout=50),
-        "network": asyncio.create_task(check_network()),
-        "llm_keys_models": asyncio.create_task(check_llm_keys_models())
-    }
-
-    if full or RUN_LONGER_CHECKS:
-        tasks["duckdb"] = asyncio.create_task(check_duckdb())
-        tasks["playwright"] = asyncio.create_task(check_playwright())
-
-    # run all concurrently, collect results
+    if full:
+        for name, (factory, interval) in EXTENDED_HEALTH_CHECKS.items():
+            if name not in health_monitor.checks:
+                health_monitor.add(name, factory, interval)
+    if refresh:
+        await asyncio.gather(*[health_monitor.refresh(name, force=True) for name in health_monitor.checks])
+    elif full:
+        # extended checks are only scheduled once someone asks for them; don't leave them pending
+        await asyncio.gather(*[health_monitor.refresh(name) for name in EXTENDED_HEALTH_CHECKS
+                               if name not in health_monitor.results])
+
+    now = time.time()
     results = {}
-    for name, coro in tasks.items():
-        try:
-            res = await coro
-            results[name] = {"status": "ok", "result": res}
-        except TimeoutError:
-            results[name] = {"status": "timeout", "error": "check timed out"}
-        except Exception as e:
-            results[name] = {"status": "error", "error": str(e), "trace": traceback.format_exc()}
+    for name in health_monitor.checks:
+        if name in EXTENDED_HEALTH_CHECKS and not (full or RUN_LONGER_CHECKS):
+            continue
+        entry = health_monitor.results.get(name)
+        if entry is None:
+            results[name] = {"status": "pending", "error": "check has not completed yet"}
+        else:
+            results[name] = {**entry, "age_seconds": round(now - entry.get("checked_ts", now), 1)}
 
     report["checks"] = results
 
     # quick summary flags
-    failed = [k for k, v in results.items() if v.get("status") != "ok"]
-    if failed:
-        report["status"] = "warning"
-        report["summary"]["failed_checks"] = failed
-    else:
-        report["status"] = "ok"
-        report["summary"]["failed_checks"] = []
+    failed = [k for k, v in results.items() if v.get("status") not in ("ok", "pending")]
+    report["summary"]["failed_checks"] = failed
+    report["summary"]["pending_checks"] = [k for k, v in results.items() if v.get("status") == "pending"]
+    report["status"] = "warning" if failed else "ok"
 
     report["elapsed_seconds"] = (datetime.utcnow() - started).total_seconds()
     return report
@@ -1,2 +1,14 @@
 #!/bin/sh
+# WEB_CONCURRENCY > 1 serves with gunicorn + uvicorn workers: app.py is imported once (--preload)
+# and the workers are forked from it copy-on-write. Datasets, scrape results and Gemini quota
+# state are shared between workers through SHARED_CACHE_DIR / SHARED_STATE_DB.
+WORKERS=${WEB_CONCURRENCY:-1}
+if [ "$WORKERS" -gt 1 ]; then
+    exec gunicorn app:app \
+        --worker-class uvicorn.workers.UvicornWorker \
+        --preload \
+        --workers "$WORKERS" \
+        --bind 0.0.0.0:${PORT:-20000} \
+        --timeout ${GUNICORN_TIMEOUT:-300}
+fi
 exec uvicorn app:app --host 0.0.0.0 --port ${PORT:-20000}
@@ -0,0 +1,19 @@
+"""
+Test setup: app.py reads its configuration at import time, so point every piece of node-local
+shared state (SQLite db, caches, hot tier) at a throwaway directory and provide a dummy Gemini
+key before anything imports it. No test talks to Gemini.
+"""
+import os
+import sys
+import tempfile
+
+_STATE_DIR = tempfile.mkdtemp(prefix="tdata-tests-")
+
+os.environ["gemini_api_1"] = "test-key"
+os.environ["SHARED_STATE_DB"] = os.path.join(_STATE_DIR, "state.db")
+os.environ["SHARED_CACHE_DIR"] = os.path.join(_STATE_DIR, "cache")
+os.environ["EXEC_CACHE_DIR"] = os.path.join(_STATE_DIR, "exec_cache")
+os.environ["HOT_TIER_DIR"] = os.path.join(_STATE_DIR, "hot")
+os.environ["MPLBACKEND"] = "Agg"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,122 @@
+"""
+Load test for multi-worker serving (entrypoint.sh with WEB_CONCURRENCY > 1): fires N concurrent
+POST /api requests at gunicorn + uvicorn workers serving tests.stub_app (LLM stubbed, real parse
+and sandbox) for each worker count, and reports throughput.
+
+    python -m tests.load_test_workers --workers 1 4 --requests 40 --concurrency 8
+
+Every request uploads a different CSV, so neither the execution cache nor single-flight
+coalescing can short-circuit the work. Throughput can only scale up to the number of CPU cores.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTIONS = b"1. How many rows are there?\n2. What is the total of value?\n"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _csv(i: int, rows: int) -> bytes:
+    lines = ["id,value,label"] + [f"{r},{(r * 7 + i) % 1000},l{r % 13}" for r in range(rows)]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def start_server(workers: int, state_dir: str, llm_latency: float):
+    port = _free_port()
+    env = dict(os.environ,
+               gemini_api_1=os.environ.get("gemini_api_1", "test-key"),
+               SHARED_STATE_DB=os.path.join(state_dir, "state.db"),
+               SHARED_CACHE_DIR=os.path.join(state_dir, "cache"),
+               EXEC_CACHE_DIR=os.path.join(state_dir, "exec_cache"),
+               HOT_TIER_DIR=os.path.join(state_dir, "hot"),
+               LLM_STUB_LATENCY=str(llm_latency),
+               MPLBACKEND="Agg")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "tests.stub_app:app",
+         "--worker-class", "uvicorn.workers.UvicornWorker", "--preload",
+         "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "--timeout", "300"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}/api"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=2).ok:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.5)
+    proc.kill()
+    raise RuntimeError(f"gunicorn with {workers} worker(s) did not come up")
+
+
+def run_load(url: str, n_requests: int, concurrency: int, rows: int):
+    bodies = [_csv(i, rows) for i in range(n_requests)]
+
+    def post(i):
+        t0 = time.perf_counter()
+        resp = requests.post(url, files={"questions_file": ("questions.txt", QUESTIONS),
+                                         "data_file": (f"data{i}.csv", bodies[i])}, timeout=300)
+        return resp.status_code, resp.json() if resp.ok else resp.text, time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(post, range(n_requests)))
+    elapsed = time.perf_counter() - t0
+    latencies = sorted(o[2] for o in outcomes)
+    return {
+        "ok": sum(1 for o in outcomes if o[0] == 200),
+        "requests": n_requests,
+        "seconds": elapsed,
+        "throughput": n_requests / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "outcomes": outcomes,
+    }
+
+
+def benchmark(worker_counts, n_requests=40, concurrency=8, rows=50_000, llm_latency=0.5):
+    report = {}
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory(prefix="tdata-load-") as state_dir:
+            proc, url = start_server(workers, state_dir, llm_latency)
+            try:
+                run_load(url, min(concurrency, n_requests), concurrency, rows)  # warm-up: sandbox imports, page cache
+                report[workers] = run_load(url, n_requests, concurrency, rows)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=30)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=50_000, help="rows per uploaded CSV")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds the stubbed LLM call takes")
+    args = parser.parse_args()
+    print(f"cpu cores: {os.cpu_count()}")
+    report = benchmark(args.workers, args.requests, args.concurrency, args.rows, args.llm_latency)
+    base = report[args.workers[0]]["throughput"]
+    print(f"{'workers':>7} {'ok':>7} {'seconds':>8} {'req/s':>7} {'p50 s':>7} {'p95 s':>7} {'speedup':>8}")
+    for workers, r in report.items():
+        print(f"{workers:>7} {r['ok']:>3}/{r['requests']:<3} {r['seconds']:>8.1f} {r['throughput']:>7.2f} "
+              f"{r['p50']:>7.2f} {r['p95']:>7.2f} {r['throughput'] / base:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
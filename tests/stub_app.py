@@ -0,0 +1,22 @@
+"""
+app:app with the agent replaced by a canned plan, for load tests that must not call Gemini.
+Everything else (upload parsing, dataset cache, sandbox) is the real pipeline.
+"""
+import os
+import time
+
+import app as _app
+
+LLM_STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", 0.5))
+
+
+def _stub_plan(llm_input, max_retries=3):
+    time.sleep(LLM_STUB_LATENCY)  # stands in for the Gemini round trip
+    return {
+        "questions": ["rows", "total"],
+        "code": "results = {'rows': int(len(df)), 'total': float(df['value'].sum())}",
+    }
+
+
+_app._generate_plan = _stub_plan
+app = _app.app
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def _population(n=20_000, seed=1):
+    rng = np.random.default_rng(seed)
+    region = rng.choice(["EU", "US", "APAC", "LATAM"], size=n, p=[0.5, 0.3, 0.15, 0.05])
+    base = pd.Series(region).map({"EU": 10.0, "US": 50.0, "APAC": 100.0, "LATAM": 5.0}).to_numpy()
+    return pd.DataFrame({"region": region, "sales": base + rng.normal(0, 3, size=n)})
+
+
+def _estimators(population, sample_rows, seed=0, monkeypatch=None):
+    monkeypatch.setattr(app, "APPROX_SAMPLE_ROWS", sample_rows)
+    sample, meta = app.build_approx_sample(population, seed=seed)
+    ns = {"pd": pd, "np": np, "df": sample, "_APPROX": app._approx_sandbox_meta(meta)}
+    exec(app._APPROX_HELPERS, ns)
+    return ns, meta
+
+
+def test_reservoir_indices_are_a_uniform_sample():
+    rng = np.random.default_rng(0)
+    hits = np.zeros(100)
+    for _ in range(2000):
+        idx = app._reservoir_indices(100, 10, rng)
+        assert len(idx) == 10 == len(set(idx)) and (np.diff(idx) > 0).all()
+        hits[idx] += 1
+    # every position is kept about 2000 * 10 / 100 = 200 times
+    assert hits.min() > 140 and hits.max() < 260
+    assert list(app._reservoir_indices(5, 10, rng)) == [0, 1, 2, 3, 4]
+
+
+def test_stratified_sample_allocates_every_stratum(monkeypatch):
+    population = _population()
+    monkeypatch.setattr(app, "APPROX_SAMPLE_ROWS", 1000)
+    sample, meta = app.build_approx_sample(population, seed=3)
+    assert meta["method"] == "stratified" and meta["strata_column"] == "region"
+    assert meta["population_rows"] == len(population) and meta["sample_rows"] == len(sample)
+    strata = {s["label"]: s for s in meta["strata"].values()}
+    assert sum(s["population"] for s in strata.values()) == len(population)
+    assert strata["LATAM"]["sample"] >= app.APPROX_MIN_PER_STRATUM
+    # the sample keeps the original row labels
+    pd.testing.assert_frame_equal(sample.drop(columns=app.APPROX_STRATUM_COLUMN), population.loc[sample.index])
+
+
+def test_census_estimates_are_exact(monkeypatch):
+    population = _population(2000)
+    ns, _ = _estimators(population, sample_rows=len(population), monkeypatch=monkeypatch)
+    df = ns["df"]
+    assert ns["approx_sum"](df["sales"]) == pytest.approx(population["sales"].sum())
+    assert ns["approx_mean"](df["sales"]) == pytest.approx(population["sales"].mean())
+    assert ns["approx_count"](df["region"] == "EU") == pytest.approx((population["region"] == "EU").sum())
+    assert ns["approx_proportion"](df["sales"] > 40) == pytest.approx((population["sales"] > 40).mean())
+    assert all(iv["std_error"] == 0 for iv in ns["_approx_intervals"])
+
+
+def test_intervals_cover_the_population_value(monkeypatch):
+    population = _population()
+    truth = {
+        "sum": population["sales"].sum(),
+        "mean": population.loc[population["region"] == "US", "sales"].mean(),
+        "count": (population["sales"] > 12).sum(),
+        "proportion": ((population["sales"] > 12) & (population["region"] == "EU")).sum()
+        / (population["region"] == "EU").sum(),
+    }
+    covered = {k: 0 for k in truth}
+    runs = 40
+    for seed in range(runs):
+        ns, _ = _estimators(population, sample_rows=800, seed=seed, monkeypatch=monkeypatch)
+        df = ns["df"]
+        ns["approx_sum"](df["sales"])
+        ns["approx_mean"](df.loc[df["region"] == "US", "sales"])
+        ns["approx_count"](df["sales"] > 12)
+        ns["approx_proportion"](df["sales"] > 12, within=df["region"] == "EU")
+        for iv in ns["_approx_intervals"]:
+            covered[iv["kind"]] += iv["low"] <= truth[iv["kind"]] <= iv["high"]
+    # nominal 95% coverage; allow for the small number of runs
+    assert all(c >= 0.85 * runs for c in covered.values()), covered
+
+
+def test_result_extras_match_rounded_estimates(monkeypatch):
+    ns, meta = _estimators(_population(), sample_rows=800, monkeypatch=monkeypatch)
+    df = ns["df"]
+    total = ns["approx_sum"](df["sales"])
+    extras = ns["_result_extras"]({"total": round(total, 2), "rows": len(df)})["approx"]
+    assert extras["intervals"]["total"]["estimate"] == total
+    assert "rows" not in extras["intervals"]
+    assert extras["population_rows"] == meta["population_rows"]
+
+
+def test_helpers_reject_values_without_row_labels(monkeypatch):
+    ns, _ = _estimators(_population(), sample_rows=800, monkeypatch=monkeypatch)
+    sales = ns["df"]["sales"]
+    with pytest.raises(ValueError):
+        ns["approx_sum"](pd.Series(sales.to_numpy(), index=np.arange(len(sales)) + 10**7))
+    with pytest.raises(TypeError):
+        ns["approx_mean"]([1, 2, 3])
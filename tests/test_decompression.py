@@ -0,0 +1,124 @@
+import asyncio
+import bz2
+import gzip
+import io
+import lzma
+import zipfile
+import zlib
+
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import app
+
+CSV = b"a,b\n" + b"".join(b"%d,%d\n" % (i, i * i) for i in range(2000))
+
+
+def _zip(name, data):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def _zstd(data):
+    zstd = pytest.importorskip("zstandard")
+    return zstd.ZstdCompressor().compress(data)
+
+
+@pytest.mark.parametrize("name,payload", [
+    ("data.csv.gz", lambda: gzip.compress(CSV)),
+    ("data.csv.bz2", lambda: bz2.compress(CSV)),
+    ("data.csv.xz", lambda: lzma.compress(CSV)),
+    ("data.csv.zst", lambda: _zstd(CSV)),
+    ("data.zip", lambda: _zip("inner/data.csv", CSV)),
+    ("data.zip", lambda: _zip("data.csv.gz", gzip.compress(CSV))),  # nested
+    ("upload.bin", lambda: gzip.compress(CSV)),  # sniffed from the magic bytes, not the name
+])
+def test_compressed_uploads_are_sniffed_and_parsed(name, payload):
+    df = app._parse_uploaded_dataframe(name, io.BytesIO(payload()))
+    pd.testing.assert_frame_equal(df, pd.read_csv(io.BytesIO(CSV)))
+
+
+@pytest.mark.parametrize("head,name,fmt", [
+    (b"PAR1\x15\x04", "x.bin", "parquet"),
+    (b"\x89PNG\r\n", "x.bin", "image"),
+    (b'  [{"a": 1}]', "x.bin", "json"),
+    (b"a,b\n1,2\n", "x.bin", "csv"),
+    (b"a\tb\n", "x.tsv", "csv"),
+    (b"\x00\x01\x02", "x.bin", None),
+])
+def test_sniff_format(head, name, fmt):
+    assert app._sniff_format(head, name) == fmt
+
+
+def test_zip_bomb_upload_is_rejected(monkeypatch):
+    monkeypatch.setattr(app, "MAX_DECOMPRESSED_BYTES", 1 << 20)
+    bomb = gzip.compress(b"0" * (8 << 20))
+    with pytest.raises(HTTPException) as e:
+        app._parse_uploaded_dataframe("bomb.csv.gz", io.BytesIO(bomb))
+    assert e.value.status_code == 413
+    with pytest.raises(HTTPException) as e:
+        app._parse_uploaded_dataframe("bomb.zip", io.BytesIO(_zip("bomb.csv", b"0" * (8 << 20))))
+    assert e.value.status_code == 413
+
+
+def _run_middleware(body_chunks, encoding):
+    """Feed body_chunks through the middleware into an app that records every message it receives."""
+    received = []
+
+    async def inner(scope, receive, send):
+        while True:
+            message = await receive()
+            received.append(message)
+            if not message.get("more_body"):
+                break
+
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(body_chunks) - 1}
+                for i, c in enumerate(body_chunks)]
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {"type": "http", "headers": [(b"content-encoding", encoding.encode())]}
+    asyncio.run(app.RequestDecompressionMiddleware(inner)(scope, receive, None))
+    return received
+
+
+@pytest.mark.parametrize("encoding,compress", [
+    ("gzip", gzip.compress),
+    ("deflate", zlib.compress),
+    ("zstd", _zstd),
+])
+def test_body_is_inflated_in_bounded_pieces(encoding, compress):
+    raw = b"x" * (5 << 20) + CSV
+    packed = compress(raw)
+    received = _run_middleware([packed[:100], packed[100:]], encoding)
+    assert b"".join(m["body"] for m in received) == raw
+    # the highly compressible body arrives in several pieces, none larger than the chunk size
+    # (zstd: one feed's worth of output)
+    limit = app._INFLATE_CHUNK_BYTES if encoding != "zstd" else 16 << 20
+    assert len(received) > 1 and max(len(m["body"]) for m in received) <= limit
+    assert received[-1]["more_body"] is False
+
+
+@pytest.mark.parametrize("encoding,compress", [("gzip", gzip.compress), ("zstd", _zstd)])
+def test_body_bomb_is_rejected(encoding, compress, monkeypatch):
+    monkeypatch.setattr(app, "MAX_DECOMPRESSED_BYTES", 1 << 20)
+    with pytest.raises(HTTPException) as e:
+        _run_middleware([compress(b"\0" * (64 << 20))], encoding)
+    assert e.value.status_code == 413
+
+
+def test_api_answers_413_for_a_compressed_bomb(monkeypatch):
+    monkeypatch.setattr(app, "MAX_DECOMPRESSED_BYTES", 1 << 20)
+    boundary = "bomb"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"questions.txt\"; filename=\"questions.txt\"\r\n"
+            f"Content-Type: text/plain\r\n\r\n").encode() + b"q" * (4 << 20) + f"\r\n--{boundary}--\r\n".encode()
+    client = TestClient(app.app)
+    resp = client.post("/api", content=gzip.compress(body),
+                       headers={"Content-Type": f"multipart/form-data; boundary={boundary}",
+                                "Content-Encoding": "gzip"})
+    assert resp.status_code == 413
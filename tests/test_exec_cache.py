@@ -0,0 +1,107 @@
+import os
+import time
+
+import pytest
+
+import app
+
+PLOT = "data:image/png;base64," + "iVBORw0KGgo" * 40
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return app.ExecutionResultCache(str(tmp_path / "exec"), ttl_seconds=60, max_bytes=1 << 20)
+
+
+def _age(cache, key, seconds):
+    """Pretend the entry was created (and last used) seconds ago."""
+    entry = os.path.join(cache.root, key)
+    past = time.time() - seconds
+    os.utime(os.path.join(entry, "result.json"), (past, past))
+    os.utime(entry, (past, past))
+
+
+def test_round_trip_keeps_images_in_their_own_files(cache):
+    results = {"answer": 42, "plots": [PLOT], "nested": {"plot": PLOT, "label": "x"}}
+    cache.put("k1", results)
+    entry = os.path.join(cache.root, "k1")
+    assert sorted(os.listdir(entry)) == ["img_0.b64", "img_1.b64", "result.json"]
+    with open(os.path.join(entry, "result.json")) as f:
+        assert PLOT not in f.read()
+    assert cache.get("k1") == results
+    assert cache.get("missing") is None
+
+
+def test_expired_entries_are_dropped(cache):
+    cache.put("old", {"a": 1})
+    _age(cache, "old", 120)
+    assert cache.get("old") is None
+    assert not os.path.exists(os.path.join(cache.root, "old"))
+
+
+def test_least_recently_used_entries_are_evicted_first(cache):
+    payload = {"blob": "x" * 4000}
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, payload)
+        _age(cache, key, 30 - i)
+    cache.get("a")  # now the most recently used
+    cache.max_bytes = 13000  # room for three entries
+    cache.put("d", payload)
+    assert sorted(os.listdir(cache.root)) == ["a", "c", "d"]
+
+
+@pytest.mark.parametrize("code,cacheable", [
+    ("results['n'] = len(df)", True),
+    ("results['s'] = df.sample(10)['x'].mean()", False),
+    ("results['s'] = df.sample(10, random_state=0)['x'].mean()", True),
+    ("results['s'] = df.sample(frac=0.1, random_state=1).shape[0]", True),
+    ("import numpy as np\nresults['r'] = np.random.rand()", False),
+    ("import datetime\nresults['t'] = str(datetime.datetime.now())", False),
+    ("import time\nresults['t'] = time.time()", False),
+    ("results['t'] = str(pd.Timestamp('today'))", False),
+    ("import requests\nresults['r'] = requests.get('http://x').status_code", False),
+    ("results['n'] = len(pd.read_csv('https://example.com/x.csv'))", False),
+    ("results['n'] = len(pd.read_csv('local.csv'))", True),
+])
+def test_is_cacheable_code(code, cacheable):
+    assert app.is_cacheable_code(code) is cacheable
+
+
+def test_scraped_sources_must_be_hashed():
+    code = "d = scrape_url_to_dataframe('https://example.com/t')\nresults['n'] = len(d['data'])"
+    assert not app.is_cacheable_code(code)
+    assert app.is_cacheable_code(code, {"https://example.com/t": "abc"})
+    assert not app.is_cacheable_code("d = scrape_url_to_dataframe(url)", {"https://example.com/t": "abc"})
+
+
+def test_key_ignores_formatting_but_not_inputs():
+    key = app.execution_cache_key("results['n'] = len(df)", "d1")
+    assert app.execution_cache_key("# count\nresults['n']  =  len(df)\n", "d1") == key
+    assert app.execution_cache_key("results['n'] = len(df)", "d2") != key
+    assert app.execution_cache_key("results['n'] = len(df)", "d1", {"u": "h"}) != key
+
+
+@pytest.mark.parametrize("setting,value", [
+    ("PLOT_AUTO_DOWNSAMPLE", True),
+    ("PROJECTION_ENABLED", False),
+    ("PLOT_DOWNSAMPLE_MIN_POINTS", 123),
+    ("_PLOT_HELPER", app._PLOT_HELPER + "\n# changed\n"),
+], ids=["auto-downsample", "projection", "downsample-threshold", "prelude-text"])
+def test_key_changes_with_the_sandbox_prelude_and_config(monkeypatch, setting, value):
+    key = app.execution_cache_key("results['n'] = len(df)", "d1")
+    monkeypatch.setattr(app, setting, value)
+    assert app.execution_cache_key("results['n'] = len(df)", "d1") != key
+
+
+def test_cached_run_is_served_without_the_sandbox(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "_exec_cache", app.ExecutionResultCache(str(tmp_path / "exec"), 60, 1 << 20))
+    code = "results['n'] = 6 * 7"
+    first = app.write_and_run_temp_python(code, dataset_hash="d1", timeout=60)
+    assert first["status"] == "success" and first["result"] == {"n": 42} and not first.get("cached")
+
+    def no_sandbox(*args, **kwargs):
+        raise AssertionError("ran the sandbox")
+
+    monkeypatch.setattr(app, "_run_sandbox_script", no_sandbox)
+    second = app.write_and_run_temp_python(code, dataset_hash="d1", timeout=60)
+    assert second == {"status": "success", "result": {"n": 42}, "cached": True}
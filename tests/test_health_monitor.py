@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+import app
+
+
+def _monitors(name, factory, interval=60):
+    # two monitors over the same shared store stand in for two workers on one node
+    return [app.HealthMonitor({name: (factory, interval)}) for _ in range(2)]
+
+
+def test_stale_check_runs_once_across_workers():
+    calls = []
+
+    async def slow_check():
+        calls.append(1)
+        await asyncio.sleep(0.3)
+        return {"value": len(calls)}
+
+    a, b = _monitors("claim_once", slow_check)
+
+    async def both():
+        return await asyncio.gather(a.refresh("claim_once"), b.refresh("claim_once"))
+
+    first, second = asyncio.run(both())
+    assert len(calls) == 1
+    assert first["result"] == second["result"] == {"value": 1}
+    assert not os.path.exists(a.store.path("claim_once", ".lock"))
+
+
+def test_fresh_shared_result_is_adopted_without_running():
+    calls = []
+
+    async def check():
+        calls.append(1)
+        return {}
+
+    a, b = _monitors("adopt_fresh", check)
+    asyncio.run(a.refresh("adopt_fresh"))
+    asyncio.run(b.refresh("adopt_fresh"))
+    assert len(calls) == 1
+
+
+def test_abandoned_claim_is_taken_over(monkeypatch):
+    async def check():
+        return {"ok": True}
+
+    (monitor,) = _monitors("abandoned", check)[:1]
+    lock = monitor.store.path("abandoned", ".lock")
+    open(lock, "w").close()
+    os.utime(lock, (0, 0))  # a worker died while holding the claim long ago
+    assert asyncio.run(monitor.refresh("abandoned"))["result"] == {"ok": True}
+
+
+def test_failing_check_releases_claim():
+    async def broken():
+        raise RuntimeError("boom")
+
+    (monitor,) = _monitors("broken", broken)[:1]
+    entry = asyncio.run(monitor.refresh("broken"))
+    assert entry["status"] == "error"
+    assert not os.path.exists(monitor.store.path("broken", ".lock"))
@@ -0,0 +1,112 @@
+import hashlib
+import mmap
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def _frame(n=1000):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "a": np.arange(n),
+        "b": rng.random(n),
+        "when": pd.date_range("2024-01-01", periods=n, freq="h"),
+        "name": [f"n{i % 7}" for i in range(n)],
+        "gaps": np.where(np.arange(n) % 5 == 0, np.nan, 1.0),
+        "flag": np.arange(n) % 2 == 0,
+        "opt": pd.array(np.where(np.arange(n) % 3 == 0, None, np.arange(n)), dtype="Int64"),
+    }, index=pd.Index(np.arange(n) * 10, name="key"))
+
+
+def _loader():
+    ns = {"pd": pd, "np": np}
+    exec(app._DATASET_LOADER, ns)
+    return ns
+
+
+def _digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _mapped(arr):
+    # walk the base chain down to the buffer the array views
+    while isinstance(getattr(arr, "base", None), np.ndarray):
+        arr = arr.base
+    base = getattr(arr, "base", None)
+    return isinstance(base, memoryview) and isinstance(base.obj, mmap.mmap)
+
+
+@pytest.fixture
+def arrow_file(tmp_path):
+    df = _frame()
+    path = str(tmp_path / "data.arrow")
+    app._write_arrow_file(app._arrow_table(df), path)
+    return df, path
+
+
+def test_arrow_load_matches_original(arrow_file):
+    df, path = arrow_file
+    pd.testing.assert_frame_equal(_loader()["_load_dataset"](None, None, path, None), df)
+
+
+def test_primitive_columns_are_zero_copy_and_writable(arrow_file):
+    df, path = arrow_file
+    before = _digest(path)
+    frame = _loader()["_arrow_frame"](path, None)
+    for col in ("a", "b", "when"):
+        assert _mapped(frame[col].to_numpy()), col
+    # strings, bools and columns with nulls are converted (copied)
+    for col in ("name", "gaps", "flag", "opt"):
+        assert not _mapped(frame[col].to_numpy()), col
+
+    frame.loc[frame.index[0], "a"] = -1
+    frame["b"] *= 2
+    frame.iloc[3, frame.columns.get_loc("when")] = pd.Timestamp("2000-01-01")
+    assert frame["a"].iloc[0] == -1
+    assert frame["b"].iloc[1] == df["b"].iloc[1] * 2
+    # the writes went to private pages: the file and fresh loads are untouched
+    assert _digest(path) == before
+    pd.testing.assert_frame_equal(_loader()["_arrow_frame"](path, None), df)
+
+
+def test_store_dataset_keeps_pickle_for_frames_arrow_would_retype(tmp_path):
+    ok, _ = app._store_dataset("store-arrow", _frame(10))
+    assert ok.endswith(".arrow")
+    mixed = pd.DataFrame({"x": pd.Series([1, None, 3], dtype=object)})
+    path, table = app._store_dataset("store-pickle", mixed)
+    assert path.endswith(".pkl") and table is None
+    pd.testing.assert_frame_equal(app._read_dataset_file(path), mixed)
+
+
+def test_acquire_copies_cached_arrow_file_without_converting(tmp_path, arrow_file, monkeypatch):
+    df, path = arrow_file
+    tier = app.HotDatasetTier(str(tmp_path / "hot"), 1 << 30, db_path=str(tmp_path / "hot.db"))
+    monkeypatch.setattr(app, "_arrow_table", lambda df: pytest.fail("converted again"))
+    segment = tier.acquire("copy-me", pickle_path=path)
+    assert segment and _digest(segment) == _digest(path)
+    assert tier.acquire("copy-me") == segment
+    tier.release("copy-me")
+    tier.release("copy-me")
+
+
+def test_acquire_rolls_back_a_failed_lookup(tmp_path):
+    tier = app.HotDatasetTier(str(tmp_path / "hot"), 1 << 30, db_path=str(tmp_path / "hot.db"))
+    conn = tier._conn()
+    conn.execute("DROP TABLE hot_datasets")
+    with pytest.raises(Exception):
+        tier.acquire("missing-table", df=_frame(10))
+    assert not conn.in_transaction
+
+
+def test_sandbox_reads_cached_arrow_file():
+    df = _frame()
+    path, _ = app._store_dataset("sandbox-arrow", df)
+    code = "df.loc[df.index[0], 'a'] = 5\nresults = {'a': int(df['a'].sum()), 'rows': len(df)}"
+    out = app.write_and_run_temp_python(code, injected_pickle=path, timeout=60)
+    assert out["status"] == "success", out
+    assert out["result"] == {"a": int(df["a"].sum()) + 5, "rows": len(df)}
@@ -0,0 +1,121 @@
+import base64
+import io
+import json
+import os
+import re
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+def _png(color):
+    fig, ax = plt.subplots(figsize=(2, 2), dpi=50)
+    ax.plot([0, 1, 2], [2, 0, 1], color=color)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    plt.close(fig)
+    return buf.getvalue()
+
+
+RED, BLUE = _png("red"), _png("blue")
+RESULT = {
+    "total": 42,
+    "chart": base64.b64encode(RED).decode("ascii"),
+    "more": {"plots": ["data:image/png;base64," + base64.b64encode(BLUE).decode("ascii")], "label": "x"},
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def prepare(request, progress=None):
+        await request.form()
+        return {}
+
+    async def execute(job, progress=None):
+        return json.loads(json.dumps(RESULT))
+
+    monkeypatch.setattr(app, "_prepare_analysis", prepare)
+    monkeypatch.setattr(app, "_execute_coalesced", execute)
+    return TestClient(app.app)
+
+
+def _post(client, params=None, accept=None):
+    headers = {"Accept": accept} if accept else {}
+    return client.post("/api", params=params or {}, headers=headers,
+                       files={"questions.txt": ("questions.txt", b"How many?")})
+
+
+def _parts(resp):
+    """[(headers, body)] of a multipart/mixed response."""
+    boundary = re.fullmatch(r"multipart/mixed; boundary=(\w+)", resp.headers["content-type"]).group(1)
+    body = resp.content
+    assert body.endswith(f"--{boundary}--\r\n".encode())
+    parts = []
+    for chunk in body.split(f"--{boundary}".encode())[1:-1]:
+        head, _, payload = chunk[2:].partition(b"\r\n\r\n")
+        headers = dict(line.split(": ", 1) for line in head.decode("ascii").split("\r\n"))
+        assert payload.endswith(b"\r\n")
+        payload = payload[:-2]
+        assert int(headers["Content-Length"]) == len(payload)
+        parts.append((headers, payload))
+    return parts
+
+
+@pytest.mark.parametrize("how", [{"accept": "multipart/mixed"}, {"params": {"images": "multipart"}}])
+def test_multipart_pairs_cid_references_with_image_parts(client, how):
+    resp = _post(client, **how)
+    assert resp.status_code == 200
+    (json_headers, json_body), *images = _parts(resp)
+    assert json_headers["Content-Type"] == "application/json"
+    answers = json.loads(json_body)
+    assert answers == {"total": 42, "chart": "cid:img-0", "more": {"plots": ["cid:img-1"], "label": "x"}}
+    by_cid = {h["Content-ID"]: (h["Content-Type"], body) for h, body in images}
+    assert by_cid == {"<img-0>": ("image/png", RED), "<img-1>": ("image/png", BLUE)}
+
+
+def test_multipart_boundary_is_fresh_per_response(client):
+    first = _post(client, accept="multipart/mixed").headers["content-type"]
+    second = _post(client, accept="multipart/mixed").headers["content-type"]
+    assert first != second
+
+
+def test_blob_refs_can_be_fetched_back(client):
+    resp = _post(client, accept=app.BLOBREF_MEDIA_TYPE)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith(app.BLOBREF_MEDIA_TYPE)
+    answers = resp.json()
+    assert answers["total"] == 42 and answers["more"]["label"] == "x"
+    refs = [answers["chart"], answers["more"]["plots"][0]]
+    assert all(re.fullmatch(r"/blobs/[0-9a-f]{24}\.png", ref) for ref in refs)
+    for ref, raw in zip(refs, (RED, BLUE)):
+        blob = client.get(ref)
+        assert blob.status_code == 200 and blob.content == raw
+        assert blob.headers["content-type"] == "image/png"
+        assert "immutable" in blob.headers["cache-control"]
+    # content-addressed: the same image gives the same reference
+    assert _post(client, accept=app.BLOBREF_MEDIA_TYPE).json()["chart"] == refs[0]
+
+
+def test_unknown_expired_and_invalid_blob_ids(client):
+    assert client.get("/blobs/" + "0" * 24 + ".png").status_code == 404
+    ref = _post(client, params={"images": "ref"}).json()["chart"]
+    path = app.blob_store.path(ref.rsplit("/", 1)[1])
+    past = time.time() - app.BLOB_TTL_SECONDS - 60
+    os.utime(path, (past, past))
+    assert client.get(ref).status_code == 404
+    assert client.get("/blobs/..%2Fsecret").status_code in (400, 404)
+    assert client.get("/blobs/not-a-blob.png").status_code == 400
+
+
+def test_plain_json_is_the_default(client):
+    resp = _post(client)
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.json() == RESULT
+    assert _post(client, params={"images": "json"}, accept="multipart/mixed").json() == RESULT
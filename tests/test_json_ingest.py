@@ -0,0 +1,72 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def _records(n=40):
+    rng = np.random.default_rng(0)
+    out = []
+    for i in range(n):
+        record = {
+            "id": i,
+            "name": f"item {i}" if i % 5 else None,
+            "price": float(rng.integers(0, 100)) + (0.5 if i > 20 else 0.0),  # whole numbers in the first chunks
+            "whole": float(i),
+            "in_stock": bool(i % 2),
+            "created_at": 1_700_000_000_000 + i * 60_000,  # epoch ms
+            "date": f"2024-01-{i % 28 + 1:02d}",
+            "count": None if i < 10 else i,  # nothing in the first chunk
+            "owner": {"name": f"o{i % 3}", "team": {"id": i % 2}},
+            "tags": ["a", "b"][: i % 3],
+        }
+        if i > 30:
+            record["late"] = "x"  # a key first seen in a later chunk
+        out.append(record)
+    return out
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setattr(app, "JSON_STREAM_MIN_BYTES", 0)
+    monkeypatch.setattr(app, "JSON_CHUNK_ROWS", 7)
+
+
+def _upload(name, payload):
+    return app._parse_uploaded_dataframe(name, io.BytesIO(payload))
+
+
+def test_streamed_array_upload_matches_read_json(streaming):
+    payload = json.dumps(_records()).encode()
+    records, _, _ = app._json_records(io.BytesIO(payload))
+    assert records is not None
+    pd.testing.assert_frame_equal(_upload("data.json", payload), pd.read_json(io.BytesIO(payload)))
+
+
+def test_streamed_ndjson_upload_matches_read_json(streaming):
+    payload = "\n".join(json.dumps(r) for r in _records()).encode()
+    pd.testing.assert_frame_equal(_upload("data.jsonl", payload), pd.read_json(io.BytesIO(payload), lines=True))
+
+
+def test_small_documents_are_parsed_whole():
+    payload = json.dumps(_records()).encode()
+    records, document, ndjson = app._json_records(io.BytesIO(payload))
+    assert records is None and document == payload and ndjson is False
+    pd.testing.assert_frame_equal(_upload("data.json", payload), pd.read_json(io.BytesIO(payload)))
+
+
+def test_streamed_records_are_flattened_like_json_normalize(streaming):
+    records = _records()
+    df = app.records_to_dataframe(iter(records))
+    expected = pd.json_normalize(records)
+    pd.testing.assert_frame_equal(df, expected[list(df.columns)])
+    assert sorted(df.columns) == sorted(expected.columns)
+
+
+def test_non_object_records_are_positional():
+    records = [[1, "a"], [2, "b"], [3, None]]
+    pd.testing.assert_frame_equal(app.records_to_dataframe(iter(records), chunk_rows=2), pd.DataFrame(records))
@@ -0,0 +1,100 @@
+import pytest
+
+import app
+
+
+class FakeCoordinator:
+    """Hands out (first model, next key) round-robin and records what it was told."""
+
+    def __init__(self):
+        self.acquired, self.quota_errors = [], []
+        self._n = 0
+
+    def acquire(self, keys, models, est_tokens, max_wait=None):
+        self._n += 1
+        slot = (models[0], keys[self._n % len(keys)])
+        self.acquired.append(slot)
+        return slot
+
+    def report_quota_error(self, key, model, retry_after=None):
+        self.quota_errors.append((key, model))
+
+    def record_outcome(self, *args):
+        pass
+
+
+class FakeModel:
+    def __init__(self, behaviour, calls=None):
+        self.behaviour = behaviour
+        self.calls = calls if calls is not None else []
+
+    def invoke(self, prompt, **kwargs):
+        self.calls.append(kwargs)
+        return self.behaviour()
+
+
+def _llm(errors_by_model, calls=None):
+    """errors_by_model: model -> list of exceptions raised by successive calls (then "ok")."""
+    coordinator = FakeCoordinator()
+    llm = app.LLMWithFallback(keys=["k1", "k2", "k3"], models=["m1", "m2", "m3"], coordinator=coordinator)
+
+    def instance(model, key, tools=None):
+        def behaviour():
+            queue = errors_by_model.get(model, [])
+            if queue:
+                raise queue.pop(0)
+            return f"ok from {model}"
+        return FakeModel(behaviour, calls)
+
+    llm._get_llm_instance = instance
+    return llm, coordinator
+
+
+def test_quota_errors_rotate_keys_on_same_model():
+    llm, coordinator = _llm({"m1": [RuntimeError("429 Resource exhausted")]})
+    assert llm.invoke("hi") == "ok from m1"
+    assert [m for m, _ in coordinator.acquired] == ["m1", "m1"]
+    assert len(coordinator.quota_errors) == 1
+
+
+def test_other_errors_fall_back_to_next_model_once():
+    llm, coordinator = _llm({"m1": [RuntimeError("500 internal error")]})
+    assert llm.invoke("hi") == "ok from m2"
+    assert [m for m, _ in coordinator.acquired] == ["m1", "m2"]
+    assert coordinator.quota_errors == []
+
+
+def test_invalid_request_raises_without_retrying():
+    llm, coordinator = _llm({"m1": [ValueError("400 Invalid argument: prompt too long")]})
+    with pytest.raises(ValueError):
+        llm.invoke("hi")
+    assert len(coordinator.acquired) == 1
+
+
+def test_every_model_failing_raises_after_one_try_each():
+    llm, coordinator = _llm({m: [RuntimeError("503 unavailable")] for m in ("m1", "m2", "m3")})
+    with pytest.raises(RuntimeError, match="All models/keys failed"):
+        llm.invoke("hi")
+    assert [m for m, _ in coordinator.acquired] == ["m1", "m2", "m3"]
+
+
+def test_client_timeout_is_the_remaining_request_budget():
+    calls = []
+    llm, _ = _llm({"m1": [RuntimeError("429 Resource exhausted")]}, calls)
+    assert llm.invoke("hi") == "ok from m1"
+    assert calls == [{"timeout": app.LLM_TIMEOUT_SECONDS, "max_retries": 1}] * 2
+
+    calls.clear()
+    with app.use_deadline(app.Deadline(5)):
+        llm.invoke("hi")
+    assert 0 < calls[0]["timeout"] <= 5 and calls[0]["max_retries"] == 1
+
+
+def test_expired_deadline_stops_before_calling_the_model():
+    calls = []
+    llm, _ = _llm({}, calls)
+    deadline = app.Deadline(60)
+    deadline.cancel()
+    with app.use_deadline(deadline), pytest.raises(app.DeadlineExceeded):
+        llm.invoke("hi")
+    assert calls == []
@@ -0,0 +1,10 @@
+from tests.load_test_workers import benchmark
+
+
+def test_preloaded_workers_serve_concurrent_requests():
+    # small version of the load test: real gunicorn, two preloaded workers, stubbed LLM
+    report = benchmark([2], n_requests=6, concurrency=6, rows=1000, llm_latency=0.1)[2]
+    assert report["ok"] == 6
+    for status, body, _ in report["outcomes"]:
+        assert body["rows"] == 1000
+        assert body["total"] > 0
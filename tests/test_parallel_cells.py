@@ -0,0 +1,45 @@
+import app
+
+
+def _cells():
+    return [
+        {"question": "fast", "code": "results['fast'] = 1"},
+        {"question": "slow", "code": "import time\ntime.sleep(60)\nresults['slow'] = 2"},
+        {"question": "queued", "code": "results['queued'] = 3"},
+    ]
+
+
+def test_finished_cells_survive_overall_timeout(monkeypatch):
+    # one worker: "queued" waits behind "slow", and the overall timeout ends the run first
+    monkeypatch.setattr(app, "PARALLEL_CELL_WORKERS", 1)
+    out = app.write_and_run_parallel_cells("", _cells(), timeout=8, cell_timeout=60)
+    assert out["status"] == "success"
+    assert out["result"] == {"fast": 1}
+    assert set(out["errors"]) == {"slow", "queued"}
+    assert all("timed out" in m for m in out["errors"].values())
+
+
+def test_finished_cells_survive_overall_timeout_when_streaming(monkeypatch):
+    monkeypatch.setattr(app, "PARALLEL_CELL_WORKERS", 1)
+    seen = []
+    out = app.write_and_run_parallel_cells("", _cells(), timeout=8, cell_timeout=60, on_cell=seen.append)
+    assert [o["questions"] for o in seen] == [["fast"]]
+    assert out["result"] == {"fast": 1}
+    assert set(out["errors"]) == {"slow", "queued"}
+
+
+def test_finished_cells_keeps_cell_errors():
+    stdout = (
+        '{"cell": 0, "questions": ["a"], "status": "success", "result": {"a": 1}}\n'
+        '{"cell": 1, "questions": ["b"], "status": "error", "message": "ZeroDivisionError"}\n'
+        '{"cell": 2, "questions": ["c"], "sta'
+    )
+    cells = [{"question": q, "code": ""} for q in "abc"]
+    out = app._finished_cells(cells, stdout, "timed out")
+    assert out == {"status": "success", "result": {"a": 1},
+                   "errors": {"b": "ZeroDivisionError", "c": "timed out"}}
+
+
+def test_nothing_finished_is_an_error():
+    out = app._finished_cells([{"question": "a", "code": ""}], "", "timed out")
+    assert out == {"status": "error", "message": "timed out"}
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+FRAMES = {
+    "mixed": pd.DataFrame({"a": [1, 2, 3], "b": [0.5, 1.5, 2.5]}),
+    "ints": pd.DataFrame({"a": [1, 2, 3], "b": [0, 2, 4]}),
+    "floats": pd.DataFrame({"a": [1.0, 2.0, 3.0], "b": [0.0, 2.0, np.nan]}),
+    "strings": pd.DataFrame({"a": [1, 2, 3], "s": ["x", "y", "z"]}),
+    "empty": pd.DataFrame({"a": pd.Series([], dtype="int64"), "b": pd.Series([], dtype="int64")}),
+}
+
+
+def _run(code, frame):
+    ns = {"pd": pd, "np": np}
+    exec(app._PERF_LINT_HELPERS, ns)
+    ns["frame"] = frame.copy()
+    with np.errstate(all="ignore"):
+        exec(code, ns)
+    return ns
+
+
+def _same(x, y):
+    if isinstance(x, (pd.Series, pd.DataFrame)):
+        getattr(pd.testing, f"assert_{type(x).__name__.lower()}_equal")(x, y)
+    elif isinstance(x, list):
+        assert len(x) == len(y)
+        for i, j in zip(x, y):
+            _same(i, j)
+    else:
+        assert type(x) is type(y), (x, y)
+        assert x == pytest.approx(y, nan_ok=True)
+
+
+def _equivalent(code, names, frames=FRAMES):
+    rewritten, findings = app.lint_generated_code(code)
+    assert rewritten != code and any(f["fixed"] for f in findings)
+    for label, frame in frames.items():
+        before, after = _run(code, frame), _run(rewritten, frame)
+        for name in names:
+            _same(before[name], after[name])
+
+
+def test_iterrows_sum_is_equivalent_on_every_frame():
+    _equivalent("acc = 0\nfor _, row in frame.iterrows():\n    acc += row['a'] * 2 - row['a']\n", ["acc"])
+
+
+def test_iterrows_append_is_equivalent_on_every_frame():
+    _equivalent("out = []\nfor _, row in frame.iterrows():\n    out.append(row['a'] > 1)\n", ["out"])
+
+
+def test_apply_axis1_is_equivalent_on_every_frame():
+    _equivalent("res = frame.apply(lambda r: r['a'] * 3, axis=1)\n", ["res"],
+                {k: v for k, v in FRAMES.items() if k != "strings"})
+
+
+def test_integer_floordiv_and_mod_keep_the_apply():
+    # numpy scalars give 0 for x // 0 and x % 0, pandas columns give inf / nan
+    _equivalent("q = frame.apply(lambda r: r['a'] // r['b'], axis=1)\n"
+                "m = frame.apply(lambda r: r['a'] % r['b'], axis=1)\n", ["q", "m"],
+                {"ints": FRAMES["ints"], "floats": FRAMES["floats"]})
+
+
+def test_mixed_frame_uses_the_original_loop():
+    ns = _run(app.lint_generated_code("acc = 0\nfor _, row in frame.iterrows():\n    acc += row['a']\n")[0],
+              FRAMES["mixed"])
+    assert type(ns["acc"]) is np.float64 and ns["acc"] == 6.0
+
+
+CONCAT_LOOP = (
+    "acc = {init}\n"
+    "for i in range({n}):\n"
+    "    acc = pd.concat([acc, pd.DataFrame({{'x': [i]}}, index=[i])]{kw})\n"
+)
+
+
+@pytest.mark.parametrize("init,n,kw", [
+    ("None", 0, ""),
+    ("None", 3, ""),
+    ("pd.DataFrame({'x': [-1]})", 0, ""),
+    ("pd.DataFrame({'x': [-1]})", 3, ""),
+    ("pd.DataFrame({'x': [-1]})", 3, ", ignore_index=True"),
+])
+def test_concat_in_loop_is_equivalent(init, n, kw):
+    code = CONCAT_LOOP.format(init=init, n=n, kw=kw)
+    rewritten, findings = app.lint_generated_code(code)
+    assert findings[0]["fixed"]
+    before, after = _run(code, FRAMES["ints"])["acc"], _run(rewritten, FRAMES["ints"])["acc"]
+    if before is None:
+        assert after is None
+    else:
+        pd.testing.assert_frame_equal(before, after)
+
+
+@pytest.mark.parametrize("kw", [", keys=[0, 1]", ", axis=1", ", sort=True"])
+def test_concat_with_other_keywords_is_not_rewritten(kw):
+    code = CONCAT_LOOP.format(init="None", n=3, kw=kw)
+    rewritten, findings = app.lint_generated_code(code)
+    assert rewritten == code
+    assert findings and not findings[0]["fixed"]
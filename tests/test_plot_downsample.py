@@ -0,0 +1,121 @@
+import io
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.axes
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from matplotlib.testing.compare import compare_images
+
+import app
+
+
+@pytest.fixture
+def helpers():
+    ns = {"np": np, "plt": plt}
+    exec(app._PLOT_DOWNSAMPLE_HELPERS.replace("_DOWNSAMPLE_MIN_POINTS_VALUE", "20000"), ns)
+    return ns
+
+
+@pytest.fixture
+def patched(helpers):
+    saved = matplotlib.axes.Axes.plot, matplotlib.axes.Axes.scatter, matplotlib.axes.Axes.hist
+    exec(app._PLOT_AUTO_DOWNSAMPLE_PATCH, helpers)
+    yield helpers
+    matplotlib.axes.Axes.plot, matplotlib.axes.Axes.scatter, matplotlib.axes.Axes.hist = saved
+
+
+def test_auto_downsample_is_opt_in():
+    assert app.PLOT_AUTO_DOWNSAMPLE is False
+    prelude = "\n".join(app._sandbox_prelude())
+    assert "lttb_downsample" in prelude and "_maxes.Axes.plot = _downsampled_plot" not in prelude
+
+
+def test_lttb_keeps_endpoints_and_count(helpers):
+    x = np.arange(10_000, dtype=float)
+    y = np.sin(x / 300)
+    idx = helpers["lttb_indices"](x, y, 500)
+    assert len(idx) == 500 and idx[0] == 0 and idx[-1] == len(x) - 1
+    assert (np.diff(idx) > 0).all()
+    assert list(helpers["lttb_indices"](x[:10], y[:10], 50)) == list(range(10))
+
+
+def test_lttb_keeps_spikes(helpers):
+    rng = np.random.default_rng(0)
+    y = rng.normal(0, 0.1, 100_000)
+    spikes = [1234, 50_000, 98_765]
+    y[spikes] = [25.0, -30.0, 40.0]
+    idx = helpers["lttb_indices"](np.arange(len(y)), y, 1000)
+    assert set(spikes) <= set(idx)
+
+
+def test_lttb_handles_datetime_x(helpers):
+    x = np.arange("2024-01-01", "2024-03-01", dtype="datetime64[m]")
+    y = np.cos(np.arange(len(x)) / 500.0)
+    dx, dy = helpers["lttb_downsample"](x, y, n_out=300)
+    assert dx.dtype == x.dtype and len(dx) == len(dy) == 300
+    assert dx[0] == x[0] and dx[-1] == x[-1]
+
+
+def _png(draw):
+    fig, ax = plt.subplots(figsize=(6, 4), dpi=80)
+    draw(ax)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    limits = ax.get_xlim(), ax.get_ylim()
+    plt.close(fig)
+    return buf.getvalue(), limits
+
+
+def _rms(tmp_path, a, b):
+    pa, pb = tmp_path / "a.png", tmp_path / "b.png"
+    pa.write_bytes(a)
+    pb.write_bytes(b)
+    result = compare_images(str(pa), str(pb), tol=0, in_decorator=True)
+    return 0.0 if result is None else result["rms"]
+
+
+def _data(n=200_000):
+    rng = np.random.default_rng(1)
+    x = np.sort(rng.uniform(0, 100, n))
+    return x, np.cumsum(rng.normal(0, 1, n)), rng.normal(x, 10), rng.uniform(-5, 50, n)
+
+
+def test_downsampled_images_match_the_originals(tmp_path, helpers):
+    x, walk, cloud, color = _data()
+    draws = {
+        "line": lambda ax: ax.plot(x, walk, "-", linewidth=1),
+        "scatter": lambda ax: ax.scatter(x, cloud, s=4, c=color, cmap="viridis"),
+        "hist": lambda ax: ax.hist(cloud, bins=60),
+    }
+    originals = {name: _png(draw) for name, draw in draws.items()}
+    saved = matplotlib.axes.Axes.plot, matplotlib.axes.Axes.scatter, matplotlib.axes.Axes.hist
+    try:
+        exec(app._PLOT_AUTO_DOWNSAMPLE_PATCH, helpers)
+        downsampled = {name: _png(draw) for name, draw in draws.items()}
+    finally:
+        matplotlib.axes.Axes.plot, matplotlib.axes.Axes.scatter, matplotlib.axes.Axes.hist = saved
+    for name in draws:
+        assert originals[name][1] == downsampled[name][1], name
+    assert _rms(tmp_path, originals["hist"][0], downsampled["hist"][0]) == 0
+    # the line and the point cloud cover the same pixels; what differs is the antialiased
+    # overdraw of 200k strokes/markers (measured rms: line ~8, scatter ~13 on 0-255)
+    assert _rms(tmp_path, originals["line"][0], downsampled["line"][0]) < 10
+    assert _rms(tmp_path, originals["scatter"][0], downsampled["scatter"][0]) < 16
+
+
+def test_scatter_keeps_the_color_scale_of_all_points(patched):
+    x, _, cloud, _ = _data(50_000)
+    # the extreme colors sit on points that share their pixel with a later point
+    color = np.zeros(len(x))
+    color[:2] = [-100.0, 100.0]
+    x[:2], cloud[:2] = x[2], cloud[2]
+    fig, ax = plt.subplots()
+    artist = ax.scatter(x, cloud, c=color)
+    assert len(artist.get_offsets()) < len(x)
+    assert artist.norm.vmin == -100.0 and artist.norm.vmax == 100.0
+    explicit = ax.scatter(x, cloud, c=color, vmin=-1, vmax=1)
+    assert explicit.norm.vmin == -1 and explicit.norm.vmax == 1
+    plt.close(fig)
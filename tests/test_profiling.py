@@ -0,0 +1,80 @@
+import os
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+CODE = """def build(n):
+    return [i * i for i in range(n)]
+
+values = build(200_000)
+total = sum(values)
+results['total'] = total
+"""
+
+
+@pytest.fixture
+def plan(monkeypatch):
+    """Make the agent answer with the given code."""
+    def use(code):
+        monkeypatch.setattr(app, "_generate_plan", lambda llm_input: {"questions": ["total"], "code": code})
+    return use
+
+
+def test_profiled_run_reports_the_generated_code(plan):
+    plan(CODE)
+    out = app.run_agent_safely_unified("", profile=True)
+    assert out["total"] == sum(i * i for i in range(200_000))
+    profile = out["_profile"]
+    assert re.fullmatch(r"[0-9a-f]{24}", profile["id"])
+    report = profile["report"]
+
+    # cProfile: the generated function is there, under the name of the generated code
+    assert any(f["function"] == "<generated>:1(build)" for f in report["top_functions"])
+    assert len(report["top_functions"]) <= app.PROFILE_TOP_FUNCTIONS
+
+    # line tracer: only lines of the generated code, with their source
+    source = CODE.splitlines()
+    assert report["lines"]
+    for line in report["lines"]:
+        assert 1 <= line["line"] <= len(source) and line["source"] == source[line["line"] - 1].strip()
+    by_source = {line["source"]: line for line in report["lines"]}
+    assert by_source["total = sum(values)"]["hits"] == 1
+    assert report["hotspots"][0]["seconds"] >= by_source["total = sum(values)"]["seconds"]
+
+    # tracemalloc: the list of 200k ints is traced
+    assert report["peak_traced_mb"] > 1
+    assert by_source["values = build(200_000)"]["peak_mb"] > 1
+
+
+def test_failing_run_still_stores_a_linked_profile(plan):
+    plan("x = 1\nraise ValueError('boom')\n")
+    out = app.run_agent_safely_unified("", profile=True)
+    assert "boom" in out["error"]
+    profile_id = re.search(r"\(profile: /profiles/([0-9a-f]{24})\)", out["error"]).group(1)
+    resp = TestClient(app.app).get(f"/profiles/{profile_id}")
+    assert resp.status_code == 200
+    record = resp.json()
+    assert record["id"] == profile_id and "raise ValueError('boom')" in record["code"]
+    assert [line["source"] for line in record["report"]["lines"]] == ["x = 1", "raise ValueError('boom')"]
+
+
+def test_profiled_runs_bypass_the_execution_cache(monkeypatch, tmp_path):
+    cache = app.ExecutionResultCache(str(tmp_path / "exec"), 60, 1 << 20)
+    monkeypatch.setattr(app, "_exec_cache", cache)
+    code = "results['n'] = 6 * 7"
+    assert not app.write_and_run_temp_python(code, dataset_hash="d1").get("cached")
+    assert app.write_and_run_temp_python(code, dataset_hash="d1").get("cached")
+
+    profiled = app.write_and_run_temp_python(code, dataset_hash="d1", profile=True)
+    assert not profiled.get("cached") and profiled["result"] == {"n": 42}
+    assert profiled["profile_id"] and "lines" in profiled["profile"]
+    assert len(os.listdir(cache.root)) == 1
+
+
+def test_unknown_and_invalid_profile_ids():
+    client = TestClient(app.app)
+    assert client.get("/profiles/" + "0" * 24).status_code == 404
+    assert client.get("/profiles/not-an-id").status_code == 400
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+COLUMNS = ["region", "sales", "x", "y", "z"]
+
+
+def _frame(n=600):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "region": np.tile(["EU", "US", "APAC"], n // 3),
+        "sales": rng.integers(0, 1000, n).astype(float),
+        "x": rng.random(n),
+        "y": rng.integers(0, 5, n),
+        "z": rng.random(n),
+    })
+
+
+def _usage(code):
+    return app.analyze_df_usage(code, COLUMNS)
+
+
+def test_simple_filters_are_pushed():
+    usage = _usage("results = {'s': df[(df['region'] == 'EU') & (df['sales'] > 100)]['x'].sum()}")
+    assert usage["columns"] == ["region", "sales", "x"]
+    assert usage["filters"] == [["region", "==", "EU"], ["sales", ">", 100]]
+
+
+@pytest.mark.parametrize("code", [
+    "results = {'s': df[(df['region'] == 'EU') & (df['sales'] > df['sales'].mean())]['x'].sum()}",
+    "results = {'s': df[(df['region'] == 'EU') & (df['sales'] > df['x'])]['x'].sum()}",
+    "results = {'s': df[df['region'] == 'EU'][df['sales'] > df['sales'].median()]['x'].sum()}",
+    "results = {'s': df.query(\"region == 'EU' and sales > sales.mean()\")['x'].sum()}",
+    "results = {'s': df.loc[(df.region == 'EU') & (df.sales > df.sales.max() / 2), 'x'].sum()}",
+])
+def test_masks_with_non_elementwise_terms_are_not_pushed(code):
+    usage = _usage(code)
+    assert usage is not None and usage["filters"] == []
+
+
+def test_dict_keys_and_method_strings_are_used_columns():
+    usage = _usage("results = {'s': df.astype({'y': float})['x'].sum(), "
+                   "'t': df.sort_values(by=['z'])['sales'].iloc[0]}")
+    assert usage["columns"] == ["sales", "x", "y", "z"]
+
+
+CODES = [
+    "results = {'s': float(df[(df['region'] == 'EU') & (df['sales'] > 100)]['x'].sum())}",
+    "results = {'s': float(df[(df['region'] == 'EU') & (df['sales'] > df['sales'].mean())]['x'].sum())}",
+    "results = {'s': float(df.astype({'y': float})['x'].sum())}",
+    "eu = df[df['region'] == 'EU']['sales']\n"
+    "results = {'labels': eu.index[:5].tolist(), 'first': float(eu.loc[eu.index[1]])}",
+    "results = {'labels': df.query(\"sales >= 500\")['x'].index[:5].tolist()}",
+]
+
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory):
+    df = _frame()
+    root = tmp_path_factory.mktemp("projection")
+    pickle = str(root / "data.pkl")
+    df.to_pickle(pickle)
+    arrow = str(root / "data.arrow")
+    app._write_arrow_file(app._arrow_table(df), arrow)
+    parquet = str(root / "data.parquet")
+    df.to_parquet(parquet, row_group_size=50)
+    return df, {"pickle": (None, None, pickle), "arrow": (None, None, arrow),
+                "hot": (arrow, None, pickle), "parquet": (None, parquet, pickle)}
+
+
+def _run(code, df):
+    ns = {"pd": pd, "np": np, "df": df}
+    exec(code, ns)
+    return ns["results"]
+
+
+@pytest.mark.parametrize("code", CODES)
+@pytest.mark.parametrize("source", ["pickle", "arrow", "hot", "parquet"])
+def test_projected_loads_give_the_same_results(code, source, sources):
+    df, paths = sources
+    loader = {"pd": pd, "np": np}
+    exec(app._DATASET_LOADER, loader)
+    projection = _usage(code)
+    assert projection is not None
+    frame = loader["_load_dataset"](*paths[source], projection)
+    assert _run(code, frame) == _run(code, df.copy())
+
+
+@pytest.mark.parametrize("source", ["arrow", "hot", "parquet"])
+def test_filtered_loads_keep_the_row_labels(source, sources):
+    df, paths = sources
+    loader = {"pd": pd, "np": np}
+    exec(app._DATASET_LOADER, loader)
+    projection = {"columns": ["region", "sales"], "filters": [["region", "==", "US"], ["sales", ">", 500]]}
+    frame = loader["_load_dataset"](*paths[source], projection)
+    expected = df[(df["region"] == "US") & (df["sales"] > 500)][["region", "sales"]]
+    pd.testing.assert_frame_equal(frame, expected, check_index_type=False)
@@ -0,0 +1,159 @@
+import asyncio
+import decimal
+import functools
+import json
+import os
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import app
+
+TABLE_HTML = """<html><body><h1>Films</h1>
+<table><tr><th>Title</th><th>Gross</th></tr>
+<tr><td>Alpha</td><td>100</td></tr><tr><td>Beta</td><td>250</td></tr></table>
+</body></html>"""
+
+# the table only exists after the script ran
+JS_TABLE_HTML = """<html><body><div id="root">Loading...</div><script>
+document.getElementById("root").innerHTML =
+  "<table><tr><th>City</th><th>Pop</th></tr><tr><td>Oslo</td><td>709</td></tr>" +
+  "<tr><td>Bergen</td><td>291</td></tr></table>";
+</script></body></html>"""
+
+RECORDS = [{"id": 1, "name": "a", "score": 1.5}, {"id": 2, "name": "b", "score": 2.5},
+           {"id": 3, "name": "c", "score": None}]
+
+
+@pytest.fixture(scope="module")
+def site(tmp_path_factory):
+    root = tmp_path_factory.mktemp("site")
+    (root / "table.html").write_text(TABLE_HTML)
+    (root / "js_table.html").write_text(JS_TABLE_HTML)
+    (root / "plain.html").write_text("<html><body><p>No tables here.</p></body></html>")
+    (root / "records.json").write_text(json.dumps(RECORDS))
+    (root / "records.ndjson").write_text("\n".join(json.dumps(r) for r in RECORDS))
+    pd.DataFrame({
+        "when": pd.to_datetime(["2024-01-01", "2024-06-30"]),
+        "price": [decimal.Decimal("1.10"), decimal.Decimal("2.25")],
+        "qty": [3, 4],
+    }).to_parquet(root / "typed.parquet")
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(root))
+    handler.log_message = lambda *a: None
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def _scrape(url):
+    out = app.scrape_url_to_dataframe.invoke(url)
+    assert out["status"] == "success", out
+    return out
+
+
+def test_static_html_table(site, monkeypatch):
+    monkeypatch.setattr(app, "browser_pool", None)
+    out = _scrape(f"{site}/table.html")
+    assert out["columns"] == ["Title", "Gross"]
+    assert [r["Title"] for r in out["data"]] == ["Alpha", "Beta"]
+
+
+def test_page_without_table_falls_back_to_text(site, monkeypatch):
+    monkeypatch.setattr(app, "browser_pool", None)
+    out = _scrape(f"{site}/plain.html")
+    assert out["columns"] == ["text"] and "No tables here." in out["data"][0]["text"]
+
+
+def test_js_table_without_renderer_is_text(site, monkeypatch):
+    monkeypatch.setattr(app, "browser_pool", None)
+    out = _scrape(f"{site}/js_table.html")
+    assert out["columns"] == ["text"]
+
+
+@pytest.mark.parametrize("name", ["records.json", "records.ndjson"])
+def test_json_records(site, name):
+    out = _scrape(f"{site}/{name}")
+    assert out["columns"] == ["id", "name", "score"]
+    assert [r["id"] for r in out["data"]] == [1, 2, 3]
+    assert out["data"][1]["score"] == 2.5
+
+
+@pytest.fixture
+def empty_scrape_cache():
+    for entry in os.scandir(app.scrape_cache.root):
+        os.unlink(entry.path)
+
+
+def test_cache_hit_returns_the_same_types_as_a_miss(site, empty_scrape_cache, monkeypatch):
+    url = f"{site}/typed.parquet"
+    miss = _scrape(url)
+
+    def offline(*args, **kwargs):
+        raise AssertionError("not served from the cache")
+
+    monkeypatch.setattr(app.requests, "get", offline)
+    hit = _scrape(url)
+    assert hit == miss
+    assert [type(v) for v in hit["data"][0].values()] == [type(v) for v in miss["data"][0].values()]
+    assert isinstance(hit["data"][0]["when"], pd.Timestamp)
+    assert isinstance(hit["data"][0]["price"], decimal.Decimal)
+
+
+def test_cache_key_includes_the_render_backend(site, empty_scrape_cache, monkeypatch):
+    url = f"{site}/table.html"
+    monkeypatch.setattr(app, "browser_pool", None)
+    _scrape(url)
+    fetched = []
+    real_get = app.requests.get
+    monkeypatch.setattr(app.requests, "get", lambda *a, **k: fetched.append(a[0]) or real_get(*a, **k))
+    _scrape(url)
+    assert fetched == []
+    monkeypatch.setattr(app, "SCRAPE_RENDER_BACKEND", "always")
+    _scrape(url)
+    assert fetched == [url]
+
+
+@pytest.fixture(scope="module")
+def pool():
+    if not app.PLAYWRIGHT_AVAILABLE:
+        pytest.skip("playwright not installed")
+    pool = app.BrowserPool(1, 20)
+    try:
+        pool.render("data:text/html,<p>probe</p>", timeout=20)
+    except Exception as e:
+        pool.close()
+        pytest.skip(f"no launchable Chromium: {e}")
+    yield pool
+    pool.close()
+
+
+def test_js_table_is_rendered_by_the_pool(site, pool, monkeypatch):
+    monkeypatch.setattr(app, "browser_pool", pool)
+    out = _scrape(f"{site}/js_table.html")
+    assert out["columns"] == ["City", "Pop"]
+    assert [r["City"] for r in out["data"]] == ["Oslo", "Bergen"]
+    # the static page is parsed without rendering
+    assert _scrape(f"{site}/table.html")["columns"] == ["Title", "Gross"]
+    assert pool.stats()["idle_contexts"] == 1
+
+
+def test_render_wait_is_capped_by_the_request_deadline():
+    pool = app.BrowserPool(1, 30)
+
+    async def hung_render(url, timeout):
+        await asyncio.sleep(60)
+
+    pool._render = hung_render
+    token = app._current_deadline.set(app.Deadline(1))
+    try:
+        start = time.monotonic()
+        with pytest.raises(Exception):
+            pool.render("http://127.0.0.1:9/never", timeout=30)
+        assert time.monotonic() - start < 5
+    finally:
+        app._current_deadline.reset(token)
+        pool.close()
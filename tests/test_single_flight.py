@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def _job(question="q1"):
+    return {"llm_input": f"Answer {question}", "dataset_hash": "d" * 64, "pickle_path": None}
+
+
+class FakeAnalysis:
+    """Stands in for _execute_analysis: each run blocks until released and takes a while to cancel."""
+
+    def __init__(self):
+        self.runs = 0
+        self.cancelled = 0
+        self.release = None
+
+    async def __call__(self, job, progress=None):
+        self.runs += 1
+        run = self.runs
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            await asyncio.sleep(0.05)  # cleanup (releasing the hot tier, killing the sandbox) awaits too
+            raise
+        return {"answer": {"run": run, "rows": [1, 2, 3]}}
+
+
+@pytest.fixture
+def analysis(monkeypatch):
+    fake = FakeAnalysis()
+    monkeypatch.setattr(app, "_execute_analysis", fake)
+    monkeypatch.setattr(app, "SINGLE_FLIGHT_ENABLED", True)
+    app._in_flight.clear()
+    yield fake
+    app._in_flight.clear()
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_identical_jobs_share_one_run_and_get_their_own_copies(analysis):
+    async def scenario():
+        analysis.release = asyncio.Event()
+        first = asyncio.ensure_future(app._execute_coalesced(_job()))
+        second = asyncio.ensure_future(app._execute_coalesced(_job()))
+        other = asyncio.ensure_future(app._execute_coalesced(_job("q2")))
+        await _settle()
+        analysis.release.set()
+        return await asyncio.gather(first, second, other)
+
+    a, b, c = asyncio.run(scenario())
+    assert analysis.runs == 2  # one for the two identical jobs, one for the other
+    assert a == b and a is not b and a["answer"] is not b["answer"]
+    a["answer"]["rows"].append(4)
+    assert b["answer"]["rows"] == [1, 2, 3]
+    assert c["answer"]["run"] != a["answer"]["run"]
+    assert app._in_flight == {}
+
+
+def test_run_survives_one_waiter_leaving(analysis):
+    async def scenario():
+        analysis.release = asyncio.Event()
+        leaver = asyncio.ensure_future(app._execute_coalesced(_job()))
+        stayer = asyncio.ensure_future(app._execute_coalesced(_job()))
+        await _settle()
+        leaver.cancel()
+        await _settle()
+        analysis.release.set()
+        return await stayer, leaver
+
+    result, leaver = asyncio.run(scenario())
+    assert leaver.cancelled() and analysis.cancelled == 0
+    assert result["answer"]["run"] == 1 and analysis.runs == 1
+
+
+def test_last_waiter_leaving_cancels_the_run(analysis):
+    async def scenario():
+        analysis.release = asyncio.Event()
+        waiters = [asyncio.ensure_future(app._execute_coalesced(_job())) for _ in range(2)]
+        await _settle()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert analysis.runs == 1 and analysis.cancelled == 1
+    assert app._in_flight == {}
+
+
+def test_request_arriving_while_a_run_is_cancelling_starts_its_own(analysis):
+    async def scenario():
+        analysis.release = asyncio.Event()
+        leaver = asyncio.ensure_future(app._execute_coalesced(_job()))
+        await _settle()
+        leaver.cancel()
+        await _settle()
+        # the abandoned run is still cleaning up
+        assert analysis.cancelled == 1
+        analysis.release = asyncio.Event()
+        analysis.release.set()
+        return await asyncio.wait_for(app._execute_coalesced(_job()), timeout=5)
+
+    result = asyncio.run(scenario())
+    assert result["answer"]["run"] == 2
@@ -0,0 +1,89 @@
+import pytest
+
+import app
+
+QUESTIONS = (
+    "Use the attached sales.csv.\n\n"
+    + "".join(f"{i}. What is metric {i}?\n" for i in range(1, 13))
+    + "\nReturn a JSON object with keys:\n- `m1`: number\n"
+)
+LABELS = [f"What is metric {i}?" for i in range(1, 13)]
+
+
+def test_split_shares_head_and_tail_and_sizes_groups():
+    groups = app.split_questions(QUESTIONS, 5)
+    assert [len(g["labels"]) for g in groups] == [5, 5, 2]
+    assert [label for g in groups for label in g["labels"]] == LABELS
+    for group in groups:
+        assert group["text"].startswith("Use the attached sales.csv.\n\n")
+        assert group["text"].endswith("Return a JSON object with keys:\n- `m1`: number\n")
+        assert all(label in group["text"] for label in group["labels"])
+        others = [label for g in groups if g is not group for label in g["labels"]]
+        assert not any(label in group["text"] for label in others)
+
+
+def test_too_few_questions_are_not_split():
+    assert app.split_questions(QUESTIONS, 12) is None
+    assert app.split_questions("What is the mean?", 1) is None
+
+
+def _answer_code(questions):
+    return "\n".join(f"results[{q!r}] = {q!r}.split()[-1].rstrip('?')" for q in questions)
+
+
+def _run(monkeypatch, plan_for_group):
+    """Run the split pipeline with plan_for_group(labels) standing in for the agent."""
+    groups = app.split_questions(QUESTIONS, 5)
+    by_input = {}
+    for group in groups:
+        group["input"] = group["text"]
+        by_input[group["text"]] = group["labels"]
+    monkeypatch.setattr(app, "_generate_plan", lambda llm_input: plan_for_group(by_input[llm_input]))
+    monkeypatch.setattr(app, "CODEGEN_GROUP_ATTEMPTS", 1)
+    return app.run_agent_safely_unified("", codegen_groups=groups)
+
+
+def test_failing_group_gets_only_its_own_error_answers(monkeypatch):
+    def plan(labels):
+        if labels[0] == LABELS[5]:
+            return {"error": "model refused"}
+        return {"questions": labels, "code": _answer_code(labels)}
+
+    out = _run(monkeypatch, plan)
+    assert list(out) == LABELS
+    for i, label in enumerate(LABELS, 1):
+        if 6 <= i <= 10:
+            assert out[label].startswith("Error: ") and "model refused" in out[label]
+        else:
+            assert out[label] == str(i)
+
+
+@pytest.mark.parametrize("report", ["extra", "merged"])
+def test_answer_order_survives_a_group_reporting_other_questions(monkeypatch, report):
+    def plan(labels):
+        if labels[0] != LABELS[0]:
+            return {"questions": labels, "code": _answer_code(labels)}
+        if report == "extra":
+            # reworded questions plus one that belongs to another group
+            asked = [f"Q: {label}" for label in labels] + ["What is metric 7?"]
+            code = "\n".join(f"results[{a!r}] = {label.split()[-1].rstrip('?')!r}"
+                             for a, label in zip(asked, labels)) + "\nresults['What is metric 7?'] = 'wrong'"
+            return {"questions": asked, "code": code}
+        # the last two questions answered as one
+        asked = labels[:3] + ["metrics 4 and 5"]
+        return {"questions": asked, "code": _answer_code(labels[:3]) + "\nresults['metrics 4 and 5'] = '4'"}
+
+    out = _run(monkeypatch, plan)
+    assert list(out) == LABELS
+    assert out["What is metric 7?"] == "7"
+    assert [out[label] for label in LABELS[:4]] == ["1", "2", "3", "4"]
+    if report == "merged":
+        assert out[LABELS[4]].startswith("Error: ")
+    else:
+        assert out[LABELS[4]] == "5"
+    assert [out[label] for label in LABELS[5:]] == [str(i) for i in range(6, 13)]
+
+    # the declared keys of the request map onto the answers by position
+    keys = [f"m{i}" for i in range(1, 13)]
+    typed = app._apply_key_types(out, keys, {k: str for k in keys})
+    assert typed["m12"] == "12" and typed["m7"] == "7"
@@ -0,0 +1,76 @@
+"""
+/api?stream=1 against a real uvicorn server: Starlette's StreamingResponse listens for the client
+disconnecting on the same receive channel the multipart body arrives on, which an ASGI test
+transport does not reproduce.
+"""
+import json
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+import app
+
+QUESTIONS = b"1. How many rows are there?\n"
+
+
+def _stub_plan(llm_input, max_retries=3):
+    return {"questions": ["rows"],
+            "code": "results = {'rows': int(len(df)) if 'df' in globals() else 0}"}
+
+
+@pytest.fixture()
+def server(monkeypatch):
+    monkeypatch.setattr(app, "_generate_plan", _stub_plan)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    srv = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=srv.run, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if srv.started:
+            break
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    srv.should_exit = True
+    thread.join(timeout=10)
+
+
+def _events(base_url, files):
+    events = []
+    with httpx.Client(timeout=60) as client:
+        with client.stream("POST", f"{base_url}/api?stream=1", files=files) as resp:
+            assert resp.status_code == 200
+            event = None
+            for line in resp.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    events.append((event, json.loads(line[len("data: "):])))
+    return events
+
+
+def test_stream_with_data_file(server):
+    csv = b"a,b\n" + b"".join(b"%d,%d\n" % (i, i * 2) for i in range(500))
+    events = _events(server, {"questions_file": ("questions.txt", QUESTIONS),
+                              "data_file": ("data.csv", csv)})
+    names = [e for e, _ in events]
+    assert names[0] == "accepted"
+    assert "error" not in names, events
+    assert ("answer", {"question": "rows", "answer": 500}) in events
+    assert events[-1] == ("result", {"rows": 500})
+
+
+def test_stream_with_questions_only(server):
+    events = _events(server, {"questions_file": ("questions.txt", QUESTIONS)})
+    assert events[-1] == ("result", {"rows": 0}), events
+
+
+def test_stream_reports_missing_questions_file(server):
+    events = _events(server, {"data_file": ("data.csv", b"a\n1\n")})
+    assert events[-1][0] == "error"
+    assert events[-1][1]["status_code"] == 400